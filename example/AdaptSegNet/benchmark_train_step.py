@@ -0,0 +1,82 @@
+import argparse
+import itertools
+import subprocess
+import sys
+import time
+import torch
+import torch.optim as optim
+import torch.backends.cudnn as cudnn
+
+from model.deeplab_multi import Res_Deeplab
+from model.discriminator import FCDiscriminator
+from utils.train_step import MultiLevelAdaptStep
+from pytorchgo.utils import logger
+from pytorchgo.utils.gpu import PeakGPUMemory
+
+# Peak memory and iteration time of the multi-level AdaptSegNet step for each
+# combination of segmentation loss / discriminator input resolution, each one measured
+# in its own process so that the peaks don't carry over.
+#   python benchmark_train_step.py --input_size 1280,720 --input_size_target 1024,512
+parser = argparse.ArgumentParser(description='AdaptSegNet training step benchmark')
+parser.add_argument('--input_size', type=str, default='1280,720')
+parser.add_argument('--input_size_target', type=str, default='1024,512')
+parser.add_argument('--num_classes', type=int, default=19)
+parser.add_argument('--iter_size', type=int, default=1)
+parser.add_argument('--iterations', type=int, default=10)
+parser.add_argument('--gpu', type=int, default=0)
+parser.add_argument('--only', type=str, default=None,
+                    help='seg_resolution,d_resolution: a single measurement')
+args = parser.parse_args()
+args.learning_rate = 2.5e-4
+
+
+def fake_batch(size, num_classes):
+    w, h = size
+    images = torch.randn(1, 3, h, w)
+    labels = torch.LongTensor(1, h, w).random_(0, num_classes)
+    return images, labels
+
+
+def benchmark(seg_resolution, d_resolution, input_size, input_size_target):
+    model = Res_Deeplab(num_classes=args.num_classes).cuda()
+    model_D1 = FCDiscriminator(num_classes=args.num_classes).cuda()
+    model_D2 = FCDiscriminator(num_classes=args.num_classes).cuda()
+    optimizer = optim.SGD(model.optim_parameters(args), lr=args.learning_rate, momentum=0.9)
+    optimizer_D1 = optim.Adam(model_D1.parameters(), lr=1e-4, betas=(0.9, 0.99))
+    optimizer_D2 = optim.Adam(model_D2.parameters(), lr=1e-4, betas=(0.9, 0.99))
+    train_step = MultiLevelAdaptStep(model, [model_D1, model_D2], optimizer, [optimizer_D1, optimizer_D2],
+                                     lambda_seg=(0.1, 1.0), lambda_adv=(0.0002, 0.001),
+                                     input_size=input_size, input_size_target=input_size_target,
+                                     iter_size=args.iter_size, seg_resolution=seg_resolution,
+                                     d_resolution=d_resolution)
+    data_iter = itertools.repeat((fake_batch(input_size, args.num_classes),
+                                  fake_batch(input_size_target, args.num_classes)))
+
+    train_step.step(data_iter)  # warm up cudnn
+    torch.cuda.synchronize()
+    with PeakGPUMemory() as memory:
+        start = time.time()
+        for _ in range(args.iterations):
+            train_step.step(data_iter)
+        torch.cuda.synchronize()
+        elapsed = (time.time() - start) / args.iterations
+    logger.info('seg loss at {:6s} resolution, D at {:6s} resolution: {:.3f} s/iter, peak memory {}'.format(
+        seg_resolution, d_resolution, elapsed, memory))
+
+
+if __name__ == '__main__':
+    if args.only:
+        from pytorchgo.utils.pytorch_utils import set_gpu
+        set_gpu(args.gpu)
+        cudnn.enabled = True
+        cudnn.benchmark = True
+        input_size = tuple(map(int, args.input_size.split(',')))
+        input_size_target = tuple(map(int, args.input_size_target.split(',')))
+        seg_resolution, d_resolution = args.only.split(',')
+        benchmark(seg_resolution, d_resolution, input_size, input_size_target)
+    else:
+        # CUDA isn't touched here, every combination starts from a fresh process
+        logger.info('peak memory: as nvidia-smi reports it for the process, CUDA context included')
+        for seg_resolution in ['input', 'output']:
+            for d_resolution in ['input', 'output']:
+                subprocess.check_call([sys.executable] + sys.argv + ['--only', '{},{}'.format(seg_resolution, d_resolution)])
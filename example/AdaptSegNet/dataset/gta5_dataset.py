@@ -7,6 +7,7 @@ import torch
 import torchvision
 from torch.utils import data
 from PIL import Image
+from pytorchgo.dataloader import LabelMapper, CITYSCAPES_ID_TO_TRAINID
 
 
 class GTA5DataSet(data.Dataset):
@@ -24,9 +25,8 @@ class GTA5DataSet(data.Dataset):
 	    self.img_ids = self.img_ids * int(np.ceil(float(max_iters) / len(self.img_ids)))
         self.files = []
 
-        self.id_to_trainid = {7: 0, 8: 1, 11: 2, 12: 3, 13: 4, 17: 5,
-                              19: 6, 20: 7, 21: 8, 22: 9, 23: 10, 24: 11, 25: 12,
-                              26: 13, 27: 14, 28: 15, 31: 16, 32: 17, 33: 18}
+        self.id_to_trainid = CITYSCAPES_ID_TO_TRAINID
+        self.label_mapper = LabelMapper(self.id_to_trainid, ignore_label=ignore_label)
 
         # for split in ["train", "trainval", "val"]:
         for name in self.img_ids:
@@ -54,12 +54,9 @@ class GTA5DataSet(data.Dataset):
         label = label.resize(self.crop_size, Image.NEAREST)
 
         image = np.asarray(image, np.float32)
-        label = np.asarray(label, np.float32)
 
         # re-assign labels to match the format of Cityscapes
-        label_copy = 255 * np.ones(label.shape, dtype=np.float32)
-        for k, v in self.id_to_trainid.items():
-            label_copy[label == k] = v
+        label_copy = self.label_mapper(label)
 
         size = image.shape
         image = image[:, :, ::-1]  # change to BGR
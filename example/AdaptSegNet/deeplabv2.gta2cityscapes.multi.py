@@ -1,26 +1,25 @@
 import argparse
 import torch
-import torch.nn as nn
 from torch.utils import data, model_zoo
 import numpy as np
 import pickle
-from torch.autograd import Variable
 import torch.optim as optim
 import scipy.misc
 import torch.backends.cudnn as cudnn
-import torch.nn.functional as F
 import sys
 import os
-import os.path as osp
 import random
 
 from model.deeplab_multi import Res_Deeplab
 from model.discriminator import FCDiscriminator
-from utils.loss import CrossEntropy2d
+from utils.train_step import MultiLevelAdaptStep
 from dataset.gta5_dataset import GTA5DataSet
 from dataset.synthia_dataset import SynthiaDataSet
 from dataset.cityscapes_dataset import cityscapesDataSet
+from pytorchgo.dataloader import PackedSegDataset, PrefetchIterator, InfiniteSampler, to_cuda
 from pytorchgo.utils import logger
+from pytorchgo.utils.checkpoint import CheckpointManager
+from utils.validation import evaluate_cityscapes
 from tqdm import tqdm
 
 IMG_MEAN = np.array((104.00698793, 116.66876762, 122.67891434), dtype=np.float32)
@@ -147,24 +146,22 @@ def get_arguments():
                         help="choose gpu device.")
     parser.add_argument("--set", type=str, default=SET,
                         help="choose adaptation set.")
+    parser.add_argument("--packed_source", type=str, default=None,
+                        help="source dataset packed with pytorchgo.dataloader.packed, replaces --data_dir.")
+    parser.add_argument("--packed_target", type=str, default=None,
+                        help="target dataset packed with pytorchgo.dataloader.packed.")
+    parser.add_argument("--seg_resolution", type=str, default='input', choices=['input', 'output'],
+                        help="segmentation loss at input (upsampled predictions) or output (downsampled labels) resolution.")
+    parser.add_argument("--d_resolution", type=str, default='input', choices=['input', 'output'],
+                        help="feed the discriminators upsampled or native resolution predictions.")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the checkpoint in the log directory.")
     return parser.parse_args()
 
 
 args = get_arguments()
 
 
-def loss_calc(pred, label):
-    """
-    This function returns cross entropy loss for semantic segmentation
-    """
-    # out shape batch_size x channels x h x w -> batch_size x channels x h x w
-    # label shape h x w x 1 x batch_size  -> batch_size x 1 x h x w
-    label = Variable(label.long()).cuda()
-    criterion = CrossEntropy2d().cuda()
-
-    return criterion(pred, label)
-
-
 def lr_poly(base_lr, iter, max_iter, power):
     return base_lr * ((1 - float(iter) / max_iter) ** (power))
 
@@ -188,31 +185,12 @@ def proceed_test(model, input_size, quick_test = 1e10):
     logger.info("proceed test on cityscapes val set...")
     model.eval()
     model.cuda()
-    testloader = data.DataLoader(
-        cityscapesDataSet(crop_size=input_size, mean=IMG_MEAN, scale=False, mirror=False, set="val"),
-        batch_size=1, shuffle=False, pin_memory=True)
-
-    interp = nn.Upsample(size=(cityscape_image_size[1], cityscape_image_size[0]), mode='bilinear')
-
-    from tensorpack.utils.stats import MIoUStatistics
-    stat = MIoUStatistics(NUM_CLASSES)
+    stat = evaluate_cityscapes(model, input_size, IMG_MEAN, NUM_CLASSES, cityscape_image_size, quick_test=quick_test)
 
-    for index, batch in tqdm(enumerate(testloader), desc="validation"):
-        if index > quick_test: break
-
-        image, label, _, name = batch
-        image, label = Variable(image, volatile=True), Variable(label)
-
-        output1, output2 = model(image.cuda())#(1,19,129,257)
-        output = interp(output2).cpu().data[0].numpy()
-        output = output.transpose(1, 2, 0)
-        output = np.asarray(np.argmax(output, axis=2), dtype=np.uint8)
-        stat.feed(output, label.data.cpu().numpy().squeeze())
-
-    logger.info("tensorpack  class19 IoU: {}".format(stat.mIoU_beautify))
-    logger.info("tensorpack class19 mIoU: {}".format(stat.mIoU))
+    logger.info("class19 IoU: {}".format(stat.iou()))
+    logger.info("class19 mIoU: {}".format(stat.miou()))
     model.train()
-    return stat.mIoU
+    return stat.miou()
 
 
 
@@ -265,35 +243,36 @@ def main():
     model_D2.train()
     model_D2.cuda()
 
-    if SOURCE_DATA == "GTA5":
-        trainloader = data.DataLoader(
-            GTA5DataSet(args.data_dir, args.data_list, max_iters=args.num_steps * args.iter_size * args.batch_size,
+    # shuffled by InfiniteSampler, whose position is checkpointed for --resume
+    if args.packed_source is not None:
+        source_dataset = PackedSegDataset(args.packed_source, mean=IMG_MEAN, size=input_size,
+                                          max_iters=args.num_steps * args.iter_size * args.batch_size)
+    elif SOURCE_DATA == "GTA5":
+        source_dataset = GTA5DataSet(args.data_dir, args.data_list, max_iters=args.num_steps * args.iter_size * args.batch_size,
                         crop_size=input_size,
-                        scale=args.random_scale, mirror=args.random_mirror, mean=IMG_MEAN),
-            batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, pin_memory=True)
-        trainloader_iter = enumerate(trainloader)
+                        scale=args.random_scale, mirror=args.random_mirror, mean=IMG_MEAN)
     elif SOURCE_DATA == "SYNTHIA":
-        trainloader = data.DataLoader(
-            SynthiaDataSet(args.data_dir, args.data_list,LABEL_LIST_PATH, max_iters=args.num_steps * args.iter_size * args.batch_size,
+        source_dataset = SynthiaDataSet(args.data_dir, args.data_list,LABEL_LIST_PATH, max_iters=args.num_steps * args.iter_size * args.batch_size,
                         crop_size=input_size,
-                        scale=args.random_scale, mirror=args.random_mirror, mean=IMG_MEAN),
-            batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, pin_memory=True)
-        trainloader_iter = enumerate(trainloader)
+                        scale=args.random_scale, mirror=args.random_mirror, mean=IMG_MEAN)
     else:
         raise ValueError
+    trainloader = data.DataLoader(source_dataset, batch_size=args.batch_size, sampler=InfiniteSampler(source_dataset),
+                                  num_workers=args.num_workers, pin_memory=True)
 
 
 
-    targetloader = data.DataLoader(cityscapesDataSet(
-                                                     max_iters=args.num_steps * args.iter_size * args.batch_size,
-                                                     crop_size=input_size_target,
-                                                     scale=False, mirror=args.random_mirror, mean=IMG_MEAN,
-                                                     set=args.set),
-                                   batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
-                                   pin_memory=True)
-
-
-    targetloader_iter = enumerate(targetloader)
+    if args.packed_target is not None:
+        target_dataset = PackedSegDataset(args.packed_target, mean=IMG_MEAN, size=input_size_target,
+                                          max_iters=args.num_steps * args.iter_size * args.batch_size)
+    else:
+        target_dataset = cityscapesDataSet(max_iters=args.num_steps * args.iter_size * args.batch_size,
+                                           crop_size=input_size_target,
+                                           scale=False, mirror=args.random_mirror, mean=IMG_MEAN,
+                                           set=args.set)
+    targetloader = data.DataLoader(target_dataset,
+                                   batch_size=args.batch_size, sampler=InfiniteSampler(target_dataset),
+                                   num_workers=args.num_workers, pin_memory=True)
 
     # implement model.optim_parameters(args) to handle different models' lr setting
 
@@ -307,185 +286,75 @@ def main():
     optimizer_D2 = optim.Adam(model_D2.parameters(), lr=args.learning_rate_D, betas=(0.9, 0.99))
     optimizer_D2.zero_grad()
 
-    bce_loss = torch.nn.BCEWithLogitsLoss()
+    checkpoints = CheckpointManager(logger.get_logger_dir())
+    checkpoint_objects = {'model_state_dict': model, 'model_D1_state_dict': model_D1, 'model_D2_state_dict': model_D2,
+                          'optim_state_dict': optimizer, 'optim_D1_state_dict': optimizer_D1,
+                          'optim_D2_state_dict': optimizer_D2,
+                          'source_sampler': trainloader.sampler, 'target_sampler': targetloader.sampler}
+    start_iter = 0
+    best_mIoU = 0
+    if args.resume:
+        state = checkpoints.restore(checkpoint_objects)
+        start_iter = state['iteration'] + 1
+        best_mIoU = state['best_mean_iu']
+    # the learning rates follow i_iter, the data order continues after the batches already seen
+    for loader in [trainloader, targetloader]:
+        loader.sampler.skip(start_iter * args.iter_size * args.batch_size)
 
-    interp = nn.Upsample(size=(input_size[1], input_size[0]), mode='bilinear')
-    interp_target = nn.Upsample(size=(input_size_target[1], input_size_target[0]), mode='bilinear')
+    # (source batch, target batch) pairs prepared ahead, copied to the GPU on a side stream
+    data_iter = PrefetchIterator([trainloader, targetloader], transform=to_cuda, cuda_stream=True)
 
     # labels for adversarial training
     source_label = 0
     target_label = 1
 
-    best_mIoU = 0
-
-    for i_iter in tqdm(range(args.num_steps_stop),total=args.num_steps_stop, desc="training"):
-
-        loss_seg_value1 = 0
-        loss_adv_target_value1 = 0
-        loss_D_value1 = 0
+    train_step = MultiLevelAdaptStep(model, [model_D1, model_D2], optimizer, [optimizer_D1, optimizer_D2],
+                                     lambda_seg=(args.lambda_seg, 1.0),
+                                     lambda_adv=(args.lambda_adv_target1, args.lambda_adv_target2),
+                                     input_size=input_size, input_size_target=input_size_target,
+                                     iter_size=args.iter_size, seg_resolution=args.seg_resolution,
+                                     d_resolution=args.d_resolution,
+                                     source_label=source_label, target_label=target_label,
+                                     ignore_label=args.ignore_label)
 
-        loss_seg_value2 = 0
-        loss_adv_target_value2 = 0
-        loss_D_value2 = 0
+    for i_iter in tqdm(range(start_iter, args.num_steps_stop), initial=start_iter, total=args.num_steps_stop, desc="training"):
 
-        optimizer.zero_grad()
         lr = adjust_learning_rate(optimizer, i_iter)
-
-        optimizer_D1.zero_grad()
-        optimizer_D2.zero_grad()
         lr_D1 = adjust_learning_rate_D(optimizer_D1, i_iter)
         lr_D2 = adjust_learning_rate_D(optimizer_D2, i_iter)
 
-        for sub_i in range(args.iter_size):
-
-            ######################### train G
-
-            # don't accumulate grads in D
-            for param in model_D1.parameters():
-                param.requires_grad = False
-
-            for param in model_D2.parameters():
-                param.requires_grad = False
-
-            # train with source
-
-            _, batch = trainloader_iter.next()
-            images, labels, _, _ = batch
-            images = Variable(images).cuda()
-
-            pred1, pred2 = model(images)
-            pred1 = interp(pred1)
-            pred2 = interp(pred2)
-
-            loss_seg1 = loss_calc(pred1, labels)
-            loss_seg2 = loss_calc(pred2, labels)
-            loss = loss_seg2 + args.lambda_seg * loss_seg1
-
-            # proper normalization
-            loss = loss / args.iter_size
-            loss.backward()
-            loss_seg_value1 += loss_seg1.data.cpu().numpy()[0] / args.iter_size
-            loss_seg_value2 += loss_seg2.data.cpu().numpy()[0] / args.iter_size
-
-            # train with target
-
-            _, batch = targetloader_iter.next()
-            images, _, _ ,_ = batch
-            images = Variable(images).cuda()
-
-            pred_target1, pred_target2 = model(images)
-            pred_target1 = interp_target(pred_target1)
-            pred_target2 = interp_target(pred_target2)
-
-            D_out1 = model_D1(F.softmax(pred_target1))
-            D_out2 = model_D2(F.softmax(pred_target2))
-
-            loss_adv_target1 = bce_loss(D_out1,
-                                       Variable(torch.FloatTensor(D_out1.data.size()).fill_(source_label)).cuda(
-                                           ))
-
-            loss_adv_target2 = bce_loss(D_out2,
-                                        Variable(torch.FloatTensor(D_out2.data.size()).fill_(source_label)).cuda(
-                                            ))
-
-            loss = args.lambda_adv_target1 * loss_adv_target1 + args.lambda_adv_target2 * loss_adv_target2
-            loss = loss / args.iter_size
-            loss.backward()
-            loss_adv_target_value1 += loss_adv_target1.data.cpu().numpy()[0] / args.iter_size
-            loss_adv_target_value2 += loss_adv_target2.data.cpu().numpy()[0] / args.iter_size
-
-            ################################## train D
-
-            # bring back requires_grad
-            for param in model_D1.parameters():
-                param.requires_grad = True
-
-            for param in model_D2.parameters():
-                param.requires_grad = True
-
-            # train with source
-            pred1 = pred1.detach()
-            pred2 = pred2.detach()
-
-            D_out1 = model_D1(F.softmax(pred1))
-            D_out2 = model_D2(F.softmax(pred2))
-
-            loss_D1 = bce_loss(D_out1,
-                              Variable(torch.FloatTensor(D_out1.data.size()).fill_(source_label)).cuda())
-
-            loss_D2 = bce_loss(D_out2,
-                               Variable(torch.FloatTensor(D_out2.data.size()).fill_(source_label)).cuda())
-
-            loss_D1 = loss_D1 / args.iter_size / 2
-            loss_D2 = loss_D2 / args.iter_size / 2
-
-            loss_D1.backward()
-            loss_D2.backward()
-
-            loss_D_value1 += loss_D1.data.cpu().numpy()[0]
-            loss_D_value2 += loss_D2.data.cpu().numpy()[0]
-
-            # train with target
-            pred_target1 = pred_target1.detach()
-            pred_target2 = pred_target2.detach()
-
-            D_out1 = model_D1(F.softmax(pred_target1))
-            D_out2 = model_D2(F.softmax(pred_target2))
-
-            loss_D1 = bce_loss(D_out1,
-                              Variable(torch.FloatTensor(D_out1.data.size()).fill_(target_label)).cuda())
-
-            loss_D2 = bce_loss(D_out2,
-                               Variable(torch.FloatTensor(D_out2.data.size()).fill_(target_label)).cuda())
-
-            loss_D1 = loss_D1 / args.iter_size / 2
-            loss_D2 = loss_D2 / args.iter_size / 2
-
-            loss_D1.backward()
-            loss_D2.backward()
-
-            loss_D_value1 += loss_D1.data.cpu().numpy()[0]
-            loss_D_value2 += loss_D2.data.cpu().numpy()[0]
-
-        optimizer.step()
-        optimizer_D1.step()
-        optimizer_D2.step()
+        losses = train_step.step(data_iter)
+        loss_seg_value1, loss_seg_value2 = losses['loss_seg1'], losses['loss_seg2']
+        loss_adv_target_value1, loss_adv_target_value2 = losses['loss_adv1'], losses['loss_adv2']
+        loss_D_value1, loss_D_value2 = losses['loss_D1'], losses['loss_D2']
 
         if i_iter%100 ==0:
             logger.info(
                 'iter = {}/{},loss_seg1 = {:.3f} loss_seg2 = {:.3f} loss_adv1 = {:.3f}, loss_adv2 = {:.3f} loss_D1 = {:.3f} loss_D2 = {:.3f}, lr={:.7f}, lr_D={:.7f}, best miou16= {:.5f}'.format(
                     i_iter, args.num_steps_stop, loss_seg_value1, loss_seg_value2, loss_adv_target_value1,
                     loss_adv_target_value2, loss_D_value1, loss_D_value2, lr, lr_D1, best_mIoU))
+            logger.info("data: queue depth {queue_depth:.2f}, starved {starved:.2%}, wait {wait_ms:.1f}ms/iter".format(
+                **data_iter.stats()))
 
 
 
         if i_iter % args.save_pred_every == 0 and i_iter != 0:
             logger.info("saving snapshot.....")
             cur_miou16 = proceed_test(model, input_size)
-            is_best = True if best_mIoU < cur_miou16 else False
-            if is_best:
-                best_mIoU = cur_miou16
-            torch.save({
-                'iteration': i_iter,
-                'optim_state_dict': optimizer.state_dict(),
-                'optim_D1_state_dict': optimizer_D1.state_dict(),
-                'optim_D2_state_dict': optimizer_D2.state_dict(),
-                'model_state_dict': model.state_dict(),
-                'model_D1_state_dict': model_D1.state_dict(),
-                'model_D2_state_dict': model_D2.state_dict(),
-                'best_mean_iu': cur_miou16,
-            }, osp.join(logger.get_logger_dir(), 'checkpoint.pth.tar'))
-            if is_best:
-                import shutil
-                shutil.copy(osp.join(logger.get_logger_dir(), 'checkpoint.pth.tar'),
-                            osp.join(logger.get_logger_dir(), 'model_best.pth.tar'))
+            best_mIoU = max(best_mIoU, cur_miou16)
+            # written in the background, model_best.pth.tar follows the best miou16
+            checkpoints.save(checkpoint_objects, step=i_iter, metric=cur_miou16,
+                             iteration=i_iter, mean_iu=cur_miou16, best_mean_iu=best_mIoU)
 
 
         if i_iter >= args.num_steps_stop - 1:
             break
 
+    data_iter.close()
+    checkpoints.close()
+
 
 
 if __name__ == '__main__':
-    logger.auto_set_dir()
+    logger.auto_set_dir(action='k' if args.resume else None)
     main()
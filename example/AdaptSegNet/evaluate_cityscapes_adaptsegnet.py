@@ -18,6 +18,7 @@ from tqdm import tqdm
 
 import matplotlib.pyplot as plt
 import torch.nn as nn
+from pytorchgo.utils.vis import CITYSCAPES_PALETTE, palette_image
 IMG_MEAN = np.array((104.00698793,116.66876762,122.67891434), dtype=np.float32)
 
 DATA_DIRECTORY = './data/Cityscapes/data'
@@ -30,19 +31,17 @@ NUM_CLASSES = 19
 RESTORE_FROM = 'train_log/deeplabv2.synthia2cityscapes.single.8k/checkpoint.pth.tar'
 SET = 'val'
 
-palette = [128, 64, 128, 244, 35, 232, 70, 70, 70, 102, 102, 156, 190, 153, 153, 153, 153, 153, 250, 170, 30,
-           220, 220, 0, 107, 142, 35, 152, 251, 152, 70, 130, 180, 220, 20, 60, 255, 0, 0, 0, 0, 142, 0, 0, 70,
-           0, 60, 100, 0, 80, 100, 0, 0, 230, 119, 11, 32]
-zero_pad = 256 * 3 - len(palette)
-for i in range(zero_pad):
-    palette.append(0)
-
-
 def colorize_mask(mask):
     # mask: numpy array of the mask
-    new_mask = Image.fromarray(mask.astype(np.uint8)).convert('P')
-    new_mask.putpalette(palette)
-    return new_mask
+    return palette_image(mask, CITYSCAPES_PALETTE)
+
+
+def save_prediction(pred, save_dir, name, save_raw=False):
+    # runs on the writer pool: palette mapping and PNG encoding stay off the inference loop
+    name = name.split('/')[-1].split('.')[0]
+    colorize_mask(pred).save('%s/%s_color.png' % (save_dir, name))
+    if save_raw:
+        Image.fromarray(pred).save('%s/%s.png' % (save_dir, name))
 
 def get_arguments():
     """Parse all the arguments provided from the CLI.
@@ -67,6 +66,14 @@ def get_arguments():
                         help="choose evaluation set.")
     parser.add_argument("--save", type=str, default=SAVE_PATH,
                         help="Path to save result.")
+    parser.add_argument("--save-raw", action="store_true",
+                        help="Also save the raw trainId predictions.")
+    parser.add_argument("--num-writers", type=int, default=4,
+                        help="Number of workers encoding and saving the predictions.")
+    parser.add_argument("--max-pending", type=int, default=16,
+                        help="Maximum number of predictions waiting to be saved.")
+    parser.add_argument("--writer-processes", action="store_true",
+                        help="Save the predictions with a process pool instead of threads.")
     return parser.parse_args()
 
 
@@ -108,33 +115,31 @@ def main():
 
     interp = nn.Upsample(size=(cityscape_image_size[1], cityscape_image_size[0]), mode='bilinear')
 
-    from tensorpack.utils.stats import MIoUStatistics
-    stat = MIoUStatistics(NUM_CLASSES)
+    from pytorchgo.utils.metrics import ConfusionMatrix
+    from pytorchgo.utils.async_writer import AsyncWriter
+    stat = ConfusionMatrix(NUM_CLASSES)
+    writer = AsyncWriter(num_workers=args.num_writers, max_pending=args.max_pending,
+                         use_processes=args.writer_processes)
 
     for index, batch in tqdm(enumerate(testloader)):
         image,label, _, name = batch
-        image, label = Variable(image, volatile=True), Variable(label)
+        image = Variable(image, volatile=True)
 
         #output2 = model(image.cuda(gpu0))
         output1, output2 = model(image.cuda(gpu0))
-        output = interp(output2).cpu().data[0].numpy()
-
-        output = output.transpose(1,2,0)
-        output = np.asarray(np.argmax(output, axis=2), dtype=np.uint8)
-
-        output_col = colorize_mask(output)
-
-
-        name = name[0].split('/')[-1]
-        output_col.save('%s/%s_color.png' % (args.save, name.split('.')[0]))
-
-        stat.feed(output, label.data.cpu().numpy().squeeze())
-
-    print("tensorpack IoU: {}".format(stat.mIoU_beautify))
-    print("tensorpack class16 IoU: {}".format(np.sum(stat.IoU)/16))
-    print("tensorpack mIoU: {}".format(stat.mIoU))
-    print("tensorpack mean_accuracy: {}".format(stat.mean_accuracy))
-    print("tensorpack accuracy: {}".format(stat.accuracy))
+        # argmax on the GPU, only the uint8 prediction is copied back
+        pred = interp(output2).data.max(1)[1]
+        stat.update(pred, label.cuda(gpu0))
+        writer.put(save_prediction, pred[0].byte().cpu().numpy(), args.save, name[0], args.save_raw)
+
+    writer.close()
+
+    iou = stat.iou()
+    print("IoU: {}".format(iou))
+    print("class16 IoU: {}".format(np.sum(iou)/16))
+    print("mIoU: {}".format(stat.miou()))
+    print("mean_accuracy: {}".format(stat.mean_accuracy()))
+    print("accuracy: {}".format(stat.pixel_accuracy()))
 
 
 if __name__ == '__main__':
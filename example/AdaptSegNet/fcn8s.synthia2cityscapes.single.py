@@ -21,7 +21,9 @@ from utils.loss import CrossEntropy2d
 from dataset.gta5_dataset import GTA5DataSet
 from dataset.synthia_dataset import SynthiaDataSet
 from dataset.cityscapes_dataset import cityscapesDataSet
+from pytorchgo.dataloader import PackedSegDataset
 from pytorchgo.utils import logger
+from utils.validation import evaluate_cityscapes
 from tqdm import tqdm
 from pytorchgo.utils.pytorch_utils import model_summary,optimizer_summary
 
@@ -150,6 +152,10 @@ def get_arguments():
                         help="choose gpu device.")
     parser.add_argument("--set", type=str, default=SET,
                         help="choose adaptation set.")
+    parser.add_argument("--packed_source", type=str, default=None,
+                        help="source dataset packed with pytorchgo.dataloader.packed, replaces --data_dir.")
+    parser.add_argument("--packed_target", type=str, default=None,
+                        help="target dataset packed with pytorchgo.dataloader.packed.")
     return parser.parse_args()
 
 
@@ -191,29 +197,10 @@ def proceed_test(model, input_size, quick_test = 1e10):
     logger.info("proceed test on cityscapes val set...")
     model.eval()
     model.cuda()
-    testloader = data.DataLoader(
-        cityscapesDataSet(crop_size=input_size, mean=IMG_MEAN, scale=False, mirror=False, set="val"),
-        batch_size=1, shuffle=False, pin_memory=True)
+    stat = evaluate_cityscapes(model, input_size, IMG_MEAN, NUM_CLASSES, cityscape_image_size, quick_test=quick_test)
 
-    interp = nn.Upsample(size=(cityscape_image_size[1], cityscape_image_size[0]), mode='bilinear')
-
-    from tensorpack.utils.stats import MIoUStatistics
-    stat = MIoUStatistics(NUM_CLASSES)
-
-    for index, batch in tqdm(enumerate(testloader), desc="validation"):
-        if index > quick_test: break
-
-        image, label, _, name = batch
-        image, label = Variable(image, volatile=True), Variable(label)
-
-        output2 = model(image.cuda())#(1,19,129,257)
-        output = interp(output2).cpu().data[0].numpy()
-        output = output.transpose(1, 2, 0)
-        output = np.asarray(np.argmax(output, axis=2), dtype=np.uint8)
-        stat.feed(output, label.data.cpu().numpy().squeeze())
-
-    miou16 = np.sum(stat.IoU) / 16
-    print("tensorpack class16 IoU with: {}".format(miou16))
+    miou16 = np.sum(stat.iou()) / 16
+    print("class16 IoU with: {}".format(miou16))
     model.train()
     return miou16
 
@@ -284,7 +271,13 @@ def main():
     model_D2.train()
     model_D2.cuda()
 
-    if SOURCE_DATA == "GTA5":
+    if args.packed_source is not None:
+        trainloader = data.DataLoader(
+            PackedSegDataset(args.packed_source, mean=IMG_MEAN, size=input_size,
+                             max_iters=args.num_steps * args.iter_size * args.batch_size),
+            batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, pin_memory=True)
+        trainloader_iter = enumerate(trainloader)
+    elif SOURCE_DATA == "GTA5":
         trainloader = data.DataLoader(
             GTA5DataSet(args.data_dir, args.data_list, max_iters=args.num_steps * args.iter_size * args.batch_size,
                         crop_size=input_size,
@@ -303,11 +296,15 @@ def main():
 
 
 
-    targetloader = data.DataLoader(cityscapesDataSet(
-                                                     max_iters=args.num_steps * args.iter_size * args.batch_size,
-                                                     crop_size=input_size_target,
-                                                     scale=False, mirror=args.random_mirror, mean=IMG_MEAN,
-                                                     set=args.set),
+    if args.packed_target is not None:
+        target_dataset = PackedSegDataset(args.packed_target, mean=IMG_MEAN, size=input_size_target,
+                                          max_iters=args.num_steps * args.iter_size * args.batch_size)
+    else:
+        target_dataset = cityscapesDataSet(max_iters=args.num_steps * args.iter_size * args.batch_size,
+                                           crop_size=input_size_target,
+                                           scale=False, mirror=args.random_mirror, mean=IMG_MEAN,
+                                           set=args.set)
+    targetloader = data.DataLoader(target_dataset,
                                    batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
                                    pin_memory=True)
 
@@ -0,0 +1,135 @@
+import collections
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+from pytorchgo.augmentation import resize_labels
+
+from .loss import CrossEntropy2d
+
+
+class MultiLevelAdaptStep(object):
+    """
+    One AdaptSegNet iteration: segmentation loss on the source batch, adversarial loss
+    on the target batch, then the per-level discriminators on the detached generator
+    outputs, with gradients accumulated over ``iter_size`` batch pairs.
+
+    seg_resolution: 'input' upsamples the predictions to the label size for the
+        segmentation loss (the original recipe), 'output' nearest-downsamples the labels
+        to the prediction size instead.
+    d_resolution: 'input' upsamples the predictions before the discriminators,
+        'output' feeds them at native output resolution.
+    """
+
+    def __init__(self, model, discriminators, optimizer, optimizers_D, lambda_seg, lambda_adv,
+                 input_size, input_size_target, iter_size=1, seg_resolution='input', d_resolution='input',
+                 source_label=0, target_label=1, ignore_label=255):
+        assert seg_resolution in ['input', 'output'] and d_resolution in ['input', 'output']
+        self.model = model
+        self.discriminators = discriminators
+        self.optimizer = optimizer
+        self.optimizers_D = optimizers_D
+        self.lambda_seg = lambda_seg
+        self.lambda_adv = lambda_adv
+        self.iter_size = iter_size
+        self.seg_resolution = seg_resolution
+        self.d_resolution = d_resolution
+        self.source_label = source_label
+        self.target_label = target_label
+
+        self.interp = nn.Upsample(size=(input_size[1], input_size[0]), mode='bilinear')
+        self.interp_target = nn.Upsample(size=(input_size_target[1], input_size_target[0]), mode='bilinear')
+        self.seg_criterion = CrossEntropy2d(ignore_label=ignore_label).cuda()
+        self.bce_loss = torch.nn.BCEWithLogitsLoss()
+        self._domain_labels = {}
+
+    def domain_label(self, like, value):
+        key = (tuple(like.size()), value)
+        if key not in self._domain_labels:
+            self._domain_labels[key] = Variable(torch.FloatTensor(*key[0]).fill_(value).cuda())
+        return self._domain_labels[key]
+
+    def _set_requires_grad(self, requires_grad):
+        for model_D in self.discriminators:
+            for param in model_D.parameters():
+                param.requires_grad = requires_grad
+
+    def _forward(self, images):
+        preds = self.model(Variable(images).cuda())
+        return preds if isinstance(preds, tuple) else (preds,)
+
+    def _seg_loss(self, pred, labels):
+        if self.seg_resolution == 'output':
+            labels = resize_labels(labels, (pred.size(3), pred.size(2)))
+        return self.seg_criterion(pred, Variable(labels.long()).cuda())
+
+    def _for_d(self, pred, interp, upsampled=None):
+        """Detached discriminator input, the upsampled prediction is reused when it exists."""
+        if self.d_resolution == 'output':
+            return pred.detach()
+        if upsampled is not None:
+            return upsampled.detach()
+        return interp(pred.detach())
+
+    def step(self, data_iter):
+        """
+        Args:
+            data_iter: iterator over (source_batch, target_batch) pairs, batches being
+                (images, labels, ...), e.g. a :class:`pytorchgo.dataloader.PrefetchIterator`.
+
+        Returns:
+            dict of loss values, summed over the accumulated batches.
+        """
+        values = collections.defaultdict(float)
+        self.optimizer.zero_grad()
+        for optimizer_D in self.optimizers_D:
+            optimizer_D.zero_grad()
+
+        for sub_i in range(self.iter_size):
+            # G, don't accumulate grads in D
+            self._set_requires_grad(False)
+
+            source_batch, target_batch = next(data_iter)
+
+            # train with source
+            images, labels = source_batch[:2]
+            preds = self._forward(images)
+            upsampled = [self.interp(p) for p in preds] if self.seg_resolution == 'input' else [None] * len(preds)
+            seg_losses = [self._seg_loss(u if u is not None else p, labels) for p, u in zip(preds, upsampled)]
+            loss = sum(w * l for w, l in zip(self.lambda_seg, seg_losses)) / self.iter_size
+            loss.backward()
+            source_d = [self._for_d(p, self.interp, u) for p, u in zip(preds, upsampled)]
+            del preds, upsampled, loss
+
+            # train with target
+            images = target_batch[0]
+            preds = self._forward(images)
+            if self.d_resolution == 'input':
+                preds = [self.interp_target(p) for p in preds]
+            adv_losses = []
+            for model_D, pred in zip(self.discriminators, preds):
+                D_out = model_D(F.softmax(pred))
+                adv_losses.append(self.bce_loss(D_out, self.domain_label(D_out, self.source_label)))
+            loss = sum(w * l for w, l in zip(self.lambda_adv, adv_losses)) / self.iter_size
+            loss.backward()
+            target_d = [p.detach() for p in preds]
+            del preds, loss
+
+            # D, on the detached generator outputs, one backward for all levels and both domains
+            self._set_requires_grad(True)
+            d_losses = []
+            for model_D, src, tgt in zip(self.discriminators, source_d, target_d):
+                D_src, D_tgt = model_D(F.softmax(src)), model_D(F.softmax(tgt))
+                d_losses.append((self.bce_loss(D_src, self.domain_label(D_src, self.source_label)) +
+                                 self.bce_loss(D_tgt, self.domain_label(D_tgt, self.target_label))) / self.iter_size / 2)
+            sum(d_losses).backward()
+
+            for level in range(len(d_losses)):
+                values['loss_seg{}'.format(level + 1)] += seg_losses[level].data[0] / self.iter_size
+                values['loss_adv{}'.format(level + 1)] += adv_losses[level].data[0] / self.iter_size
+                values['loss_D{}'.format(level + 1)] += d_losses[level].data[0]
+
+        self.optimizer.step()
+        for optimizer_D in self.optimizers_D:
+            optimizer_D.step()
+        return values
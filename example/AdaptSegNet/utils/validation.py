@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import torch.nn as nn
+from torch.autograd import Variable
+from torch.utils import data
+from tqdm import tqdm
+from pytorchgo.utils import logger
+from pytorchgo.utils.metrics import ConfusionMatrix
+
+from dataset.cityscapes_dataset import cityscapesDataSet
+
+QUICK_VAL_LIST = './dataset/cityscapes_list/quick_val_{}.txt'
+
+
+def quick_val_indices(dataset_size, num_images, seed=1234):
+    """
+    A fixed random subset of the val set, written to QUICK_VAL_LIST on first use
+    so that quick validations of every run and every script see the same images.
+    """
+    path = QUICK_VAL_LIST.format(num_images)
+    if os.path.isfile(path):
+        return [int(i) for i in open(path)]
+    indices = sorted(np.random.RandomState(seed).choice(dataset_size, num_images, replace=False).tolist())
+    with open(path, 'w') as f:
+        f.write('\n'.join(str(i) for i in indices) + '\n')
+    logger.info("quick validation subset of {} images written to {}".format(num_images, path))
+    return indices
+
+
+def evaluate_cityscapes(model, input_size, mean, num_classes, label_size, quick_test=None,
+                        batch_size=2, num_workers=4):
+    """
+    Evaluate on Cityscapes val: batched inference, upsampling to label size and argmax on
+    the GPU, confusion matrix accumulated on the GPU.
+
+    Args:
+        input_size: (w, h) the images are resized to.
+        label_size: (w, h) of the labels, predictions are upsampled to it.
+        quick_test(int): only evaluate a fixed subset of this many images.
+
+    Returns:
+        ConfusionMatrix
+    """
+    dataset = cityscapesDataSet(crop_size=input_size, mean=mean, scale=False, mirror=False, set="val")
+    sampler = None
+    if quick_test is not None and quick_test < len(dataset):
+        sampler = quick_val_indices(len(dataset), int(quick_test))
+    testloader = data.DataLoader(dataset, batch_size=batch_size, shuffle=False, sampler=sampler,
+                                 num_workers=num_workers, pin_memory=True)
+
+    interp = nn.Upsample(size=(label_size[1], label_size[0]), mode='bilinear')
+    stat = ConfusionMatrix(num_classes)
+
+    for image, label, _, _ in tqdm(testloader, desc="validation"):
+        output = model(Variable(image, volatile=True).cuda())
+        if isinstance(output, tuple):
+            output = output[-1]
+        pred = interp(output).data.max(1)[1]
+        stat.update(pred, label.cuda())
+    return stat
@@ -13,6 +13,7 @@ from os.path import join
 import cv2
 from datetime import datetime
 import copy
+from pytorchgo.dataloader import get_label_mapper
 
 def fast_hist(a, b, n):
     k = (a >= 0) & (a < n)
@@ -22,10 +23,7 @@ def per_class_iu(hist):
     return np.diag(hist) / (hist.sum(1) + hist.sum(0) - np.diag(hist))
 
 def label_mapping(input, mapping):
-    output = np.copy(input)
-    for ind in range(len(mapping)):
-        output[input == mapping[ind][0]] = mapping[ind][1]
-    return np.array(output, dtype=np.int64)
+    return get_label_mapper(mapping)(input)
 
 def compute_mIoU(pred_imgs, gt_imgs, json_path):
     """
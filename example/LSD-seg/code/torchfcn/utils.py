@@ -2,6 +2,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+from torch.autograd import Variable
 
 
 def _fast_hist(label_true, label_pred, n_class):
@@ -78,6 +79,76 @@ def cross_entropy2d(input, target, class_num=19, weight=None, size_average=True)
 
     return loss
 
+class DiscriminatorInputs(object):
+    """
+    Batched inputs and targets of the ACGAN-style discriminator, built on the device of the batch:
+        - images: the mean subtracted BGR network input brought back to [0, 1], which is
+          what transform_forD(img, sz, resize=False, mean_add=True) does to one image
+        - class labels: the segmentation labels downsampled (nearest) to the classifier output
+        - domain labels: constant maps 0-3 (source real, source fake, target real, target fake),
+          cached per output shape
+    """
+
+    def __init__(self, mean_bgr):
+        self.mean = torch.from_numpy(np.asarray(mean_bgr, dtype=np.float32)).view(1, 3, 1, 1)
+        self._indices = {}
+        self._domain_labels = {}
+
+    @staticmethod
+    def _device(tensor):
+        return tensor.get_device() if tensor.is_cuda else -1
+
+    @staticmethod
+    def _to(tensor, device):
+        return tensor.cuda(device) if device >= 0 else tensor
+
+    def images(self, data):
+        """
+        Args:
+            data: N x 3 x H x W tensor, mean subtracted BGR
+        Returns:
+            N x 3 x H x W tensor in [0, 1], BGR
+        """
+        device = self._device(data)
+        if self._device(self.mean) != device:
+            self.mean = self._to(self.mean.cpu(), device)
+        return (data + self.mean) / 255.0
+
+    def labels(self, labels, size):
+        """
+        Args:
+            labels: N x H x W LongTensor
+            size: (h, w) of the classifier output
+        Returns:
+            N x h x w LongTensor, nearest pixel centers (same as PIL for integer ratios)
+        """
+        _, h, w = labels.size()
+        device = self._device(labels)
+        key = (h, w, size[0], size[1], device)
+        if key not in self._indices:
+            rows = np.minimum(((np.arange(size[0]) + 0.5) * h / size[0]).astype(np.int64), h - 1)
+            cols = np.minimum(((np.arange(size[1]) + 0.5) * w / size[1]).astype(np.int64), w - 1)
+            self._indices[key] = (self._to(torch.from_numpy(rows), device),
+                                  self._to(torch.from_numpy(cols), device))
+        rows, cols = self._indices[key]
+        return labels.index_select(1, rows).index_select(2, cols)
+
+    def domain_labels(self, output):
+        """
+        Args:
+            output: N x 4 x h x w domain scores of D (tensor)
+        Returns:
+            list of the 4 N x h x w domain label Variables: source real, source fake,
+            target real and target fake
+        """
+        n, _, h, w = output.size()
+        key = (n, h, w, self._device(output))
+        if key not in self._domain_labels:
+            self._domain_labels[key] = [Variable(self._to(torch.LongTensor(n, h, w).fill_(k), key[3]))
+                                        for k in range(4)]
+        return self._domain_labels[key]
+
+
 def step_scheduler(optimizer, epoch):
     """
     Function to perform step learning rate decay
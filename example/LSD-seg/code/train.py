@@ -7,6 +7,7 @@ import torchfcn, datetime
 from util_fns import get_parameters
 from util_fns import weights_init
 from pytorchgo.utils import logger
+from pytorchgo.utils.metrics import RunningConfusionMatrix
 
 class_num = 19
 
@@ -181,7 +182,9 @@ class Trainer_LSD(object):
 
         self.lrd = 0.0002
         self.image_size_forD = tuple(image_size)
+        self.inputs_forD = torchfcn.utils.DiscriminatorInputs(self.train_loader.dataset.mean_bgr)
         self.n_class = len(self.train_loader.dataset.class_names)
+        self.train_metrics = RunningConfusionMatrix(self.n_class, interval=10, stride=4)
 
         self.timestamp_start = \
             datetime.datetime.now(pytz.timezone('Asia/Tokyo'))
@@ -324,29 +327,19 @@ class Trainer_LSD(object):
 
             data_source, labels_source = datas
             data_target, __ = datat
-            data_source_forD = torch.zeros((data_source.size()[0], 3, self.image_size_forD[1], self.image_size_forD[0]))
-            data_target_forD = torch.zeros((data_target.size()[0], 3, self.image_size_forD[1], self.image_size_forD[0]))
-
-            # We pass the unnormalized data to the discriminator. So, the GANs produce images without data normalization
-            for i in range(data_source.size()[0]):
-                data_source_forD[i] = self.train_loader.dataset.transform_forD(data_source[i], self.image_size_forD,
-                                                                               resize=False, mean_add=True)
-                data_target_forD[i] = self.train_loader.dataset.transform_forD(data_target[i], self.image_size_forD,
-                                                                               resize=False, mean_add=True)
-
             iteration = batch_idx + self.epoch * min(len(self.train_loader), len(self.target_loader))
             self.iteration = iteration
 
             if self.cuda:
                 data_source, labels_source = data_source.cuda(), labels_source.cuda()
                 data_target = data_target.cuda()
-                data_source_forD = data_source_forD.cuda()
-                data_target_forD = data_target_forD.cuda()
+
+            # We pass the unnormalized data to the discriminator. So, the GANs produce images without data normalization
+            data_source_forD = Variable(self.inputs_forD.images(data_source))
+            data_target_forD = Variable(self.inputs_forD.images(data_target))
 
             data_source, labels_source = Variable(data_source), Variable(labels_source)
             data_target = Variable(data_target)
-            data_source_forD = Variable(data_source_forD)
-            data_target_forD = Variable(data_target_forD)
 
             # Source domain
             score, fc7, pool4, pool3 = self.model(data_source)
@@ -365,26 +358,11 @@ class Trainer_LSD(object):
             # (2) Domain lables for classifying source real, source fake, target real and target fake
 
             # Labels for classifier branch
-            Dout_sz = outD_src_real_s.size()
-            label_forD = torch.zeros(
-                (outD_tgt_fake_c.size()[0], outD_tgt_fake_c.size()[2], outD_tgt_fake_c.size()[3]))  # [1,40,80]
-            for i in range(label_forD.size()[0]):
-                label_forD[i] = self.train_loader.dataset.transform_label_forD(labels_source[i], (
-                outD_tgt_fake_c.size()[2], outD_tgt_fake_c.size()[3]))
-            if self.cuda:
-                label_forD = label_forD.cuda()
-            label_forD = Variable(label_forD.long())
+            label_forD = Variable(self.inputs_forD.labels(labels_source.data, outD_tgt_fake_c.size()[2:]))
 
             # Domain labels
-            domain_labels_src_real = torch.LongTensor(Dout_sz[0], Dout_sz[2], Dout_sz[3]).zero_()
-            domain_labels_src_fake = torch.LongTensor(Dout_sz[0], Dout_sz[2], Dout_sz[3]).zero_() + 1
-            domain_labels_tgt_real = torch.LongTensor(Dout_sz[0], Dout_sz[2], Dout_sz[3]).zero_() + 2
-            domain_labels_tgt_fake = torch.LongTensor(Dout_sz[0], Dout_sz[2], Dout_sz[3]).zero_() + 3
-
-            domain_labels_src_real = Variable(domain_labels_src_real.cuda())
-            domain_labels_src_fake = Variable(domain_labels_src_fake.cuda())
-            domain_labels_tgt_real = Variable(domain_labels_tgt_real.cuda())
-            domain_labels_tgt_fake = Variable(domain_labels_tgt_fake.cuda())
+            domain_labels_src_real, domain_labels_src_fake, domain_labels_tgt_real, domain_labels_tgt_fake = \
+                self.inputs_forD.domain_labels(outD_src_real_s.data)
 
             # Updates.
             # There are three sets of updates - (1) Discriminator, (2) Generator and (3) F network
@@ -436,19 +414,13 @@ class Trainer_LSD(object):
             if np.isnan(float(lossF.data[0])):
                 raise ValueError('lossF is nan while training')
 
-            # Computing metrics for logging
-            metrics = []
-            lbl_pred = score.data.max(1)[1].cpu().numpy()[:, :, :]
-            lbl_true = labels_source.data.cpu().numpy()
-            for lt, lp in zip(lbl_true, lbl_pred):
-                acc, acc_cls, mean_iu, fwavacc = \
-                    torchfcn.utils.label_accuracy_score(
-                        [lt], [lp], n_class=self.n_class)
-                metrics.append((acc, acc_cls, mean_iu, fwavacc))
-            metrics = np.mean(metrics, axis=0)
+            # Computing metrics for logging, on a subsample of the iterations and pixels, read at the log interval
+            self.train_metrics.update(score.data.max(1)[1], labels_source.data)
+            metrics = [''] * 4
 
             # Logging
             if self.iteration % 100 == 0:
+                metrics = list(self.train_metrics.scores())
                 logger.info(
                     "epoch: {}/{}, iteration:{}, lossF:{}, mIoU :{}".format(self.epoch, self.max_epoch, self.iteration,
                                                                             lossF.data[0], metrics[2]))
@@ -457,7 +429,7 @@ class Trainer_LSD(object):
                     datetime.datetime.now(pytz.timezone('Asia/Tokyo')) -
                     self.timestamp_start).total_seconds()
                 log = [self.epoch, self.iteration] + [lossF.data[0]] + \
-                      metrics.tolist() + [''] * 5 + [elapsed_time]
+                      metrics + [''] * 5 + [elapsed_time]
                 log = map(str, log)
                 f.write(','.join(log) + '\n')
 
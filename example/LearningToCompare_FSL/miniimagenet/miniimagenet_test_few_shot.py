@@ -12,6 +12,7 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.optim.lr_scheduler import StepLR
 import numpy as np
+import random
 import task_generator_test as tg
 import os
 import math
@@ -30,6 +31,10 @@ parser.add_argument("-t","--test_episode", type = int, default = 600)
 parser.add_argument("-l","--learning_rate", type = float, default = 0.001)
 parser.add_argument("-g","--gpu",type=int, default=0)
 parser.add_argument("-u","--hidden_unit",type=int,default=10)
+parser.add_argument("-c","--feature_cache",type=int,default=0,
+                    help="encode every test image once and sample the test episodes from the cached features")
+parser.add_argument("--cache_batch",type=int,default=25,
+                    help="images per encoder forward when building the feature cache")
 args = parser.parse_args()
 
 
@@ -44,6 +49,8 @@ TEST_EPISODE = args.test_episode
 LEARNING_RATE = args.learning_rate
 GPU = args.gpu
 HIDDEN_UNIT = args.hidden_unit
+FEATURE_CACHE = args.feature_cache
+CACHE_BATCH = args.cache_batch
 
 def mean_confidence_interval(data, confidence=0.95):
     a = 1.0*np.array(data)
@@ -108,6 +115,23 @@ class RelationNetwork(nn.Module):
         out = F.sigmoid(self.fc2(out))
         return out
 
+    def forward_pairs(self,sample_features,test_features):
+        # Same as forward() on every (test, sample) concatenated pair, without building the pairs:
+        # the first conv is linear, so each half of its weight is applied once to its own features
+        # and the results are broadcast-added into a (test x sample) grid.
+        conv = self.layer1[0]
+        sample_out = F.conv2d(sample_features,conv.weight[:,:FEATURE_DIM].contiguous(),conv.bias)
+        test_out = F.conv2d(test_features,conv.weight[:,FEATURE_DIM:].contiguous())
+        out = test_out.unsqueeze(1) + sample_out.unsqueeze(0)
+        out = out.view(-1,out.size(2),out.size(3),out.size(4))
+        for layer in list(self.layer1)[1:]:
+            out = layer(out)
+        out = self.layer2(out)
+        out = out.view(out.size(0),-1)
+        out = F.relu(self.fc1(out))
+        out = F.sigmoid(self.fc2(out))
+        return out.view(test_features.size(0),sample_features.size(0))
+
 def weights_init(m):
     classname = m.__class__.__name__
     if classname.find('Conv') != -1:
@@ -123,6 +147,85 @@ def weights_init(m):
         m.weight.data.normal_(0, 0.01)
         m.bias.data = torch.ones(m.bias.data.size())
 
+def encode_folders(feature_encoder,folders):
+    # Every test image is decoded and encoded exactly once. BN keeps using batch statistics
+    # as in the episodic test, over randomly mixed batches of CACHE_BATCH images.
+    images,offsets = tg.load_mini_imagenet_images(folders)
+    features = None
+    order = torch.randperm(len(images))
+    for i in range(0,len(images),CACHE_BATCH):
+        index = order[i:i+CACHE_BATCH]
+        batch = tg.normalize_images(images[index.numpy()])
+        out = feature_encoder(Variable(batch,volatile=True).cuda(GPU)).data
+        if features is None:
+            features = out.new(len(images),*out.size()[1:])
+        features.index_copy_(0,index.cuda(GPU),out)
+    return features,offsets
+
+def test_cached(relation_network,features,offsets):
+    accuracies = []
+    num_per_class = 5
+    for i in range(TEST_EPISODE):
+        classes = random.sample(range(len(offsets)-1),CLASS_NUM)
+        index = np.stack([offsets[c] + np.random.permutation(offsets[c+1]-offsets[c])[:SAMPLE_NUM_PER_CLASS+15]
+                          for c in classes]) # CLASS_NUM x (SAMPLE_NUM_PER_CLASS+15)
+        sample_index = torch.from_numpy(index[:,:SAMPLE_NUM_PER_CLASS].ravel()).cuda(GPU)
+        sample_features = features.index_select(0,sample_index)
+        sample_features = sample_features.view(CLASS_NUM,SAMPLE_NUM_PER_CLASS,FEATURE_DIM,19,19).sum(1)
+
+        # queries in the same order and batches as the data loader: num_per_class of every class at a time
+        test_index = index[:,SAMPLE_NUM_PER_CLASS:].T.ravel()
+        test_labels = np.tile(np.arange(CLASS_NUM),15)
+        total_rewards = 0
+        for j in range(0,len(test_index),num_per_class*CLASS_NUM):
+            test_features = features.index_select(0,torch.from_numpy(test_index[j:j+num_per_class*CLASS_NUM]).cuda(GPU))
+            relations = relation_network.forward_pairs(Variable(sample_features,volatile=True),
+                                                       Variable(test_features,volatile=True))
+            _,predict_labels = torch.max(relations.data,1)
+            total_rewards += np.sum(predict_labels.cpu().numpy() == test_labels[j:j+num_per_class*CLASS_NUM])
+
+        accuracies.append(total_rewards/1.0/CLASS_NUM/15)
+    return accuracies
+
+def test_episodic(feature_encoder,relation_network,metatest_folders):
+    accuracies = []
+    for i in range(TEST_EPISODE):
+        total_rewards = 0
+        task = tg.MiniImagenetTask(metatest_folders,CLASS_NUM,SAMPLE_NUM_PER_CLASS,15)
+        sample_dataloader = tg.get_mini_imagenet_data_loader(task,num_per_class=SAMPLE_NUM_PER_CLASS,split="train",shuffle=False)
+        num_per_class = 5
+        test_dataloader = tg.get_mini_imagenet_data_loader(task,num_per_class=num_per_class,split="test",shuffle=False)
+
+        sample_images,sample_labels = sample_dataloader.__iter__().next()
+        for test_images,test_labels in test_dataloader:
+            batch_size = test_labels.shape[0]
+            # calculate features
+            sample_features = feature_encoder(Variable(sample_images).cuda(GPU)) # 5x64
+            sample_features = sample_features.view(CLASS_NUM,SAMPLE_NUM_PER_CLASS,FEATURE_DIM,19,19)
+            sample_features = torch.sum(sample_features,1).squeeze(1)
+            test_features = feature_encoder(Variable(test_images).cuda(GPU)) # 20x64
+
+            # calculate relations
+            # each batch sample link to every samples to calculate relations
+            # to form a 100x128 matrix for relation network
+            sample_features_ext = sample_features.unsqueeze(0).repeat(batch_size,1,1,1,1)
+
+            test_features_ext = test_features.unsqueeze(0).repeat(1*CLASS_NUM,1,1,1,1)
+            test_features_ext = torch.transpose(test_features_ext,0,1)
+            relation_pairs = torch.cat((sample_features_ext,test_features_ext),2).view(-1,FEATURE_DIM*2,19,19)
+            relations = relation_network(relation_pairs).view(-1,CLASS_NUM)
+
+            _,predict_labels = torch.max(relations.data,1)
+
+            rewards = [1 if predict_labels[j]==test_labels[j] else 0 for j in range(batch_size)]
+
+            total_rewards += np.sum(rewards)
+
+
+        accuracy = total_rewards/1.0/CLASS_NUM/15
+        accuracies.append(accuracy)
+    return accuracies
+
 def main():
     # Step 1: init data folders
     print("init data folders")
@@ -151,6 +254,10 @@ def main():
         relation_network.load_state_dict(torch.load(str("./models/miniimagenet_relation_network_"+ str(CLASS_NUM) +"way_" + str(SAMPLE_NUM_PER_CLASS) +"shot.pkl")))
         print("load relation network success")
 
+    if FEATURE_CACHE:
+        print("building feature cache")
+        features,offsets = encode_folders(feature_encoder,metatest_folders)
+
     total_accuracy = 0.0
     for episode in range(EPISODE):
 
@@ -158,42 +265,10 @@ def main():
             # test
             print("Testing...")
 
-            accuracies = []
-            for i in range(TEST_EPISODE):
-                total_rewards = 0
-                task = tg.MiniImagenetTask(metatest_folders,CLASS_NUM,SAMPLE_NUM_PER_CLASS,15)
-                sample_dataloader = tg.get_mini_imagenet_data_loader(task,num_per_class=SAMPLE_NUM_PER_CLASS,split="train",shuffle=False)
-                num_per_class = 5
-                test_dataloader = tg.get_mini_imagenet_data_loader(task,num_per_class=num_per_class,split="test",shuffle=False)
-
-                sample_images,sample_labels = sample_dataloader.__iter__().next()
-                for test_images,test_labels in test_dataloader:
-                    batch_size = test_labels.shape[0]
-                    # calculate features
-                    sample_features = feature_encoder(Variable(sample_images).cuda(GPU)) # 5x64
-                    sample_features = sample_features.view(CLASS_NUM,SAMPLE_NUM_PER_CLASS,FEATURE_DIM,19,19)
-                    sample_features = torch.sum(sample_features,1).squeeze(1)
-                    test_features = feature_encoder(Variable(test_images).cuda(GPU)) # 20x64
-
-                    # calculate relations
-                    # each batch sample link to every samples to calculate relations
-                    # to form a 100x128 matrix for relation network
-                    sample_features_ext = sample_features.unsqueeze(0).repeat(batch_size,1,1,1,1)
-
-                    test_features_ext = test_features.unsqueeze(0).repeat(1*CLASS_NUM,1,1,1,1)
-                    test_features_ext = torch.transpose(test_features_ext,0,1)
-                    relation_pairs = torch.cat((sample_features_ext,test_features_ext),2).view(-1,FEATURE_DIM*2,19,19)
-                    relations = relation_network(relation_pairs).view(-1,CLASS_NUM)
-
-                    _,predict_labels = torch.max(relations.data,1)
-
-                    rewards = [1 if predict_labels[j]==test_labels[j] else 0 for j in range(batch_size)]
-
-                    total_rewards += np.sum(rewards)
-
-
-                accuracy = total_rewards/1.0/CLASS_NUM/15
-                accuracies.append(accuracy)
+            if FEATURE_CACHE:
+                accuracies = test_cached(relation_network,features,offsets)
+            else:
+                accuracies = test_episodic(feature_encoder,relation_network,metatest_folders)
 
             test_accuracy,h = mean_confidence_interval(accuracies)
 
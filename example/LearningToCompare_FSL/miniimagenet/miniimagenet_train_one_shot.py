@@ -128,6 +128,8 @@ def main():
     print("init data folders")
     # init character folders for dataset construction
     metatrain_folders,metatest_folders = tg.mini_imagenet_folders()
+    # decode every meta-training image once, episodes are gathered from memory
+    metatrain_pool = tg.image_pool(metatrain_folders)
 
     # Step 2: init neural networks
     print("init neural networks")
@@ -164,15 +166,10 @@ def main():
         relation_network_scheduler.step(episode)
 
         # init dataset
-        # sample_dataloader is to obtain previous samples for compare
-        # batch_dataloader is to batch samples for training
-        task = tg.MiniImagenetTask(metatrain_folders,CLASS_NUM,SAMPLE_NUM_PER_CLASS,BATCH_NUM_PER_CLASS)
-        sample_dataloader = tg.get_mini_imagenet_data_loader(task,num_per_class=SAMPLE_NUM_PER_CLASS,split="train",shuffle=False)
-        batch_dataloader = tg.get_mini_imagenet_data_loader(task,num_per_class=BATCH_NUM_PER_CLASS,split="test",shuffle=True)
+        # samples are the support set to compare with, batches are the queries for training
 
         # sample datas
-        samples,sample_labels = sample_dataloader.__iter__().next()
-        batches,batch_labels = batch_dataloader.__iter__().next()
+        samples,sample_labels,batches,batch_labels = metatrain_pool.sample_task(CLASS_NUM,SAMPLE_NUM_PER_CLASS,BATCH_NUM_PER_CLASS)
 
         # calculate features
         sample_features = feature_encoder(Variable(samples).cuda(GPU)) # 5x64*5*5
@@ -9,6 +9,7 @@ import os
 from PIL import Image
 import matplotlib.pyplot as plt
 import numpy as np
+from pytorchgo.dataloader import ImagePool
 from torch.utils.data.sampler import Sampler
 
 def imshow(img):
@@ -75,6 +76,17 @@ class MiniImagenetTask(object):
         return os.path.join(*sample.split('/')[:-1])
 
 
+def _load_image(path):
+    image = Image.open(path)
+    image = image.convert('RGB')
+    return np.array(image, dtype=np.uint8).reshape(image.size[1], image.size[0], -1)
+
+
+def image_pool(folders, num_workers=None):
+    ''' In-memory pool of the mini-Imagenet images of ``folders``, normalized as in get_mini_imagenet_data_loader '''
+    return ImagePool(folders, _load_image, mean=0.92206, std=0.08426, num_workers=num_workers)
+
+
 class FewShotDataset(Dataset):
 
     def __init__(self, task, split='train', transform=None, target_transform=None):
@@ -173,3 +173,22 @@ def get_mini_imagenet_data_loader(task, num_per_class=1, split='train',shuffle =
 
     loader = DataLoader(dataset, batch_size=num_per_class*task.num_classes, sampler=sampler)
     return loader
+
+
+def load_mini_imagenet_images(folders):
+    ''' Decodes every image of the class folders once.
+        Returns uint8 images [N,84,84,3] grouped by class, and offsets such that
+        images[offsets[c]:offsets[c+1]] belong to folders[c] '''
+    images = []
+    offsets = [0]
+    for c in folders:
+        for x in sorted(os.listdir(c)):
+            images.append(np.array(Image.open(os.path.join(c, x)).convert('RGB'), dtype=np.uint8))
+        offsets.append(len(images))
+    return np.stack(images), np.array(offsets)
+
+
+def normalize_images(images):
+    ''' uint8 [N,H,W,3] -> FloatTensor [N,3,H,W], same as ToTensor + Normalize of the data loader '''
+    images = torch.from_numpy(images).permute(0, 3, 1, 2).contiguous().float().div_(255)
+    return images.sub_(0.92206).div_(0.08426)
@@ -120,6 +120,8 @@ def main():
     print("init data folders")
     # init character folders for dataset construction
     metatrain_character_folders,metatest_character_folders = tg.omniglot_character_folders()
+    # decode every meta-training image once, episodes are gathered from memory
+    metatrain_pool = tg.image_pool(metatrain_character_folders)
 
     # Step 2: init neural networks
     print("init neural networks")
@@ -156,17 +158,11 @@ def main():
         relation_network_scheduler.step(episode)
 
         # init dataset
-        # sample_dataloader is to obtain previous samples for compare
-        # batch_dataloader is to batch samples for training
+        # samples are the support set to compare with, batches are the queries for training
         degrees = random.choice([0,90,180,270])
-        task = tg.OmniglotTask(metatrain_character_folders,CLASS_NUM,SAMPLE_NUM_PER_CLASS,BATCH_NUM_PER_CLASS)
-        sample_dataloader = tg.get_data_loader(task,num_per_class=SAMPLE_NUM_PER_CLASS,split="train",shuffle=False,rotation=degrees)
-        batch_dataloader = tg.get_data_loader(task,num_per_class=BATCH_NUM_PER_CLASS,split="test",shuffle=True,rotation=degrees)
-
 
         # sample datas
-        samples,sample_labels = sample_dataloader.__iter__().next()
-        batches,batch_labels = batch_dataloader.__iter__().next()
+        samples,sample_labels,batches,batch_labels = metatrain_pool.sample_task(CLASS_NUM,SAMPLE_NUM_PER_CLASS,BATCH_NUM_PER_CLASS,rotation=degrees)
 
         # calculate features
         sample_features = feature_encoder(Variable(samples).cuda(GPU)) # 5x64*5*5
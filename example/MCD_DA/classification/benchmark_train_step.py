@@ -0,0 +1,87 @@
+from __future__ import print_function
+import argparse
+import copy
+import time
+import torch
+import torch.optim as optim
+from torch.autograd import Variable
+from model.svhn2mnist import Feature, Predictor
+from utils.train_step import MCDStep
+
+# Iterations/sec of the MCD step on SVHN->MNIST shaped batches for num_k = 1..4: the
+# original recipe (G run 3 + num_k times per iteration) against MCDStep.
+#   python benchmark_train_step.py --batch_size 128 --iterations 10
+parser = argparse.ArgumentParser(description='MCD training step benchmark')
+parser.add_argument('--batch_size', type=int, default=128)
+parser.add_argument('--iterations', type=int, default=10)
+parser.add_argument('--cuda', action='store_true', default=False)
+args = parser.parse_args()
+
+
+class ReferenceStep(MCDStep):
+    """The step as Solver.train used to run it."""
+
+    def step(self, img_s, label_s, img_t):
+        self.reset_grad()
+        feat_s = self.G(img_s)
+        loss_s1, loss_s2 = self._source_loss(feat_s, label_s)
+        (loss_s1 + loss_s2).backward()
+        self.opt_g.step()
+        self.opt_c1.step()
+        self.opt_c2.step()
+        self.reset_grad()
+
+        feat_s = self.G(img_s)
+        feat_t = self.G(img_t)
+        loss_s1, loss_s2 = self._source_loss(feat_s, label_s)
+        loss_dis = self.discrepancy(self.C1(feat_t), self.C2(feat_t))
+        (loss_s1 + loss_s2 - loss_dis).backward()
+        self.opt_c1.step()
+        self.opt_c2.step()
+        self.reset_grad()
+
+        for i in range(self.num_k):
+            feat_t = self.G(img_t)
+            loss_dis = self.discrepancy(self.C1(feat_t), self.C2(feat_t))
+            loss_dis.backward()
+            self.opt_g.step()
+            self.reset_grad()
+        return {'loss_s1': loss_s1, 'loss_s2': loss_s2, 'loss_dis': loss_dis}
+
+
+def benchmark(step_class, num_k, models, batch, **kwargs):
+    G, C1, C2 = [copy.deepcopy(m) for m in models]
+    opt_g = optim.Adam(G.parameters(), lr=0.0002, weight_decay=0.0005)
+    opt_c1 = optim.Adam(C1.parameters(), lr=0.0002, weight_decay=0.0005)
+    opt_c2 = optim.Adam(C2.parameters(), lr=0.0002, weight_decay=0.0005)
+    train_step = step_class(G, C1, C2, opt_g, opt_c1, opt_c2, num_k=num_k, **kwargs)
+
+    train_step.step(*batch)  # warm up
+    if args.cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.iterations):
+        train_step.step(*batch)
+    if args.cuda:
+        torch.cuda.synchronize()
+    return args.iterations / (time.time() - start)
+
+
+if __name__ == '__main__':
+    torch.manual_seed(1)
+    models = [Feature(), Predictor(), Predictor()]
+    img_s = torch.randn(args.batch_size, 3, 32, 32)
+    label_s = torch.LongTensor(args.batch_size).random_(0, 10)
+    img_t = torch.randn(args.batch_size, 3, 32, 32)
+    if args.cuda:
+        models = [m.cuda() for m in models]
+        img_s, label_s, img_t = img_s.cuda(), label_s.cuda(), img_t.cuda()
+    batch = Variable(img_s), Variable(label_s), Variable(img_t)
+
+    for num_k in range(1, 5):
+        reference = benchmark(ReferenceStep, num_k, models, batch)
+        recompute = benchmark(MCDStep, num_k, models, batch, reuse_source_features=False)
+        shared = benchmark(MCDStep, num_k, models, batch)
+        print('num_k={}: original {:.2f} it/s, MCDStep {:.2f} it/s ({:.2f}x), '
+              'MCDStep with --recompute_source_feat {:.2f} it/s ({:.2f}x)'.format(
+                  num_k, reference, shared, shared / reference, recompute, recompute / reference))
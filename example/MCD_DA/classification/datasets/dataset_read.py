@@ -1,7 +1,10 @@
+import os
 import sys
+import numpy as np
 
 sys.path.append('../loader')
 from unaligned_data_loader import UnalignedDataLoader
+from tensor_data_loader import TensorDataLoader, to_uint8_images, to_label_array
 from svhn import load_svhn
 from mnist import load_mnist
 from usps import load_usps
@@ -30,7 +33,39 @@ def return_dataset(data, scale=False, usps=False, all_use='no'):
     return train_image, train_label, test_image, test_label
 
 
-def dataset_read(source, target, batch_size, scale=False, all_use='no'):
+CACHE_DIR = '../data/cache'
+
+
+def return_tensor_dataset(data, pixels, scale=False, usps=False, all_use='no'):
+    """
+    return_dataset as uint8 3 x pixels x pixels arrays and int64 labels. svhn and mnist,
+    read from .mat files, are converted once into CACHE_DIR. The other datasets draw a
+    random split in every run and are converted in memory.
+    """
+    if data not in ['svhn', 'mnist']:
+        train_image, train_label, test_image, test_label = return_dataset(data, scale=scale, usps=usps, all_use=all_use)
+        return to_uint8_images(train_image, pixels), to_label_array(train_label), \
+               to_uint8_images(test_image, pixels), to_label_array(test_label)
+
+    path = os.path.join(CACHE_DIR, '{}_{}{}.npz'.format(data, pixels, '_scale' if data == 'mnist' and scale else ''))
+    if not os.path.isfile(path):
+        # the full training set, the usps subset is drawn below in every run
+        train_image, train_label, test_image, test_label = return_dataset(data, scale=scale)
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        np.savez(path + '.tmp.npz', train_image=to_uint8_images(train_image, pixels),
+                 train_label=to_label_array(train_label), test_image=to_uint8_images(test_image, pixels),
+                 test_label=to_label_array(test_label))
+        os.rename(path + '.tmp.npz', path)
+    arrays = np.load(path)
+    train_image, train_label = arrays['train_image'], arrays['train_label']
+    if data == 'mnist' and usps and all_use != 'yes':
+        inds = np.random.permutation(train_image.shape[0])[:2000]
+        train_image, train_label = train_image[inds], train_label[inds]
+    return train_image, train_label, arrays['test_image'], arrays['test_label']
+
+
+def dataset_read(source, target, batch_size, scale=False, all_use='no', backend='pil'):
     S = {}
     S_test = {}
     T = {}
@@ -39,10 +74,12 @@ def dataset_read(source, target, batch_size, scale=False, all_use='no'):
     if source == 'usps' or target == 'usps':
         usps = True
 
-    train_source, s_label_train, test_source, s_label_test = return_dataset(source, scale=scale,
-                                                                            usps=usps, all_use=all_use)
-    train_target, t_label_train, test_target, t_label_test = return_dataset(target, scale=scale, usps=usps,
-                                                                            all_use=all_use)
+    pixels = 40 if source == 'synth' else 28 if source == 'usps' or target == 'usps' else 32
+    read = return_dataset if backend == 'pil' else lambda data, **kwargs: return_tensor_dataset(data, pixels, **kwargs)
+    train_source, s_label_train, test_source, s_label_test = read(source, scale=scale,
+                                                                  usps=usps, all_use=all_use)
+    train_target, t_label_train, test_target, t_label_test = read(target, scale=scale, usps=usps,
+                                                                  all_use=all_use)
 
 
     S['imgs'] = train_source
@@ -55,11 +92,11 @@ def dataset_read(source, target, batch_size, scale=False, all_use='no'):
     S_test['labels'] = t_label_test
     T_test['imgs'] = test_target
     T_test['labels'] = t_label_test
-    scale = 40 if source == 'synth' else 28 if source == 'usps' or target == 'usps' else 32
-    train_loader = UnalignedDataLoader()
-    train_loader.initialize(S, T, batch_size, batch_size, scale=scale)
+    loader_class = UnalignedDataLoader if backend == 'pil' else TensorDataLoader
+    train_loader = loader_class()
+    train_loader.initialize(S, T, batch_size, batch_size, scale=pixels)
     dataset = train_loader.load_data()
-    test_loader = UnalignedDataLoader()
-    test_loader.initialize(S_test, T_test, batch_size, batch_size, scale=scale)
+    test_loader = loader_class()
+    test_loader.initialize(S_test, T_test, batch_size, batch_size, scale=pixels)
     dataset_test = test_loader.load_data()
     return dataset, dataset_test
@@ -0,0 +1,108 @@
+import numpy as np
+import torch
+from PIL import Image
+
+
+def to_uint8_images(images, scale):
+    """
+    N x C x H x W arrays as the PIL pipeline of Dataset sees them: cast to uint8,
+    grayscale repeated to 3 channels, resized to scale x scale.
+    """
+    images = np.uint8(np.asarray(images))
+    if images.shape[1] == 1:
+        images = np.repeat(images, 3, axis=1)
+    if images.shape[2] != scale or images.shape[3] != scale:
+        images = np.stack([np.asarray(Image.fromarray(im.transpose((1, 2, 0))).resize((scale, scale), Image.BILINEAR))
+                           for im in images]).transpose((0, 3, 1, 2))
+    return np.ascontiguousarray(images)
+
+
+def to_label_array(labels):
+    return np.asarray(labels).reshape(-1).astype(np.int64)
+
+
+class TensorDomain(object):
+    """
+    One domain held as a uint8 image tensor and a label tensor, on the GPU with ``cuda``.
+    Batches are gathered by index and normalized like ToTensor + Normalize(0.5, 0.5).
+    """
+
+    def __init__(self, images, labels, batch_size, shuffle=True, cuda=True):
+        self.images = torch.from_numpy(images) if isinstance(images, np.ndarray) else images
+        self.labels = torch.from_numpy(labels) if isinstance(labels, np.ndarray) else labels
+        if cuda:
+            self.images, self.labels = self.images.cuda(), self.labels.cuda()
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return self.images.size(0)
+
+    def __iter__(self):
+        n = len(self)
+        order = torch.randperm(n) if self.shuffle else torch.arange(0, n).long()
+        if self.images.is_cuda:
+            order = order.cuda(self.images.get_device())
+        for start in range(0, n, self.batch_size):
+            index = order[start:start + self.batch_size]
+            images = self.images.index_select(0, index).float().div_(255).sub_(0.5).div_(0.5)
+            yield images, self.labels.index_select(0, index)
+
+
+class PairedTensorData(object):
+    """Same pairing as PairedData: a pass ends once both domains have been exhausted."""
+
+    def __init__(self, domain_A, domain_B):
+        self.domain_A = domain_A
+        self.domain_B = domain_B
+
+    def __iter__(self):
+        self.stop_A = False
+        self.stop_B = False
+        self.iter_A = iter(self.domain_A)
+        self.iter_B = iter(self.domain_B)
+        return self
+
+    def __next__(self):
+        try:
+            A, A_labels = next(self.iter_A)
+        except StopIteration:
+            self.stop_A = True
+            self.iter_A = iter(self.domain_A)
+            A, A_labels = next(self.iter_A)
+        try:
+            B, B_labels = next(self.iter_B)
+        except StopIteration:
+            self.stop_B = True
+            self.iter_B = iter(self.domain_B)
+            B, B_labels = next(self.iter_B)
+        if self.stop_A and self.stop_B:
+            raise StopIteration()
+        return {'S': A, 'S_label': A_labels,
+                'T': B, 'T_label': B_labels}
+
+    next = __next__
+
+
+class TensorDataLoader(object):
+    """Drop-in for UnalignedDataLoader with the datasets resident as tensors."""
+
+    def initialize(self, source, target, batch_size1, batch_size2, scale=32, cuda=True):
+        self.dataset_s = TensorDomain(to_uint8_images(source['imgs'], scale), to_label_array(source['labels']),
+                                      batch_size1, cuda=cuda)
+        if target['imgs'] is source['imgs'] and target['labels'] is source['labels']:
+            # the test loader pairs the target test set with itself, keep one copy
+            self.dataset_t = TensorDomain(self.dataset_s.images, self.dataset_s.labels, batch_size2, cuda=cuda)
+        else:
+            self.dataset_t = TensorDomain(to_uint8_images(target['imgs'], scale), to_label_array(target['labels']),
+                                          batch_size2, cuda=cuda)
+        self.paired_data = PairedTensorData(self.dataset_s, self.dataset_t)
+
+    def name(self):
+        return 'TensorDataLoader'
+
+    def load_data(self):
+        return self.paired_data
+
+    def __len__(self):
+        return max(len(self.dataset_s), len(self.dataset_t))
@@ -12,6 +12,8 @@ parser.add_argument('--batch-size', type=int, default=128, metavar='N',
                     help='input batch size for training (default: 64)')
 parser.add_argument('--checkpoint_dir', type=str, default='checkpoint', metavar='N',
                     help='source only or not')
+parser.add_argument('--data_backend', type=str, default='tensor', choices=['tensor', 'pil'],
+                    help='tensor: datasets resident on the GPU as uint8 tensors, pil: per-sample PIL transforms')
 parser.add_argument('--eval_only', action='store_true', default=False,
                     help='evaluation only option')
 parser.add_argument('--lr', type=float, default=0.0002, metavar='LR',
@@ -24,6 +26,8 @@ parser.add_argument('--num_k', type=int, default=4, metavar='N',
                     help='hyper paremeter for generator update')
 parser.add_argument('--one_step', action='store_true', default=False,
                     help='one step training with gradient reversal layer')
+parser.add_argument('--recompute_source_feat', action='store_true', default=False,
+                    help='recompute the source features for the classifier update instead of reusing them')
 parser.add_argument('--optimizer', type=str, default='adam', metavar='N', help='which optimizer')
 parser.add_argument('--resume_epoch', type=int, default=100, metavar='N',
                     help='epoch to resume')
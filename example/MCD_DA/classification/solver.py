@@ -6,6 +6,7 @@ import torch.optim as optim
 from torch.autograd import Variable
 from model.build_gen import *
 from datasets.dataset_read import dataset_read
+from utils.train_step import MCDStep
 
 
 # Training settings
@@ -27,7 +28,7 @@ class Solver(object):
             self.scale = False
         print('dataset loading')
         self.datasets, self.dataset_test = dataset_read(source, target, self.batch_size, scale=self.scale,
-                                                        all_use=self.all_use)
+                                                        all_use=self.all_use, backend=args.data_backend)
         print('load finished!')
         self.G = Generator(source=source, target=target)
         self.C1 = Classifier(source=source, target=target)
@@ -48,6 +49,8 @@ class Solver(object):
 
         self.set_optimizer(which_opt=optimizer, lr=learning_rate)
         self.lr = learning_rate
+        self.train_step = MCDStep(self.G, self.C1, self.C2, self.opt_g, self.opt_c1, self.opt_c2, num_k=self.num_k,
+                                  reuse_source_features=not args.recompute_source_feat)
 
     def set_optimizer(self, which_opt='momentum', lr=0.001, momentum=0.9):
         if which_opt == 'momentum':
@@ -83,7 +86,6 @@ class Solver(object):
         return torch.mean(torch.abs(F.softmax(out1) - F.softmax(out2)))
 
     def train(self, epoch, record_file=None):
-        criterion = nn.CrossEntropyLoss().cuda()
         self.G.train()
         self.C1.train()
         self.C2.train()
@@ -95,54 +97,12 @@ class Solver(object):
             label_s = data['S_label']
             if img_s.size()[0] < self.batch_size or img_t.size()[0] < self.batch_size:
                 break
-            img_s = img_s.cuda()
-            img_t = img_t.cuda()
-            imgs = Variable(torch.cat((img_s, \
-                                       img_t), 0))
+            img_s = Variable(img_s.cuda())
+            img_t = Variable(img_t.cuda())
             label_s = Variable(label_s.long().cuda())
 
-            img_s = Variable(img_s)
-            img_t = Variable(img_t)
-            self.reset_grad()
-            feat_s = self.G(img_s)
-            output_s1 = self.C1(feat_s)
-            output_s2 = self.C2(feat_s)
-
-            loss_s1 = criterion(output_s1, label_s)
-            loss_s2 = criterion(output_s2, label_s)
-            loss_s = loss_s1 + loss_s2
-            loss_s.backward()
-            self.opt_g.step()
-            self.opt_c1.step()
-            self.opt_c2.step()
-            self.reset_grad()
-
-            feat_s = self.G(img_s)
-            output_s1 = self.C1(feat_s)
-            output_s2 = self.C2(feat_s)
-            feat_t = self.G(img_t)
-            output_t1 = self.C1(feat_t)
-            output_t2 = self.C2(feat_t)
-
-            loss_s1 = criterion(output_s1, label_s)
-            loss_s2 = criterion(output_s2, label_s)
-            loss_s = loss_s1 + loss_s2
-            loss_dis = self.discrepancy(output_t1, output_t2)
-            loss = loss_s - loss_dis # because reversed_gradient!!!!
-            loss.backward()
-            self.opt_c1.step()
-            self.opt_c2.step()
-            self.reset_grad()
-
-            for i in xrange(self.num_k):
-                #
-                feat_t = self.G(img_t)
-                output_t1 = self.C1(feat_t)
-                output_t2 = self.C2(feat_t)
-                loss_dis = self.discrepancy(output_t1, output_t2)
-                loss_dis.backward()
-                self.opt_g.step()
-                self.reset_grad()
+            losses = self.train_step.step(img_s, label_s, img_t)
+            loss_s1, loss_s2, loss_dis = losses['loss_s1'], losses['loss_s2'], losses['loss_dis']
             if batch_idx > 500:
                 return batch_idx
 
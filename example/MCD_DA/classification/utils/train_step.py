@@ -0,0 +1,89 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+
+class MCDStep(object):
+    """
+    One Maximum Classifier Discrepancy iteration:
+      A. G, C1 and C2 on the source classification loss,
+      B. C1 and C2 on the source loss minus the target discrepancy, G fixed,
+      C. G on the target discrepancy, ``num_k`` times.
+
+    Generator work shared between the steps:
+      - G doesn't change during B, so the target features of B are computed with a graph
+        and reused by the first C update instead of running G again.
+      - B never backpropagates into G: its source features come detached from step A when
+        ``reuse_source_features`` (one G update old), or from a gradient-free forward.
+    Source and target are not concatenated through G: G has BatchNorm, and a joint batch
+    would mix the per-domain batch statistics the recipe trains with.
+    """
+
+    def __init__(self, G, C1, C2, opt_g, opt_c1, opt_c2, num_k=4, reuse_source_features=True):
+        self.G = G
+        self.C1 = C1
+        self.C2 = C2
+        self.opt_g = opt_g
+        self.opt_c1 = opt_c1
+        self.opt_c2 = opt_c2
+        self.num_k = num_k
+        self.reuse_source_features = reuse_source_features
+        self.criterion = nn.CrossEntropyLoss()
+
+    def reset_grad(self):
+        self.opt_g.zero_grad()
+        self.opt_c1.zero_grad()
+        self.opt_c2.zero_grad()
+
+    def discrepancy(self, out1, out2):
+        return torch.mean(torch.abs(F.softmax(out1) - F.softmax(out2)))
+
+    def _source_loss(self, feat_s, label_s):
+        loss_s1 = self.criterion(self.C1(feat_s), label_s)
+        loss_s2 = self.criterion(self.C2(feat_s), label_s)
+        return loss_s1, loss_s2
+
+    def step(self, img_s, label_s, img_t):
+        """
+        Args:
+            img_s, label_s, img_t: Variables on the device of the models.
+
+        Returns:
+            dict: the source losses of step B and the discrepancy of the last G update.
+        """
+        self.reset_grad()
+
+        # A
+        feat_s = self.G(img_s)
+        loss_s1, loss_s2 = self._source_loss(feat_s, label_s)
+        (loss_s1 + loss_s2).backward()
+        self.opt_g.step()
+        self.opt_c1.step()
+        self.opt_c2.step()
+        self.reset_grad()
+
+        # B
+        if self.reuse_source_features:
+            feat_s = feat_s.detach()
+        else:
+            feat_s = Variable(self.G(Variable(img_s.data, volatile=True)).data)
+        feat_t = self.G(img_t)
+        loss_s1, loss_s2 = self._source_loss(feat_s, label_s)
+        feat_t_b = feat_t.detach()
+        loss_dis = self.discrepancy(self.C1(feat_t_b), self.C2(feat_t_b))
+        (loss_s1 + loss_s2 - loss_dis).backward()
+        self.opt_c1.step()
+        self.opt_c2.step()
+        self.reset_grad()
+
+        # C, the first update reuses the target features of B
+        for i in range(self.num_k):
+            if i > 0:
+                feat_t = self.G(img_t)
+            loss_dis = self.discrepancy(self.C1(feat_t), self.C2(feat_t))
+            loss_dis.backward()
+            self.opt_g.step()
+            self.reset_grad()
+
+        return {'loss_s1': loss_s1, 'loss_s2': loss_s2, 'loss_dis': loss_dis}
@@ -5,6 +5,7 @@ from pprint import pprint
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from torch.autograd import Variable
 from torch.utils import data
@@ -38,6 +39,18 @@ parser.add_argument("--add_bg_loss", action="store_true",
                     help='whether you add background loss or not')
 parser.add_argument("--saves_prob", action="store_true",
                     help='whether you save probability tensors')
+parser.add_argument("--prob_dtype", type=str, default="float16", choices=["float16", "uint8"],
+                    help='storage of the saved probabilities: uint8 is half the size, quantized to 1/255 (see README)')
+parser.add_argument("--prob_topk", type=int, default=None,
+                    help='only save the k most probable classes of each pixel')
+parser.add_argument("--prob_verify", action="store_true",
+                    help='report the error of the saved probabilities')
+parser.add_argument("--crf", action="store_true",
+                    help='also refine the predictions with DenseCRF (tools/crf.py) on a process pool')
+parser.add_argument("--crf_workers", type=int, default=None,
+                    help='crf processes, all the cpus by default')
+parser.add_argument("--crf_rgb", action="store_true",
+                    help='use the raw image in the crf pairwise term')
 parser.add_argument("--use_f2", action="store_true",
                     help='whether you use f2')
 parser.add_argument('--use_ae', action="store_true",
@@ -127,6 +140,15 @@ if torch.cuda.is_available():
 
 from tensorpack.utils.stats import MIoUStatistics
 stat = MIoUStatistics(nb_classes=16,ignore_label=255)
+n_pred_class = args.n_class if args.add_bg_loss else args.n_class - 1
+if args.saves_prob:
+    from pytorchgo.utils.prob_store import ProbStore
+    prob_store = ProbStore(os.path.join(base_outdir, "prob"), dtype=args.prob_dtype, topk=args.prob_topk,
+                           verify=args.prob_verify)
+if args.crf:
+    from tools.crf import CRFPool
+    crf = CRFPool(os.path.join(base_outdir, "label_crf"), num_workers=args.crf_workers,
+                  outimg_shape=test_img_shape, n_class=n_pred_class)
 for index, (origin_imgs, labels, paths) in tqdm(enumerate(target_loader)):
     path = paths[0]
     #if index > 10: break
@@ -143,16 +165,15 @@ for index, (origin_imgs, labels, paths) in tqdm(enumerate(target_loader)):
 
     if args.saves_prob:
         # Save probability tensors
-        prob_outdir = os.path.join(base_outdir, "prob")
-        mkdir_if_not_exist(prob_outdir)
-        prob_outfn = os.path.join(prob_outdir, path.split('/')[-1].replace('png', 'npy'))
-        np.save(prob_outfn, outputs[0].data.cpu().numpy())
+        prob_store.save(path.split('/')[-1].replace('.png', ''), F.softmax(outputs).data[0].cpu().numpy())
 
     # Save predicted pixel labels(pngs)
-    if args.add_bg_loss:
-        pred = outputs[0, :args.n_class].data.max(0)[1].cpu()
-    else:
-        pred = outputs[0, :args.n_class - 1].data.max(0)[1].cpu()
+    pred = outputs[0, :n_pred_class].data.max(0)[1].cpu()
+
+    if args.crf:
+        # softmax and float16 on the gpu, the workers only get the probabilities
+        crf.put(path.split('/')[-1].replace('.png', ''), F.softmax(outputs).data[0].half().cpu().numpy(),
+                path if args.crf_rgb else None)
 
     img = Image.fromarray(np.uint8(pred.numpy()))
     img = img.resize(test_img_shape, Image.NEAREST)
@@ -185,4 +206,8 @@ for index, (origin_imgs, labels, paths) in tqdm(enumerate(target_loader)):
     vis_fn = os.path.join(vis_outdir, path.split('/')[-1])
     img.save(vis_fn)
 
+if args.saves_prob:
+    prob_store.summary()
+if args.crf:
+    crf.close()
 print("=>mIoU :{}".format(stat.mIoU))
@@ -14,6 +14,7 @@ from PIL import Image
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 from tqdm import tqdm
+from pytorchgo.dataloader import get_label_mapper
 
 import glob
 
@@ -52,10 +53,7 @@ def save_colorful_images(prediction, filename, palette, postfix='_color.png'):
 
 
 def label_mapping(input, mapping):
-    output = np.copy(input)
-    for ind in range(len(mapping)):
-        output[input == mapping[ind][0]] = mapping[ind][1]
-    return np.array(output, dtype=np.int64)
+    return get_label_mapper(mapping)(input)
 
 
 def plot_confusion_matrix(cm, classes,
@@ -4,6 +4,7 @@ import os
 from pprint import pprint
 import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from torch.autograd import Variable
 from torch.utils import data
@@ -26,6 +27,12 @@ parser.add_argument('--test_img_shape', default=(2048, 1024), nargs=2,
                     help="W H, FOR Valid(2048, 1024) Test(1280, 720)")
 parser.add_argument("---saves_prob", action="store_true",
                     help='whether you save probability tensors')
+parser.add_argument("--prob_dtype", type=str, default="float16", choices=["float16", "uint8"],
+                    help='storage of the saved probabilities: uint8 is half the size, quantized to 1/255 (see README)')
+parser.add_argument("--prob_topk", type=int, default=None,
+                    help='only save the k most probable classes of each pixel')
+parser.add_argument("--prob_verify", action="store_true",
+                    help='report the error of the saved probabilities')
 
 args = parser.parse_args()
 args = add_additional_params_to_args(args)
@@ -82,6 +89,10 @@ if torch.cuda.is_available():
     model.cuda()
 
 model.eval()
+if args.saves_prob:
+    from pytorchgo.utils.prob_store import ProbStore
+    prob_store = ProbStore(os.path.join(base_outdir, "prob"), dtype=args.prob_dtype, topk=args.prob_topk,
+                           verify=args.prob_verify)
 for index, (imgs, labels, paths) in tqdm(enumerate(target_loader)):
     path = paths[0]
     imgs = Variable(imgs)
@@ -95,10 +106,7 @@ for index, (imgs, labels, paths) in tqdm(enumerate(target_loader)):
 
     if args.saves_prob:
         # Save probability tensors
-        prob_outdir = os.path.join(base_outdir, "prob")
-        mkdir_if_not_exist(prob_outdir)
-        prob_outfn = os.path.join(prob_outdir, path.split('/')[-1].replace('png', 'npy'))
-        np.save(prob_outfn, preds[0].data.cpu().numpy())
+        prob_store.save(path.split('/')[-1].replace('.png', ''), F.softmax(preds).data[0].cpu().numpy())
 
     # Save predicted pixel labels(pngs)
     if train_args.add_bg_loss:
@@ -131,3 +139,6 @@ for index, (imgs, labels, paths) in tqdm(enumerate(target_loader)):
     mkdir_if_not_exist(vis_outdir)
     vis_fn = os.path.join(vis_outdir, path.split('/')[-1])
     img.save(vis_fn)
+
+if args.saves_prob:
+    prob_store.summary()
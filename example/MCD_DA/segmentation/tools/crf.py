@@ -1,13 +1,16 @@
 # coding: utf-8
 import argparse
+import ctypes
+import multiprocessing
 import os
+import time
 
 import numpy as np
 import pydensecrf.densecrf as dcrf
-import scipy.misc as m
 from PIL import Image
 from tqdm import tqdm
 
+from pytorchgo.utils.async_writer import BoundedPool
 from util import mkdir_if_not_exist
 
 
@@ -61,16 +64,143 @@ def dense_crf(probs, img=None, n_iters=10,
 
 
 def softmax(x):
-    """Compute softmax values for each sets of scores in x."""
-    e_x = np.exp(x - np.max(x))
-    return e_x / e_x.sum(axis=0)  # only difference
+    """Compute softmax values over the class axis of C x H x W scores."""
+    e_x = np.exp(x - np.max(x, axis=0, keepdims=True))
+    return e_x / e_x.sum(axis=0)
+
+
+_worker = {}
+
+
+def _init_worker(slots, config):
+    _worker['slots'] = slots
+    _worker.update(config)
+
+
+def _refine(slot, shape, name, img_path):
+    n = int(np.prod(shape))
+    probs = np.frombuffer(_worker['slots'][slot], dtype=np.float16, count=n).reshape(shape)
+    # float16 underflows to 0 for confident pixels, keep the unary energy finite
+    probs = np.maximum(probs.astype(np.float32), 1e-8).transpose(1, 2, 0)[np.newaxis]
+    _, h, w, _ = probs.shape
+
+    if img_path is not None:
+        rgb_img = Image.open(img_path).convert('RGB').resize((w, h), Image.NEAREST)
+        out = dense_crf(probs, img=np.expand_dims(np.array(rgb_img), 0))
+    else:
+        out = dense_crf(probs)
+
+    after_crf = np.argmax(out[0, :, :, :_worker['n_class']], 2)
+
+    # save prob after crf
+    if _worker['prob_outdir']:
+        np.save(os.path.join(_worker['prob_outdir'], name + '.npy'), np.transpose(out[0], (2, 0, 1)))
+
+    after_crf = Image.fromarray(np.uint8(after_crf))
+    if _worker['outimg_shape'] is not None:
+        after_crf = after_crf.resize(tuple(_worker['outimg_shape']), Image.NEAREST)
+    # written under a temporary name first, so that an interrupted run never leaves a
+    # truncated png that a resumed run would skip
+    outfn = os.path.join(_worker['outdir'], name + '.png')
+    after_crf.save(outfn + '.tmp', format='PNG')
+    os.rename(outfn + '.tmp', outfn)
+
+
+class CRFPool(object):
+    """
+    DenseCRF refinement on a process pool. The class probabilities are handed to the
+    workers as float16 through a fixed set of shared memory slots instead of being
+    pickled or written to disk; :meth:`put` blocks while all the slots are in use.
+    Images whose output png already exists are skipped, so an interrupted run resumes.
+
+    Usage, e.g. inline in a tester:
+
+        crf = CRFPool(outdir, num_workers=8, outimg_shape=(2048, 1024))
+        for ...:
+            crf.put(name, F.softmax(outputs).data[0].half().cpu().numpy(), img_path)
+        crf.close()   # waits for the pending images and reports images/sec
+    """
+
+    def __init__(self, outdir, num_workers=None, num_slots=None, outimg_shape=None, n_class=19,
+                 prob_outdir=None):
+        """
+        Args:
+            outdir: directory of the refined label pngs.
+            num_workers: size of the pool, all the cpus by default.
+            num_slots: number of probability maps in flight, 2 per worker by default.
+            outimg_shape: W H of the saved pngs, the probability map size if None.
+            n_class: number of classes the labels are taken from.
+            prob_outdir: if given, also save the probabilities after CRF there as npy.
+        """
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.num_slots = num_slots or 2 * self.num_workers
+        self.outdir = outdir
+        self.config = {'outdir': outdir, 'outimg_shape': outimg_shape, 'n_class': n_class,
+                       'prob_outdir': prob_outdir}
+        mkdir_if_not_exist(outdir)
+        if prob_outdir:
+            mkdir_if_not_exist(prob_outdir)
+        self._pool = None
+        self.num_skipped = 0
+
+    def _start(self, size):
+        # the slots are sized on the first image: all the maps of a run have the same size
+        self.slot_size = size
+        self._slots = [multiprocessing.RawArray(ctypes.c_uint16, size) for _ in range(self.num_slots)]
+        self._pool = BoundedPool(self.num_workers, self.num_slots, use_processes=True,
+                                 initializer=_init_worker, initargs=(self._slots, self.config))
+        self._start_time = time.time()
+
+    def is_done(self, name):
+        return os.path.exists(os.path.join(self.outdir, name + '.png'))
+
+    def put(self, name, probs, img_path=None):
+        """
+        Args:
+            name: output file name, without extension.
+            probs: C x H x W class probabilities (not scores), converted to float16.
+            img_path: raw image for the bilateral term, resized to H x W.
+
+        Returns:
+            bool: False if the output already existed and the image was skipped.
+        """
+        if self.is_done(name):
+            self.num_skipped += 1
+            return False
+        probs = np.asarray(probs)
+        if self._pool is None:
+            self._start(probs.size)
+        if probs.size > self.slot_size:
+            raise ValueError("{}: probability map of {} values doesn't fit the slots of {}".format(
+                name, probs.size, self.slot_size))
+        slot = self._pool.acquire()
+        np.frombuffer(self._slots[slot], dtype=np.float16, count=probs.size)[:] = probs.reshape(-1)
+        self._pool.submit(slot, _refine, slot, probs.shape, name, img_path)
+        return True
+
+    def close(self):
+        """Wait for the pending images, report the throughput and raise the first error, if any."""
+        if self._pool is None:
+            if self.num_skipped:
+                print("crf: all {} images already done".format(self.num_skipped))
+            return
+        self._pool.close()
+        num_done = self._pool.num_jobs
+        if num_done:
+            total_time = time.time() - self._start_time
+            print("crf: {} images in {:.1f}s, {:.2f} images/sec with {} workers ({:.2f}s per image){}".format(
+                num_done, total_time, num_done / total_time, self.num_workers,
+                self._pool.job_time / num_done,
+                ", {} already done".format(self.num_skipped) if self.num_skipped else ""))
 
 
 if __name__ == '__main__':
+    from pytorchgo.utils.prob_store import ProbStore
 
     parser = argparse.ArgumentParser(description='Postprocessing CRF')
     parser.add_argument('prob_indir', type=str,
-                        help='input directory that contains npys in which probability tensors exist')
+                        help='input directory: the probability store of adapt_tester --saves_prob, '
+                             'or npys of scores')
     parser.add_argument('outdir', type=str,
                         help='output directory that contains predicted labels(pngs)')
     parser.add_argument('--prob_outdir', default=None)
@@ -78,48 +208,34 @@ if __name__ == '__main__':
                         help="W H")
     parser.add_argument('--raw_img_indir', type=str, default=None,
                         help="input directory that contains raw imgs(valid:'/data/unagi0/watanabe/DomainAdaptation/Segmentation/VisDA2017/cityscapes_val_imgs', test:'/data/ugui0/dataset/adaptation/segmentation_test')")
-
+    parser.add_argument('--n_class', type=int, default=19)
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='crf processes, all the cpus by default')
 
     args = parser.parse_args()
 
     args.outimg_shape = [int(x) for x in args.outimg_shape]
 
-    mkdir_if_not_exist(args.outdir)
-
-
-    for one_file in tqdm(os.listdir(args.prob_indir)):
-        one_npy_fn = os.path.join(args.prob_indir, one_file)
-        outfn = os.path.join(args.outdir, one_file.replace("npy", "png"))
+    crf = CRFPool(args.outdir, num_workers=args.num_workers, outimg_shape=args.outimg_shape,
+                  n_class=args.n_class, prob_outdir=args.prob_outdir)
 
-        #     if os.path.exists(outfn):
-        #         continue
+    prob_store = ProbStore(args.prob_indir)
+    names = prob_store.names()
+    if not names:
+        names = [fn.replace(".npy", "") for fn in sorted(os.listdir(args.prob_indir)) if fn.endswith(".npy")]
+    # resume: don't even load the maps of the images already done
+    todo = [name for name in names if not crf.is_done(name)]
+    print("crf: {} of {} images already done".format(len(names) - len(todo), len(names)))
 
-        one_prob = np.load(one_npy_fn)
-        one_prob = softmax(one_prob)
-        one_prob = np.transpose(one_prob, [1, 2, 0])
-        one_prob = np.expand_dims(one_prob, 0)
-        _, h, w, n_class = one_prob.shape
-
-        if args.raw_img_indir:
-            one_raw_img_fn = os.path.join(args.raw_img_indir, one_file.replace("npy", "png"))
-            rgb_img = m.imread(one_raw_img_fn)
-            rgb_img = Image.fromarray(np.uint8(rgb_img))
-            rgb_img = rgb_img.resize((w, h), Image.NEAREST)
-            np_rgb_img = np.array(rgb_img)
-            np_rgb_img = np.expand_dims(np_rgb_img, 0)
-            out = dense_crf(one_prob, img=np_rgb_img)
+    for name in tqdm(todo):
+        if name in prob_store:
+            one_prob = prob_store.load(name)
         else:
-            out = dense_crf(one_prob)
-
-        after_crf = np.argmax(out[0, :, :, :19], 2)
-
-        # save prob after crf
-        if args.prob_outdir:
-            mkdir_if_not_exist(args.prob_outdir)
-            out_npy_file = os.path.join(args.prob_outdir, one_file)
-            np.save(out_npy_file, np.transpose(out[0], (2, 0, 1)))
-
-        after_crf = Image.fromarray(np.uint8(after_crf))
-        after_crf = after_crf.resize(args.outimg_shape, Image.NEAREST)
+            # the npys hold the scores of the network
+            one_prob = softmax(np.load(os.path.join(args.prob_indir, name + ".npy")).astype(np.float32))
+        img_path = None
+        if args.raw_img_indir:
+            img_path = os.path.join(args.raw_img_indir, name + ".png")
+        crf.put(name, one_prob.astype(np.float16), img_path)
 
-        after_crf.save(outfn)
+    crf.close()
@@ -7,6 +7,8 @@ import numpy as np
 import torch
 from PIL import Image
 
+from pytorchgo.utils.vis import colorize, full_palette
+
 
 class Scale(object):
     def __init__(self, size, interpolation=Image.BILINEAR):
@@ -172,38 +174,16 @@ def colormap(n):
 
 class Colorize(object):
     def __init__(self, n=20):
-        self.cmap = labelcolormap(n)
-        self.cmap = torch.from_numpy(self.cmap[:n])
+        self.cmap = torch.from_numpy(full_palette(labelcolormap(n)[:n]))
 
     def __call__(self, gray_image):
-        size = gray_image.size()
-        color_image = torch.ByteTensor(3, size[1], size[2]).fill_(0)
-
-        for label in range(0, len(self.cmap)):
-            mask = (label == gray_image[0]).cpu()
-            color_image[0][mask] = self.cmap[label][0]
-            color_image[1][mask] = self.cmap[label][1]
-            color_image[2][mask] = self.cmap[label][2]
+        # 1 x H x W labels -> 3 x H x W ByteTensor, labels without a color stay black
+        return colorize(gray_image[0], self.cmap).cpu()
 
-        return color_image
 
-
-class Colorize2(object):
+class Colorize2(Colorize):
     def __init__(self, n=20):
-        self.cmap = pallet()
-        self.cmap = torch.from_numpy(self.cmap)
-
-    def __call__(self, gray_image):
-        size = gray_image.size()
-        color_image = torch.ByteTensor(3, size[1], size[2]).fill_(0)
-
-        for label in range(0, len(self.cmap)):
-            mask = (label == gray_image[0]).cpu()
-            color_image[0][mask] = self.cmap[label][0]
-            color_image[1][mask] = self.cmap[label][1]
-            color_image[2][mask] = self.cmap[label][2]
-
-        return color_image
+        self.cmap = torch.from_numpy(full_palette(pallet()))
 
 
 class RandomSizedCrop:
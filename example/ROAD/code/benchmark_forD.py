@@ -0,0 +1,77 @@
+from __future__ import print_function
+import argparse
+import copy
+import time
+import numpy as np
+import torch
+from PIL import Image
+from torch.autograd import Variable
+from pytorchgo.augmentation import DiscriminatorInput, resize_labels
+from pytorchgo.utils import logger
+
+# Per-iteration cost of preparing discriminator inputs: the former PIL round-trip
+# (deepcopy, .numpy(), LANCZOS/NEAREST resize, .cuda()) vs. the on-device transforms.
+#   python benchmark_forD.py --batch_size 1 --d_size 512 256
+parser = argparse.ArgumentParser(description='discriminator input preparation benchmark')
+parser.add_argument('--image_size', type=int, nargs=2, default=[1024, 512])
+parser.add_argument('--d_size', type=int, nargs=2, default=[512, 256])
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--iterations', type=int, default=50)
+parser.add_argument('--no-cuda', action='store_true', default=False)
+args = parser.parse_args()
+args.cuda = not args.no_cuda and torch.cuda.is_available()
+
+mean_bgr = np.array([104.00698793, 116.66876762, 122.67891434])
+
+
+def pil_image_forD(img_orig, sz):
+    out = []
+    for i in range(img_orig.size(0)):
+        img = copy.deepcopy(img_orig[i]).cpu().numpy()
+        img = img.transpose((1, 2, 0)) + mean_bgr
+        img = Image.fromarray(img[:, :, ::-1].astype(np.uint8)).convert('RGB')
+        in_ = np.array(img.resize((sz[0], sz[1]), Image.LANCZOS), dtype=np.float64) / 255.0
+        out.append(torch.from_numpy(in_[:, :, ::-1].transpose((2, 0, 1)).copy()).float())
+    out = torch.stack(out)
+    return out.cuda() if args.cuda else out
+
+
+def pil_label_forD(label_orig, sz):
+    out = []
+    for i in range(label_orig.size(0)):
+        label = Image.fromarray(copy.deepcopy(label_orig[i]).cpu().numpy().astype(np.uint8))
+        out.append(torch.from_numpy(np.array(label.resize((sz[0], sz[1]), Image.NEAREST), dtype=np.int64)))
+    out = torch.stack(out)
+    return out.cuda() if args.cuda else out
+
+
+def timeit(fn):
+    fn()
+    if args.cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.iterations):
+        fn()
+    if args.cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / args.iterations * 1000
+
+
+if __name__ == '__main__':
+    w, h = args.image_size
+    images = torch.rand(args.batch_size, 3, h, w) * 255 - torch.from_numpy(mean_bgr).float().view(1, 3, 1, 1)
+    labels = torch.from_numpy(np.random.randint(0, 19, (args.batch_size, h, w)))
+    if args.cuda:
+        images, labels = images.cuda(), labels.cuda()
+
+    to_d = DiscriminatorInput(size=args.d_size, mean=mean_bgr, mode='area')
+    results = [
+        ('image PIL', timeit(lambda: pil_image_forD(images, args.d_size))),
+        ('image on-device', timeit(lambda: to_d(Variable(images, volatile=True)))),
+        ('label PIL', timeit(lambda: pil_label_forD(labels, args.d_size))),
+        ('label on-device', timeit(lambda: resize_labels(labels, args.d_size))),
+    ]
+    logger.info('{}x{} -> {}x{}, batch {}, {}'.format(w, h, args.d_size[0], args.d_size[1], args.batch_size,
+                                                     'cuda' if args.cuda else 'cpu'))
+    for name, ms in results:
+        logger.info('{:16s}: {:.2f} ms/iteration'.format(name, ms))
@@ -3,12 +3,10 @@ import torch
 
 from pytorchgo.utils.pytorch_utils import model_summary, optimizer_summary
 from pytorchgo.utils.weight_init import weights_init
-import torch.nn.functional as F
 from torch.utils import data, model_zoo
 import math
 import os
 import os.path as osp
-import shutil
 import numpy as np
 from torch.autograd import Variable
 import tqdm
@@ -18,6 +16,10 @@ from util_fns import get_parameters
 from pytorchgo.loss.loss import CrossEntropyLoss2d_Seg, Diff2d,CrossEntropyLoss2d
 from pytorchgo.utils.pytorch_utils import step_scheduler
 from pytorchgo.utils import logger
+from pytorchgo.utils.checkpoint import CheckpointManager
+from pytorchgo.utils.teacher_cache import TeacherCache
+from pytorchgo.trainer import AdversarialSegTrainer
+from pytorchgo.dataloader import infinite_loader, to_cuda
 
 class_num = 16
 image_size = [1024, 512]  # [640, 320]
@@ -34,14 +36,16 @@ L_LOSS_WEIGHT = 1
 DISTILL_WEIGHT = 10
 DIS_WEIGHT = 1
 
-G_STEP = 1
-D_STEP = 1
+D_STEP = 1  # discriminator updates per shared forward
+
+# model_fix outputs are cached for the target crops on this grid, see --teacher_crop_grid
+TEACHER_CROP_GRID = 128
+TEACHER_DOWNSAMPLE = 8
 
 Deeplabv2_restore_from = 'http://vllab.ucmerced.edu/ytsai/CVPR18/DeepLab_resnet_pretrained_init-f81d91e8.pth'
 
 
 def main():
-    logger.auto_set_dir()
     global args
     parser = argparse.ArgumentParser()
     parser = argparse.ArgumentParser()
@@ -56,8 +60,17 @@ def main():
     parser.add_argument('--weight_decay', type=float, default=0.0005, help='Weight decay')
     parser.add_argument('--model', type=str, default='vgg16')
     parser.add_argument('--gpu', type=int, default=3)
+    parser.add_argument('--teacher_cache', type=str, default=None,
+                        help='directory to cache model_fix outputs in, instead of running it every iteration')
+    parser.add_argument('--clear_teacher_cache', action='store_true', default=False)
+    parser.add_argument('--teacher_crop_grid', action='store_true', default=False,
+                        help='snap the target crops to the {}px grid of the teacher cache, so that they hit it. '
+                             'Far fewer crop positions: this changes the training recipe'.format(TEACHER_CROP_GRID))
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='continue from the checkpoint in the log directory')
 
     args = parser.parse_args()
+    logger.auto_set_dir(action='k' if args.resume else None)
     print(args)
 
     gpu = args.gpu
@@ -73,17 +86,22 @@ def main():
 
 
     kwargs = {'num_workers': 4, 'pin_memory': True, 'drop_last': True} if cuda else {}
-    train_loader = torch.utils.data.DataLoader(
-        torchfcn.datasets.SYNTHIA('SYNTHIA', args.dataroot, split='train', transform=True, image_size=image_size),
-        batch_size=args.batchSize, shuffle=True, **kwargs)
+    # endless loaders: the workers live for the whole run instead of restarting every epoch
+    train_loader = infinite_loader(
+        torchfcn.datasets.SYNTHIA('SYNTHIA', args.dataroot, split='train', transform=True, image_size=image_size, raw_uint8=True),
+        batch_size=args.batchSize, **kwargs)
 
     val_loader = torch.utils.data.DataLoader(
         torchfcn.datasets.CityScapes('cityscapes', args.dataroot, split='val', transform=True, image_size=[2048,1024]),
         batch_size=1, shuffle=False)
 
-    target_loader = torch.utils.data.DataLoader(
-        torchfcn.datasets.CityScapes('cityscapes', args.dataroot, split='train', transform=True, image_size=image_size),
-        batch_size=args.batchSize, shuffle=True)
+    if args.teacher_crop_grid:
+        logger.warn("target crops snapped to a {}px grid".format(TEACHER_CROP_GRID))
+    target_loader = infinite_loader(
+        torchfcn.datasets.CityScapes('cityscapes', args.dataroot, split='train', transform=True, image_size=image_size, raw_uint8=True,
+                                     crop_grid=TEACHER_CROP_GRID if args.teacher_crop_grid else None,
+                                     crop_key=bool(args.teacher_cache)),
+        batch_size=args.batchSize, **kwargs)
 
     if cuda:
         torch.set_default_tensor_type('torch.cuda.FloatTensor')
@@ -117,6 +135,18 @@ def main():
 
     for param in model_fix.parameters():
         param.requires_grad = False
+    teacher_cache = None
+    if args.teacher_cache:
+        # only the grid-aligned crops are cached, the others run model_fix
+        target_dataset = target_loader.dataset
+        teacher_cache = TeacherCache(
+            model_fix, osp.join(args.teacher_cache, '{}_{}x{}_grid{}.npy'.format(
+                args.model, image_size[0], image_size[1], TEACHER_CROP_GRID)),
+            key_shape=(len(target_dataset),) + target_dataset.crop_grid_shape(TEACHER_CROP_GRID),
+            entry_shape=(class_num, -(-image_size[1] // TEACHER_DOWNSAMPLE), -(-image_size[0] // TEACHER_DOWNSAMPLE)),
+            downsample=TEACHER_DOWNSAMPLE, clear=args.clear_teacher_cache)
+        if not args.teacher_crop_grid:
+            logger.info("without --teacher_crop_grid, few target crops fall on the grid of the teacher cache")
 
     netD = torchfcn.models.Domain_classifer_forAdapSegNet(n_class=class_num)
     netD.apply(weights_init)
@@ -182,6 +212,7 @@ def main():
         cuda=cuda,
         model=model,
         model_fix=model_fix,
+        teacher_cache=teacher_cache,
         netD=netD,
         optimizer=optim,
         optimizerD=optimD,
@@ -194,6 +225,8 @@ def main():
     )
     trainer.epoch = 0
     trainer.iteration = 0
+    if args.resume:
+        trainer.resume()
     trainer.train()
 
 
@@ -201,10 +234,11 @@ class MyTrainer_ROAD(object):
     def __init__(self, cuda, model, model_fix, netD, optimizer, optimizerD,
                  train_loader, target_loader, val_loader,
                  image_size, batch_size,
-                 size_average=True, loss_print_interval=500):
+                 size_average=True, loss_print_interval=500, teacher_cache=None):
         self.cuda = cuda
         self.model = model
         self.model_fix = model_fix
+        self.teacher_cache = teacher_cache
         self.netD = netD
         self.optim = optimizer
         self.optimD = optimizerD
@@ -223,6 +257,20 @@ class MyTrainer_ROAD(object):
         self.epoch = 0
         self.iteration = 0
         self.best_mean_iu = 0
+        self.checkpoints = CheckpointManager(logger.get_logger_dir())
+        self.profiler = logger.StepProfiler('train', log_interval=loss_print_interval)
+
+    def checkpoint_objects(self):
+        # the samplers hold the data order, the step schedulers are applied from the epoch
+        return {'model_state_dict': self.model, 'optim_state_dict': self.optim,
+                'netD_state_dict': self.netD, 'optimD_state_dict': self.optimD,
+                'train_sampler': self.train_loader.sampler, 'target_sampler': self.target_loader.sampler}
+
+    def resume(self):
+        state = self.checkpoints.restore(self.checkpoint_objects())
+        self.epoch = state['epoch'] + 1
+        self.iteration = state['iteration']
+        self.best_mean_iu = state['best_mean_iu']
 
     def validate(self):
         """
@@ -264,148 +312,55 @@ class MyTrainer_ROAD(object):
 
         logger.info("iteration={},epoch={},validation mIoU = {}".format(self.iteration, self.epoch, mean_iu))
 
-        is_best = mean_iu > self.best_mean_iu
-        if is_best:
-            self.best_mean_iu = mean_iu
-        torch.save({
-            'epoch': self.epoch,
-            'iteration': self.iteration,
-            'arch': self.model.__class__.__name__,
-            'optim_state_dict': self.optim.state_dict(),
-            'model_state_dict': self.model.state_dict(),
-            'best_mean_iu': self.best_mean_iu,
-        }, osp.join(logger.get_logger_dir(), 'checkpoint.pth.tar'))
-        if is_best:
-            shutil.copy(osp.join(logger.get_logger_dir(), 'checkpoint.pth.tar'),
-                        osp.join(logger.get_logger_dir(), 'model_best.pth.tar'))
+        self.best_mean_iu = max(self.best_mean_iu, mean_iu)
+        # written in the background, model_best.pth.tar follows the best mean_iu
+        self.checkpoints.save(self.checkpoint_objects(), step=self.epoch, metric=mean_iu,
+                              epoch=self.epoch, iteration=self.iteration, arch=self.model.__class__.__name__,
+                              best_mean_iu=self.best_mean_iu)
+
+    def prepare_batch(self, source_batch, target_batch):
+        # runs in the prefetch thread: to GPU, then normalize the uint8 crops on-device
+        source_data, source_labels = source_batch[0], source_batch[1]
+        target_data = target_batch[0]
+        if self.cuda:
+            source_data, source_labels, target_data = to_cuda((source_data, source_labels, target_data))
+        source_data, source_labels = self.train_loader.dataset.normalize_batch(source_data, source_labels)
+        target_data = self.target_loader.dataset.normalize_batch(target_data)
+        target_keys = None
+        if self.teacher_cache:
+            # (index, x, y) -> (index, grid row, grid column), off-grid crops get no key
+            target_keys = target_batch[2].numpy().copy()
+            off_grid = (target_keys[:, 1:] % TEACHER_CROP_GRID != 0).any(1)
+            target_keys[:, 1:] //= TEACHER_CROP_GRID
+            target_keys[off_grid] = -1
+        return source_data, source_labels, target_data, target_keys
 
     def train_epoch(self):
         """
         Function to train the model for one epoch
         """
-
-        def set_requires_grad(seg, dis):
-            for param in self.model.parameters():
-                param.requires_grad = seg
-
-            for param in self.netD.parameters():
-                param.requires_grad = dis
-
-        import copy
-
-        self.G_source_loader_iter = [enumerate(self.train_loader) for _ in range(G_STEP)]
-        self.G_target_loader_iter = [enumerate(self.target_loader)  for _ in range(G_STEP)]
-
-        self.D_source_loader_iter = [enumerate(self.train_loader) for _ in range(D_STEP)]
-        self.D_target_loader_iter = [enumerate(self.target_loader)  for _ in range(D_STEP)]
-
         for batch_idx in tqdm.tqdm(
                 range(self.iters_per_epoch),
                 total=self.iters_per_epoch,
                 desc='Train epoch = {}/{}'.format(self.epoch, self.max_epoch)):
             self.iteration = batch_idx + self.epoch * self.iters_per_epoch
 
+            losses = self.adversarial_trainer.step()
 
-            src_dis_label = 1
-            target_dis_label = 0
-            mse_loss = torch.nn.MSELoss()
-            def get_data(source_iter, target_iter):
-                _, source_batch = source_iter.next()
-                source_data, source_labels = source_batch
-
-                _, target_batch = target_iter.next()
-                target_data, _ = target_batch
-
-                if self.cuda:
-                    source_data, source_labels = source_data.cuda(), source_labels.cuda()
-                    target_data = target_data.cuda()
-
-                source_data, source_labels = Variable(source_data), Variable(source_labels)
-                target_data = Variable(target_data)
-                return source_data,source_labels, target_data
-
-            ##################################train D
-            for _ in range(D_STEP):
-                source_data, source_labels, target_data = get_data(self.D_source_loader_iter[_], self.D_target_loader_iter[_])
-                self.optimD.zero_grad()
-                set_requires_grad(seg=False, dis=True)
-
-                score = self.model(source_data)
-                seg_target_score = self.model(target_data)
-                src_discriminate_result = self.netD(F.softmax(score))
-                target_discriminate_result = self.netD(F.softmax(seg_target_score))
-
-                src_dis_loss = mse_loss(src_discriminate_result,
-                                        Variable(torch.FloatTensor(src_discriminate_result.data.size()).fill_(
-                                            src_dis_label)).cuda())
-
-                target_dis_loss = mse_loss(target_discriminate_result,
-                                           Variable(torch.FloatTensor(target_discriminate_result.data.size()).fill_(
-                                               target_dis_label)).cuda(),
-                                           )
-
-                src_dis_loss = src_dis_loss * DIS_WEIGHT
-                target_dis_loss = target_dis_loss * DIS_WEIGHT
-                dis_loss = src_dis_loss + target_dis_loss
-                dis_loss.backward()
-                self.optimD.step()
-                # https://ewanlee.github.io/2017/04/29/WGAN-implemented-by-PyTorch/
-                for p in self.netD.parameters():
-                    p.data.clamp_(-0.01, 0.01)
-
-            #####################train G, item1
-            for _ in range(G_STEP):
-                source_data, source_labels, target_data = get_data(self.G_source_loader_iter[_], self.G_target_loader_iter[_])
-                self.optim.zero_grad()
-                set_requires_grad(seg=True, dis=False)
-                # Source domain
-                score = self.model(source_data)
-                l_seg = CrossEntropyLoss2d_Seg(score, source_labels, class_num=class_num, size_average=self.size_average)
-                # target domain
-                seg_target_score = self.model(target_data)
-                modelfix_target_score = self.model_fix(target_data)
-
-                diff2d = Diff2d()
-                distill_loss = diff2d(seg_target_score, modelfix_target_score)
-
-                l_seg = l_seg * L_LOSS_WEIGHT
-                distill_loss = distill_loss * DISTILL_WEIGHT
-                seg_loss =  l_seg + distill_loss
-                #######train G, item 2
-
-
-                src_discriminate_result = self.netD(F.softmax(score))
-                target_discriminate_result = self.netD(F.softmax(seg_target_score))
-
-                src_dis_loss = mse_loss(src_discriminate_result,
-                                        Variable(torch.FloatTensor(src_discriminate_result.data.size()).fill_(
-                                            src_dis_label)).cuda())
-
-                target_dis_loss = mse_loss(target_discriminate_result,
-                                           Variable(
-                                               torch.FloatTensor(target_discriminate_result.data.size()).fill_(
-                                                   src_dis_label)).cuda(),
-                                           )
-
-                src_dis_loss = src_dis_loss*DIS_WEIGHT
-                target_dis_loss = target_dis_loss*DIS_WEIGHT
-                dis_loss = src_dis_loss + target_dis_loss
-                total_loss = seg_loss + dis_loss
-                total_loss.backward()
-                self.optim.step()
-
-
-
-
-            if np.isnan(float(dis_loss.data[0])):
+            if np.isnan(float(losses['src_dis_loss'].data[0])):
                 raise ValueError('dis_loss is nan while training')
-            if np.isnan(float(seg_loss.data[0])):
+            if np.isnan(float(losses['l_seg'].data[0])):
                 raise ValueError('total_loss is nan while training')
 
             if self.iteration % self.loss_print_interval == 0:
                 logger.info(
-                    "After weight Loss: seg_Loss={}, distill_LOSS={}, src_dis_loss={}, target_dis_loss={}".format(l_seg.data[0], distill_loss.data[0],
-                                                                                              src_dis_loss.data[0],target_dis_loss.data[0]))
+                    "After weight Loss: seg_Loss={}, distill_LOSS={}, src_dis_loss={}, target_dis_loss={}".format(
+                        losses['l_seg'].data[0], losses['distill_loss'].data[0],
+                        losses['src_dis_loss'].data[0], losses['target_dis_loss'].data[0]))
+                if self.teacher_cache:
+                    logger.info("teacher cache hit rate: {:.3f}".format(self.teacher_cache.hit_rate()))
+                logger.info("data: queue depth {queue_depth:.2f}, starved {starved:.2%}, wait {wait_ms:.1f}ms/iter".format(
+                    **self.adversarial_trainer.data_iter.stats()))
 
     def train(self):
         """
@@ -420,6 +375,10 @@ class MyTrainer_ROAD(object):
 
         logger.info("iters_per_epoch :{}".format(self.iters_per_epoch))
         self.max_epoch = args.max_epoch
+        # a resumed run picks the data order up after the batches already trained on
+        for loader in [self.train_loader, self.target_loader]:
+            loader.sampler.skip(self.epoch * self.iters_per_epoch * self.batch_size)
+        self.adversarial_trainer = ROADAdversarialTrainer(self)
         for epoch in tqdm.trange(self.epoch, args.max_epoch, desc='Train'):
             self.epoch = epoch
             self.optim = step_scheduler(self.optim, self.epoch, base_lr_schedule, "base model")
@@ -429,9 +388,40 @@ class MyTrainer_ROAD(object):
             self.netD.train()
             self.train_epoch()
 
+            self.profiler.flush()  # validation is not part of the iteration time
             self.model.eval()
             self.validate()
             self.model.train()  # return to training mode
+            self.profiler.reset()
+        self.adversarial_trainer.close()
+        self.profiler.close()
+        self.checkpoints.close()
+
+
+class ROADAdversarialTrainer(AdversarialSegTrainer):
+    """
+    One segmentation forward per (source, target) pair shared by the D and G updates,
+    plus the distillation loss against model_fix on the target batch.
+    """
+
+    def __init__(self, road):
+        self.road = road
+        self.diff2d = Diff2d()
+        super(ROADAdversarialTrainer, self).__init__(
+            road.model, road.netD, road.optim, road.optimD, road.train_loader, road.target_loader,
+            seg_loss=lambda score, label: CrossEntropyLoss2d_Seg(score, label, class_num=class_num,
+                                                                 size_average=road.size_average) * L_LOSS_WEIGHT,
+            dis_weight=DIS_WEIGHT, d_steps=D_STEP, d_clamp=0.01,  # https://ewanlee.github.io/2017/04/29/WGAN-implemented-by-PyTorch/
+            cuda=road.cuda, prepare_batch=road.prepare_batch, profiler=road.profiler)
+
+    def generator_losses(self, source_data, source_labels, target_data, target_keys, source_score, target_score):
+        with self.profiler.scope('teacher'):
+            if self.road.teacher_cache:
+                modelfix_target_score = self.road.teacher_cache(target_data, target_keys)
+            else:
+                modelfix_target_score = self.road.model_fix(target_data)
+        return {'l_seg': self.seg_loss(source_score, source_labels),
+                'distill_loss': self.diff2d(target_score, modelfix_target_score) * DISTILL_WEIGHT}
 
 
 if __name__ == '__main__':
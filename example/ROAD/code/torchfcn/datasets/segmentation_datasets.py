@@ -5,9 +5,9 @@ from PIL import Image
 import torch
 from torch.utils import data
 import cv2
-import copy
 import random
 from tqdm import tqdm
+from pytorchgo.augmentation import DiscriminatorInput, resize_labels
 
 
 DEBUG_NUM = 0
@@ -37,11 +37,20 @@ class SegmentationData_BaseClass(data.Dataset):
     ])
     mean_bgr = np.array([104.00698793, 116.66876762, 122.67891434])
 
-    def __init__(self, dset, root, split='train', output_path = False, transform=False, image_size=[1024, 512]):
+    def __init__(self, dset, root, split='train', output_path = False, transform=False, image_size=[1024, 512], raw_uint8=False, crop_grid=None, crop_key=False):
         self.root = root
         self.image_size = image_size
         self.files = collections.defaultdict(list)
         self.output_path = output_path
+        # return uint8 RGB images and uint8 labels, normalize the batch on-device with normalize_batch()
+        self.raw_uint8 = raw_uint8
+        self._mean_bgr_tensors = {}
+        self._forD_transforms = {}
+        # crop_key: also return a (index, x, y) key of the crop, so that per-crop results
+        # (e.g. teacher outputs) can be cached. crop_grid: snap random crops to a grid of
+        # this many pixels, so that crops repeat; this changes the augmentation
+        self.crop_grid = crop_grid
+        self.crop_key = crop_key
 
     def __len__(self):
         if DEBUG_NUM:
@@ -53,28 +62,78 @@ class SegmentationData_BaseClass(data.Dataset):
         data_file = self.files[self.split][index]
         
         # Loading image and label
+        if self.crop_key:
+            loaded = self.image_label_loader(data_file['img'], data_file['lbl'], self.image_size,
+                                             random_crop=True, return_origin=True)
+            loaded, origin = loaded[:-1], loaded[-1]
+        else:
+            loaded = self.image_label_loader(data_file['img'], data_file['lbl'], self.image_size, random_crop=True)
         if self.output_path:
-            img, lbl,img_path = self.image_label_loader(data_file['img'], data_file['lbl'], self.image_size, random_crop=True)
+            img, lbl,img_path = loaded
         else:
-            img, lbl = self.image_label_loader(data_file['img'], data_file['lbl'], self.image_size,
-                                                         random_crop=True)
-        img = img[:,:,::-1]
-        img -= self.mean_bgr
-        img = img.transpose(2, 0, 1)
-
-
-
-
-
-
-        img = torch.from_numpy(img.copy()).float()
-        lbl = torch.from_numpy(lbl.copy()).long()
+            img, lbl = loaded
+        if self.raw_uint8:
+            img = torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1)))
+            lbl = torch.from_numpy(np.array(lbl, dtype=np.uint8))
+        else:
+            img = img[:,:,::-1].astype(np.float32)
+            img -= self.mean_bgr
+            img = img.transpose(2, 0, 1)
+            img = torch.from_numpy(img.copy())
+            lbl = torch.from_numpy(np.asarray(lbl, dtype=np.int64))
+
+        if self.crop_key:
+            key = torch.LongTensor([index, origin[0], origin[1]])
+            if self.output_path:
+                return img,lbl,img_path,key
+            return img,lbl,key
 
         if self.output_path:
             return img,lbl,img_path
         else:
             return img,lbl
 
+    def random_crop_origin(self, high_x, high_y):
+        """
+        Random top-left corner of a crop, in [0, high_x) x [0, high_y), on the crop grid if one is set.
+        """
+        if self.crop_grid:
+            g = self.crop_grid
+            x = np.random.randint(low=0, high=(high_x - 1) // g + 1) * g
+            y = np.random.randint(low=0, high=(high_y - 1) // g + 1) * g
+        else:
+            x = np.random.randint(low=0, high=high_x)
+            y = np.random.randint(low=0, high=high_y)
+        return x, y
+
+    def normalize_batch(self, img, lbl=None):
+        """
+        On-device counterpart of the normalization done in __getitem__, for batches
+        loaded with raw_uint8=True: RGB->BGR, float conversion and mean subtraction.
+        Args:
+            img: uint8 tensor, N x 3 x H x W, RGB
+            lbl: uint8 tensor, N x H x W (optional)
+        Returns:
+            float image tensor (and long label tensor) on the device of the input
+        """
+        key = img.get_device() if img.is_cuda else -1
+        if key not in self._mean_bgr_tensors:
+            mean = torch.from_numpy(self.mean_bgr.astype(np.float32)).view(1, 3, 1, 1)
+            bgr_index = torch.LongTensor([2, 1, 0])
+            if img.is_cuda:
+                mean, bgr_index = mean.cuda(key), bgr_index.cuda(key)
+            self._mean_bgr_tensors[key] = mean, bgr_index
+        mean, bgr_index = self._mean_bgr_tensors[key]
+        img = img.index_select(1, bgr_index).float() - mean
+        if lbl is None:
+            return img
+        return img, lbl.long()
+
+    @staticmethod
+    def crop_is_blank(lbl_crop, ignore_label=255):
+        """A crop is useless for training if every pixel is ignored."""
+        return np.count_nonzero(lbl_crop != ignore_label) == 0
+
     def transform(self, img, lbl):
         """
         Module for implementing transformations to the input.
@@ -114,65 +173,29 @@ class SegmentationData_BaseClass(data.Dataset):
         Module to transform the input as needed by the discriminator.
         Input to the discriminator is in the range [0, 1]
         Args:
-            img_orig: Image
+            img_orig: Image batch (N x 3 x H x W, tensor or Variable), stays on its device
             sz: New size needed for discriminator
         Returns:
-            Transformed image
-        """
-        
-        if not resize and not mean_add:
-            img = copy.deepcopy(img_orig)
-            return img/255.0
-        else:
-            img = copy.deepcopy(img_orig)
-            img = img.numpy()        
-            img = img.squeeze().transpose((1, 2, 0))
-            if mean_add:
-                img += self.mean_bgr
-            img = img[:,:,::-1]
-
-            if resize:
-                img = img.astype(np.uint8)
-                img = Image.fromarray(img).convert('RGB')
-                img = img.resize((sz[0],sz[1]),Image.LANCZOS)
-                in_ = np.array(img, dtype=np.float64)
-            else:
-                in_ = img
-
-            in_ /= 255.0        
-            in_ = in_[:,:,::-1].transpose((2,0,1))
-            in_ = torch.from_numpy(in_.copy()).float() 
-
-            return in_
-        
-        """
-        img = copy.deepcopy(img_orig)
-        img = img.numpy()
-        img = img.transpose((0, 2, 3, 1))
-        img_new = np.zeros((img.shape[0], sz[1], sz[0], img.shape[3])).astype(img.dtype)
-        for i in range(img.shape[0]):
-            img[i] += self.mean_bgr
-            img_new[i] = cv2.resize(img[i],sz)
-            img_new[i] /= 255.0
-        return img_new.transpose((0, 3, 1, 2))
+            Transformed image batch
         """
+        key = (tuple(sz) if resize else None, mean_add)
+        if key not in self._forD_transforms:
+            self._forD_transforms[key] = DiscriminatorInput(
+                size=key[0], mean=self.mean_bgr if mean_add else None, mode='area')
+        return self._forD_transforms[key](img_orig)
 
     def transform_label_forD(self, label_orig, sz):
-            
-        label = copy.deepcopy(label_orig.data.cpu().numpy())
-        label = Image.fromarray(label.squeeze().astype(np.uint8))
-        label = label.resize((sz[0],sz[1]),Image.NEAREST)
-        label=np.array(label, dtype=np.int32)
-        label = torch.from_numpy(label.copy()).long()
-        label = label.cuda()
+        label = resize_labels(label_orig, sz).long()
+        if not label.is_cuda:
+            label = label.cuda()
         return label
 
 
 class SYNTHIA(SegmentationData_BaseClass):
     
-    def __init__(self, dset, root,class_num=16, split='train', transform=False, image_size=[1024, 512], output_path = False):
+    def __init__(self, dset, root,class_num=16, split='train', transform=False, image_size=[1024, 512], output_path = False, raw_uint8=False):
         super(SYNTHIA, self).__init__(
-            dset, root, split=split, transform=transform, image_size=image_size)
+            dset, root, split=split, transform=transform, image_size=image_size, raw_uint8=raw_uint8)
         
         self.dset = dset
         self.root = root
@@ -235,26 +258,24 @@ class SYNTHIA(SegmentationData_BaseClass):
             random_crop: Boolean variable to indicate if random crop needs to be performed.
                          If False, centercrop is done
         Returns:
-            Loaded image (numpy array)
+            Loaded image (uint8 numpy array, RGB)
         """
 
             
-        im = Image.open(img_path).convert('RGB')
+        im = Image.open(img_path)
         label = Image.open(label_path)
         MAX_TRY = 10
         #random crop only for train
         if self.split == 'train':
-            im_ = np.array(im, dtype=np.float64)
-            label_= np.array(label, dtype=np.int32)
-            #print np.unique(label)
+            label_full = np.asarray(label)
             #randomizing the left corner point to select a random crop
             #TODO,buggy, synthia_mapped_to_cityscapes/0006372.png
             i = 0
             while i < MAX_TRY:
-                x_rand = np.random.randint(low=0,high=im_.shape[0]-data_size[1])
-                y_rand = np.random.randint(low=0,high=im_.shape[1]-data_size[0])
-                label_ = label_[x_rand:x_rand+data_size[1],y_rand:y_rand+data_size[0]]
-                if np.unique(label_).shape[0]==1 and (np.unique(label_))[0]==255:
+                x_rand = np.random.randint(low=0,high=label_full.shape[0]-data_size[1])
+                y_rand = np.random.randint(low=0,high=label_full.shape[1]-data_size[0])
+                label_ = label_full[x_rand:x_rand+data_size[1],y_rand:y_rand+data_size[0]]
+                if self.crop_is_blank(label_):
                     print "blank feature map, recrop.."
                     i += 1
                 else:
@@ -264,13 +285,14 @@ class SYNTHIA(SegmentationData_BaseClass):
                 print "current image is not normal, max try: {}".format(i)
                 raise
 
-            im_ = im_[x_rand:x_rand+data_size[1],y_rand:y_rand+data_size[0],:]
+            # only the crop region is converted to an array
+            im_ = np.asarray(im.crop((y_rand, x_rand, y_rand+data_size[0], x_rand+data_size[1])).convert('RGB'))
 
         else:
-            im = im.resize((data_size[0], data_size[1]), Image.LANCZOS)
+            im = im.convert('RGB').resize((data_size[0], data_size[1]), Image.LANCZOS)
             label = label.resize((data_size[0], data_size[1]), Image.NEAREST)
-            im_ = np.array(im, dtype=np.float64)
-            label_= np.array(label, dtype=np.int32)
+            im_ = np.asarray(im)
+            label_= np.asarray(label)
 
         if self.output_path:
             return im_, label_ ,img_path
@@ -279,9 +301,9 @@ class SYNTHIA(SegmentationData_BaseClass):
 
 class GTA5(SegmentationData_BaseClass):
     
-    def __init__(self, dset, root, split='train', transform=False, image_size=[1024, 512]):
+    def __init__(self, dset, root, split='train', transform=False, image_size=[1024, 512], raw_uint8=False):
         super(GTA5, self).__init__(
-            dset, root, split=split, transform=transform, image_size=image_size)
+            dset, root, split=split, transform=transform, image_size=image_size, raw_uint8=raw_uint8)
         
         self.dset = dset
         self.root = root
@@ -324,7 +346,7 @@ class GTA5(SegmentationData_BaseClass):
             random_crop: Boolean variable to indicate if random crop needs to be performed. 
                          If False, centercrop is done
         Returns:
-            Loaded image (numpy array)
+            Loaded image (uint8 numpy array, RGB)
         """
         
         if data_size[0] != data_size[1]*2:
@@ -342,8 +364,8 @@ class GTA5(SegmentationData_BaseClass):
         if self.split == 'train':
             im = im.resize((w_new, h_new), Image.LANCZOS)
             label = label.resize((w_new, h_new), Image.LANCZOS)
-            im_ = np.array(im, dtype=np.float64)
-            label_= np.array(label, dtype=np.int32)
+            im_ = np.asarray(im)
+            label_= np.array(label)
             done = False
             while not done:
                 #randomizing the left corner point to select a random crop
@@ -363,16 +385,20 @@ class GTA5(SegmentationData_BaseClass):
         else:
             im = im.resize((data_size[0], data_size[1]), Image.LANCZOS)
             label = label.resize((data_size[0], data_size[1]), Image.NEAREST)
-            im_ = np.array(im, dtype=np.float64)
-            label_= np.array(label, dtype=np.int32)
+            im_ = np.asarray(im)
+            label_= np.asarray(label)
         return im_, label_
 
 
 class CityScapes(SegmentationData_BaseClass):
 
-    def __init__(self, dset, root, class_num=16, split='train', transform=False, image_size=[1024, 512],output_path = False):
+    # every cityscapes image is 2048 x 1024
+    full_size = (2048, 1024)
+
+    def __init__(self, dset, root, class_num=16, split='train', transform=False, image_size=[1024, 512],output_path = False, raw_uint8=False, crop_grid=None, crop_key=False):
         super(CityScapes, self).__init__(
-            dset, root, split=split, transform=transform, image_size=image_size, output_path=output_path)
+            dset, root, split=split, transform=transform, image_size=image_size, output_path=output_path, raw_uint8=raw_uint8,
+            crop_grid=crop_grid, crop_key=crop_key)
         
         self.dset = dset
         self.root = root
@@ -432,7 +458,16 @@ class CityScapes(SegmentationData_BaseClass):
             lbl_file = osp.join(gt_dir, '%s' % lid.rstrip('\n'))
             self.files[self.split].append({'img': img_file, 'lbl': lbl_file})
     
-    def image_label_loader(self, img_path, label_path, data_size, random_crop=False):
+    def crop_origin_range(self, full_size, data_size):
+        """Random crop origins (row, column) are drawn in [0, high_x) x [0, high_y), a buffer of 50 is kept."""
+        return full_size[1]-50-data_size[1], full_size[0]-50-data_size[0]
+
+    def crop_grid_shape(self, grid):
+        """Number of crop origins on a grid of ``grid`` pixels, along the rows and the columns."""
+        high_x, high_y = self.crop_origin_range(self.full_size, self.image_size)
+        return (high_x - 1) // grid + 1, (high_y - 1) // grid + 1
+
+    def image_label_loader(self, img_path, label_path, data_size, random_crop=False, return_origin=False):
         """
         Function for loading a single (image, label) pair
         Args:
@@ -441,36 +476,36 @@ class CityScapes(SegmentationData_BaseClass):
             data_size: Required size. Aspect ratio needs to be 2:1 (Cityscapes aspect ratio)
             random_crop: Boolean variable to indicate if random crop needs to be performed. 
                          If False, centercrop is done
+            return_origin: also return the (row, column) origin of the crop, (0, 0) if not cropped
         Returns:
-            Loaded image (numpy array)
+            Loaded image (uint8 numpy array, RGB)
         """
         
 
             
-        im = Image.open(img_path).convert('RGB')
+        im = Image.open(img_path)
         label = Image.open(label_path)
+        x_rand, y_rand = 0, 0
 
 
         #random crop only for train
         if self.split == 'train':
-            im_ = np.array(im, dtype=np.float64)
-            label_= np.array(label, dtype=np.int32)
             #randomizing the left corner point to select a random crop
-            x_rand = np.random.randint(low=0,high=im_.shape[0]-50-data_size[1])
-            y_rand = np.random.randint(low=0,high=im_.shape[1]-50-data_size[0]) #buffer of 50
-            label_ = label_[x_rand:x_rand+data_size[1],y_rand:y_rand+data_size[0]]
-            im_ = im_[x_rand:x_rand+data_size[1],y_rand:y_rand+data_size[0],:]
+            x_rand, y_rand = self.random_crop_origin(*self.crop_origin_range(im.size, data_size))
+            box = (y_rand, x_rand, y_rand+data_size[0], x_rand+data_size[1])
+            label_ = np.asarray(label.crop(box))
+            im_ = np.asarray(im.crop(box).convert('RGB'))
 
         else:
-            im = im.resize((data_size[0], data_size[1]), Image.LANCZOS)
+            im = im.convert('RGB').resize((data_size[0], data_size[1]), Image.LANCZOS)
             label = label.resize((data_size[0], data_size[1]), Image.NEAREST)
-            im_ = np.array(im, dtype=np.float64)
-            label_= np.array(label, dtype=np.int32)
+            im_ = np.asarray(im)
+            label_= np.asarray(label)
 
-        if self.output_path:
-            return im_, label_ ,img_path
-        else:
-            return im_,label_
+        loaded = (im_, label_, img_path) if self.output_path else (im_, label_)
+        if return_origin:
+            return loaded + ((x_rand, y_rand),)
+        return loaded
 
 
 """
@@ -0,0 +1,79 @@
+from __future__ import print_function
+import argparse
+import subprocess
+import sys
+import time
+import torch
+from torch.autograd import Variable
+from models import gnn_iclr
+from pytorchgo.utils import logger
+from pytorchgo.utils.gpu import PeakGPUMemory
+
+# Memory and throughput of the GNN metric network for several ways/shots.
+# Every measurement runs in its own process, so that the peaks don't carry over.
+#   python3 benchmark_gnn.py --batch_size 40 --edge_chunk 8
+parser = argparse.ArgumentParser(description='GNN metric network benchmark')
+parser.add_argument('--batch_size', type=int, default=40)
+parser.add_argument('--emb_size', type=int, default=128)
+parser.add_argument('--iterations', type=int, default=20)
+parser.add_argument('--edge_chunk', type=int, default=8,
+                    help='Rows per chunk of the test-time edge computation')
+parser.add_argument('--no-cuda', action='store_true', default=False)
+parser.add_argument('--only', type=str, default=None,
+                    help='n_way,num_shots,mode (train, test or chunk): a single measurement')
+args = parser.parse_args()
+args.cuda = not args.no_cuda and torch.cuda.is_available()
+args.dataset = 'mini_imagenet'
+
+
+def measure(n_way, num_shots, mode):
+    """Episodes/s and peak GPU memory of one mode, in this process."""
+    args.train_N_way = n_way
+    N = n_way * num_shots + 1
+    nodes = torch.randn(args.batch_size, N, args.emb_size + n_way)
+    if args.cuda:
+        nodes = nodes.cuda()
+    if mode != 'chunk':
+        args.edge_chunk = 0
+    model = gnn_iclr.GNN_nl(args, args.emb_size + n_way, nf=96, J=1)
+    if args.cuda:
+        model.cuda()
+    train = mode == 'train'
+    model.train(train)
+    nodes = Variable(nodes, volatile=not train)
+
+    with PeakGPUMemory() as memory:
+        start = time.time()
+        for _ in range(args.iterations):
+            out = model(nodes)
+            if train:
+                out.sum().backward()
+        if args.cuda:
+            torch.cuda.synchronize()
+        eps = args.iterations * args.batch_size / (time.time() - start)
+    return eps, str(memory) if args.cuda else 'n/a'
+
+
+def benchmark(n_way, num_shots):
+    results = []
+    for mode in ['train', 'test', 'chunk']:
+        out = subprocess.check_output([sys.executable] + sys.argv + ['--only', '{},{},{}'.format(n_way, num_shots, mode)])
+        eps, memory = out.decode('utf-8').strip().splitlines()[-1].split()
+        results.append((float(eps), memory))
+
+    (train_eps, train_mem), (test_eps, test_mem), (chunk_eps, chunk_mem) = results
+    logger.info('{}-way {}-shot (N={}): train {:.1f} episodes/s peak {} | test {:.1f} episodes/s peak {} | '
+                'test chunk={} {:.1f} episodes/s peak {}'.format(
+                    n_way, num_shots, n_way * num_shots + 1, train_eps, train_mem, test_eps, test_mem,
+                    args.edge_chunk, chunk_eps, chunk_mem))
+
+
+if __name__ == '__main__':
+    if args.only:
+        n_way, num_shots, mode = args.only.split(',')
+        print('{} {}'.format(*measure(int(n_way), int(num_shots), mode)))
+    else:
+        logger.info('peak memory: as nvidia-smi reports it for the process, CUDA context included')
+        for n_way in [5, 20]:
+            for num_shots in [1, 5]:
+                benchmark(n_way, num_shots)
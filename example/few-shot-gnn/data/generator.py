@@ -2,14 +2,101 @@ from __future__ import print_function
 import torch.utils.data as data
 import torch
 import numpy as np
-import random
+from concurrent.futures import ThreadPoolExecutor
 from torch.autograd import Variable
+from pytorchgo.utils.utils import get_rng
 from . import omniglot
 from . import mini_imagenet
 
 
+class EpisodeSampler(object):
+    """
+    Draw batches of few-shot episodes from a class-sorted image array.
+
+    ``images[offsets[c]:offsets[c + 1]]`` holds all images of class ``c``.
+    Classes, shots and support positions for a whole batch are drawn with a
+    few vectorized calls and images are gathered with fancy indexing, so the
+    cost of an episode does not grow with python loops over ways and shots.
+    """
+
+    def __init__(self, images, offsets, normalize=None, rng=None):
+        self.images = images
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.counts = np.diff(self.offsets)
+        self.num_classes = len(self.counts)
+        self.normalize = normalize
+        self.rng = get_rng(self) if rng is None else rng
+
+    def gather(self, indices):
+        images = self.images[indices.ravel()]
+        if self.normalize is not None:
+            images = self.normalize(images)
+        return np.ascontiguousarray(images, dtype='float32').reshape(indices.shape + images.shape[1:])
+
+    def sample_indices(self, batch_size, n_way, num_shots):
+        """
+        Returns:
+            classes: [batch, n_way] sampled class ids.
+            positive: [batch] position of the query class among ``classes``.
+            query: [batch] image index of the query.
+            support: [batch, n_way, num_shots] image indices of the support set,
+                disjoint from ``query``.
+        """
+        rng = self.rng
+        n_draw = num_shots + 1
+        assert n_way <= self.num_classes, 'Not enough classes for a %d-way task' % n_way
+
+        # n_way distinct classes per episode: the n_way smallest of random keys
+        classes = np.argpartition(rng.rand(batch_size, self.num_classes), n_way - 1, axis=1)[:, :n_way]
+        counts = self.counts[classes]
+        assert counts.min() >= n_draw, 'Not enough samples for %d shots' % num_shots
+
+        # num_shots + 1 distinct samples per class, padding slots can never be drawn
+        keys = rng.rand(batch_size, n_way, self.counts.max())
+        keys[np.arange(keys.shape[2]) >= counts[:, :, None]] = 2.
+        drawn = np.argpartition(keys, n_draw - 1, axis=2)[:, :, :n_draw] + self.offsets[classes][:, :, None]
+
+        # The query class gives its first draw to the query, the other classes drop their last one.
+        positive = rng.randint(0, n_way, size=batch_size)
+        rows = np.arange(batch_size)
+        query = drawn[rows, positive, 0]
+        start = (np.arange(n_way)[None, :] == positive[:, None]).astype('int64')
+        support = drawn[rows[:, None, None], np.arange(n_way)[None, :, None],
+                        start[:, :, None] + np.arange(num_shots)[None, None, :]]
+        return classes, positive, query, support
+
+    def sample(self, batch_size, n_way, num_shots, unlabeled_extra=0):
+        classes, positive, query, support = self.sample_indices(batch_size, n_way, num_shots)
+        num_support = n_way * num_shots
+        rows = np.arange(batch_size)[:, None]
+
+        # Shuffle the support set of every episode, as (class, shot) pairs.
+        perm = np.argsort(self.rng.rand(batch_size, num_support), axis=1)
+        support_idx = np.empty((batch_size, num_support), dtype='int64')
+        support_idx[rows, perm] = support.reshape(batch_size, num_support)
+        support_cls = np.empty((batch_size, num_support), dtype='int64')
+        support_cls[rows, perm] = np.repeat(np.arange(n_way), num_shots)[None, :]
+        support_shot = np.empty((batch_size, num_support), dtype='int64')
+        support_shot[rows, perm] = np.tile(np.arange(num_shots), n_way)[None, :]
+
+        eye = np.eye(n_way, dtype='float32')
+        labels_x = eye[positive]
+        labels_x_global = classes[np.arange(batch_size), positive]
+        # position-major so that every support position is a contiguous [batch, ...] block
+        oracles_yi = eye[support_cls.T]
+        labels_yi = oracles_yi * (support_shot.T >= unlabeled_extra)[:, :, None]
+        hidden_labels = np.zeros((batch_size, num_support + 1), dtype='float32')
+        hidden_labels[:, 1:] = support_shot < unlabeled_extra
+
+        batch_x = self.gather(query)
+        batches_xi = self.gather(support_idx.T)
+
+        return [batch_x, labels_x, positive.astype('int64'), labels_x_global.astype('int64'),
+                list(batches_xi), list(labels_yi), list(oracles_yi), hidden_labels]
+
+
 class Generator(data.Dataset):
-    def __init__(self, root, args, partition='train', dataset='omniglot'):
+    def __init__(self, root, args, partition='train', dataset='omniglot', prefetch=True):
         self.root = root
         self.partition = partition  # training set or test set
         self.args = args
@@ -27,81 +114,69 @@ class Generator(data.Dataset):
 
         if dataset == 'omniglot':
             self.loader = omniglot.Omniglot(self.root, dataset=dataset)
-            self.data = self.loader.load_dataset(self.partition == 'train', self.size)
+            data_dict = self.loader.load_dataset(self.partition == 'train', self.size)
+            classes = list(data_dict.keys())
+            images, offsets = self._compact_(data_dict)
+            normalize = None
         elif dataset == 'mini_imagenet':
             self.loader = mini_imagenet.MiniImagenet(self.root)
-            self.data, self.label_encoder = self.loader.load_dataset(self.partition, self.size)
+            images, offsets, classes, self.label_encoder = self.loader.load_dataset(self.partition, self.size)
+            normalize = mini_imagenet.normalize
         else:
             raise NotImplementedError
 
         self.class_encoder = {}
-        for id_key, key in enumerate(self.data):
+        for id_key, key in enumerate(classes):
             self.class_encoder[key] = id_key
 
+        self.sampler = EpisodeSampler(images, offsets, normalize=normalize)
+
+        self.prefetch = prefetch
+        self._pending = None
+        if self.prefetch:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _compact_(self, data):
+        # Move every image of the partition into one contiguous [num_images, C, H, W]
+        # array sorted by class. Lists are released class by class so peak memory
+        # stays close to a single copy of the partition.
+        keys = list(data.keys())
+        counts = [len(data[key]) for key in keys]
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype('int64')
+        images = np.empty((offsets[-1], self.input_channels, self.size[0], self.size[1]), dtype='float32')
+        for id_key, key in enumerate(keys):
+            images[offsets[id_key]:offsets[id_key + 1]] = np.stack(data[key]).reshape(
+                (-1, self.input_channels, self.size[0], self.size[1]))
+            data[key] = None
+        return images, offsets
+
     def rotate_image(self, image, times):
-        rotated_image = np.zeros(image.shape)
-        for channel in range(image.shape[0]):
-            rotated_image[channel, :, :] = np.rot90(image[channel, :, :], k=times)
-        return rotated_image
+        return np.rot90(image, k=times, axes=(1, 2))
+
+    def _next_episode_(self, key):
+        if not self.prefetch:
+            return self.sampler.sample(*key)
+        if self._pending is not None and self._pending[0] == key:
+            episode = self._pending[1].result()
+        else:
+            episode = self.sampler.sample(*key)
+        # Build the next batch in the background while the caller consumes this one.
+        self._pending = (key, self._executor.submit(self.sampler.sample, *key))
+        return episode
 
     def get_task_batch(self, batch_size=5, n_way=20, num_shots=1, unlabeled_extra=0, cuda=False, variable=False):
-        # Init variables
         # batch_x:[batch,channel,w,h]
         # labels_x: [batch, n_way]
         # labels_x_global: [batch]
-        batch_x = np.zeros((batch_size, self.input_channels, self.size[0], self.size[1]), dtype='float32')
-        labels_x = np.zeros((batch_size, n_way), dtype='float32')
-        labels_x_global = np.zeros(batch_size, dtype='int64')
-        target_distances = np.zeros((batch_size, n_way * num_shots), dtype='float32')
-        hidden_labels = np.zeros((batch_size, n_way * num_shots + 1), dtype='float32')
-        numeric_labels = []
-        batches_xi, labels_yi, oracles_yi = [], [], []
-        for i in range(n_way*num_shots):
-            batches_xi.append(np.zeros((batch_size, self.input_channels, self.size[0], self.size[1]), dtype='float32'))
-            labels_yi.append(np.zeros((batch_size, n_way), dtype='float32'))
-            oracles_yi.append(np.zeros((batch_size, n_way), dtype='float32'))
-        # Iterate over tasks for the same batch
-
-        for batch_counter in range(batch_size):
-            positive_class = random.randint(0, n_way - 1)
-
-            # Sample random classes for this TASK
-            classes_ = list(self.data.keys())
-            sampled_classes = random.sample(classes_, n_way)
-            indexes_perm = np.random.permutation(n_way * num_shots)
-
-            counter = 0
-            for class_counter, class_ in enumerate(sampled_classes):
-                if class_counter == positive_class:
-                    # We take num_shots + one sample for one class
-                    samples = random.sample(self.data[class_], num_shots+1)
-                    # Test sample is loaded
-                    batch_x[batch_counter, :, :, :] = samples[0]
-                    labels_x[batch_counter, class_counter] = 1
-                    labels_x_global[batch_counter] = self.class_encoder[class_]
-                    samples = samples[1::]
-                else:
-                    samples = random.sample(self.data[class_], num_shots)
-
-                for s_i in range(0, len(samples)):
-                    batches_xi[indexes_perm[counter]][batch_counter, :, :, :] = samples[s_i]
-                    if s_i < unlabeled_extra:
-                        labels_yi[indexes_perm[counter]][batch_counter, class_counter] = 0
-                        hidden_labels[batch_counter, indexes_perm[counter] + 1] = 1
-                    else:
-                        labels_yi[indexes_perm[counter]][batch_counter, class_counter] = 1
-                    oracles_yi[indexes_perm[counter]][batch_counter, class_counter] = 1
-                    target_distances[batch_counter, indexes_perm[counter]] = 0
-                    counter += 1
-
-            numeric_labels.append(positive_class)
+        # batches_xi, labels_yi, oracles_yi: n_way*num_shots items of [batch, ...]
+        [batch_x, labels_x, labels_x_scalar, labels_x_global,
+         batches_xi, labels_yi, oracles_yi, hidden_labels] = self._next_episode_(
+            (batch_size, n_way, num_shots, unlabeled_extra))
 
         batches_xi = [torch.from_numpy(batch_xi) for batch_xi in batches_xi]
         labels_yi = [torch.from_numpy(label_yi) for label_yi in labels_yi]
         oracles_yi = [torch.from_numpy(oracle_yi) for oracle_yi in oracles_yi]
 
-        labels_x_scalar = np.argmax(labels_x, 1)
-
         return_arr = [torch.from_numpy(batch_x), torch.from_numpy(labels_x), torch.from_numpy(labels_x_scalar),
                       torch.from_numpy(labels_x_global), batches_xi, labels_yi, oracles_yi,
                       torch.from_numpy(hidden_labels)]
@@ -5,12 +5,18 @@ import os.path
 import numpy as np
 from PIL import Image as pil_image
 import pickle
+import multiprocessing
 from pytorchgo.utils import logger
 
+IMAGE_SIZE = (84, 84)
+MEAN_RGB = np.array([120.45, 115.74, 104.65], dtype='float32').reshape(1, 3, 1, 1)
+
+
 class MiniImagenet(data.Dataset):
-    def __init__(self, root, dataset='mini_imagenet'):
+    def __init__(self, root, dataset='mini_imagenet', num_workers=None):
         self.root = root
         self.dataset = dataset
+        self.num_workers = num_workers
         if not self._check_exists_():
             self._init_folders_()
             if self.check_decompress():
@@ -42,11 +48,17 @@ class MiniImagenet(data.Dataset):
         logger.info("Decompressed")
 
     def _check_exists_(self):
-        if not os.path.exists(os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_train.pickle')) or not \
-                os.path.exists(os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_test.pickle')):
-            return False
-        else:
-            return True
+        for partition in ['train', 'test', 'val']:
+            if not os.path.exists(self._images_file_(partition)) or not \
+                    os.path.exists(self._index_file_(partition)):
+                return False
+        return True
+
+    def _images_file_(self, partition):
+        return os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_%s.npy' % partition)
+
+    def _index_file_(self, partition):
+        return os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_%s_index.pickle' % partition)
 
     def get_image_paths(self, file):
         images_path, class_names = [], []
@@ -60,6 +72,32 @@ class MiniImagenet(data.Dataset):
                 class_names.append(class_)
         return class_names, images_path
 
+    def _write_partition_(self, partition, class_names, images_path, label_encoder, pool):
+        """
+        Store a partition as one uint8 [num_images, 84, 84, 3] .npy sorted by class,
+        plus an index with the label of every class and its offset in the array.
+        """
+        classes = sorted(set(label_encoder[class_] for class_ in class_names))
+        by_class = dict((c, []) for c in classes)
+        for class_, path in zip(class_names, images_path):
+            by_class[label_encoder[class_]].append(path)
+        paths = [path for c in classes for path in by_class[c]]
+        offsets = np.cumsum([0] + [len(by_class[c]) for c in classes]).astype('int64')
+
+        tmp_file = self._images_file_(partition) + '.tmp'
+        images = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8,
+                                           shape=(len(paths), IMAGE_SIZE[0], IMAGE_SIZE[1], 3))
+        for i, img in enumerate(pool.imap(_load_image_, paths, chunksize=64)):
+            images[i] = img
+            if (i + 1) % 1000 == 0:
+                logger.info("{}: {} from {}".format(partition, i + 1, len(paths)))
+        images.flush()
+        del images
+        os.rename(tmp_file, self._images_file_(partition))
+
+        with open(self._index_file_(partition), 'wb') as handle:
+            pickle.dump({'classes': classes, 'offsets': offsets}, handle, protocol=2)
+
     def _preprocess_(self):
         logger.info('\nPreprocessing Mini-Imagenet images...')
         (class_names_train, images_path_train) = self.get_image_paths('%s/mini_imagenet/train.csv' % self.root)
@@ -81,106 +119,79 @@ class MiniImagenet(data.Dataset):
             label_encoder[keys_val[i-len(keys_train) - len(keys_test)]] = i
             label_decoder[i] = keys_val[i-len(keys_train)-len(keys_test)]
 
-        counter = 0
-        train_set = {}
-        for class_, path in zip(class_names_train, images_path_train):
-            img = pil_image.open(path)
-            img = img.convert('RGB')
-            img = img.resize((84, 84), pil_image.ANTIALIAS)
-            img = np.array(img, dtype='float32')
-            if label_encoder[class_] not in train_set:
-                train_set[label_encoder[class_]] = []
-            train_set[label_encoder[class_]].append(img)
-            counter += 1
-            if counter % 1000 == 0:
-                logger.info("Counter "+str(counter) + " from " + str(len(images_path_train) + len(class_names_test) +
-                                                               len(class_names_val)))
-
-        test_set = {}
-        for class_, path in zip(class_names_test, images_path_test):
-            img = pil_image.open(path)
-            img = img.convert('RGB')
-            img = img.resize((84, 84), pil_image.ANTIALIAS)
-            img = np.array(img, dtype='float32')
-
-            if label_encoder[class_] not in test_set:
-                test_set[label_encoder[class_]] = []
-            test_set[label_encoder[class_]].append(img)
-            counter += 1
-            if counter % 1000 == 0:
-                logger.info("Counter " + str(counter) + " from "+str(len(images_path_train) + len(class_names_test) +
-                                                               len(class_names_val)))
-
-        val_set = {}
-        for class_, path in zip(class_names_val, images_path_val):
-            img = pil_image.open(path)
-            img = img.convert('RGB')
-            img = img.resize((84, 84), pil_image.ANTIALIAS)
-            img = np.array(img, dtype='float32')
-
-            if label_encoder[class_] not in val_set:
-                val_set[label_encoder[class_]] = []
-            val_set[label_encoder[class_]].append(img)
-            counter += 1
-            if counter % 1000 == 0:
-                logger.info("Counter "+str(counter) + " from " + str(len(images_path_train) + len(class_names_test) +
-                                                               len(class_names_val)))
-
-        with open(os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_train.pickle'), 'wb') as handle:
-            pickle.dump(train_set, handle, protocol=2)
-        with open(os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_test.pickle'), 'wb') as handle:
-            pickle.dump(test_set, handle, protocol=2)
-        with open(os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_val.pickle'), 'wb') as handle:
-            pickle.dump(val_set, handle, protocol=2)
-
-        label_encoder = {}
-        keys = list(train_set.keys()) + list(test_set.keys())
+        # Images are decoded and resized in parallel, the main process only copies
+        # the results into the memory-mapped output.
+        pool = multiprocessing.Pool(self.num_workers)
+        try:
+            self._write_partition_('train', class_names_train, images_path_train, label_encoder, pool)
+            self._write_partition_('test', class_names_test, images_path_test, label_encoder, pool)
+            self._write_partition_('val', class_names_val, images_path_val, label_encoder, pool)
+        finally:
+            pool.close()
+            pool.join()
+
+        label_encoder_ids = {}
+        keys = [label_encoder[key] for key in keys_train] + [label_encoder[key] for key in keys_test]
         for id_key, key in enumerate(keys):
-            label_encoder[key] = id_key
+            label_encoder_ids[key] = id_key
         with open(os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_label_encoder.pickle'), 'wb') as handle:
-            pickle.dump(label_encoder, handle, protocol=2)
+            pickle.dump(label_encoder_ids, handle, protocol=2)
 
         logger.info('Images preprocessed')
 
-    def load_dataset(self, partition, size=(84, 84)):
+    def _load_partition_(self, partition):
+        # mmap_mode='r' keeps the images in the page cache, shared by every process reading them.
+        images = np.load(self._images_file_(partition), mmap_mode='r')
+        with open(self._index_file_(partition), 'rb') as handle:
+            index = pickle.load(handle)
+        return images, index['offsets'], index['classes']
+
+    def load_dataset(self, partition, size=IMAGE_SIZE):
+        """
+        Returns:
+            images: uint8 [num_images, H, W, 3] array sorted by class, memory-mapped
+                unless it had to be merged or resized. Use :func:`normalize` on the
+                gathered images.
+            offsets: images of the i-th class are ``images[offsets[i]:offsets[i + 1]]``.
+            classes: label of each class.
+            label_encoder:
+        """
         logger.info("Loading dataset")
         if partition == 'train_val':
-            with open(os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_%s.pickle' % 'train'),
-                      'rb') as handle:
-                data = pickle.load(handle)
-            with open(os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_%s.pickle' % 'val'),
-                      'rb') as handle:
-                data_val = pickle.load(handle)
-            data.update(data_val)
-            del data_val
+            images, offsets, classes = self._load_partition_('train')
+            images_val, offsets_val, classes_val = self._load_partition_('val')
+            images = np.concatenate([images, images_val])
+            offsets = np.concatenate([offsets, offsets_val[1:] + offsets[-1]])
+            classes = list(classes) + list(classes_val)
         else:
-            with open(os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_%s.pickle' % partition),
-                      'rb') as handle:
-                data = pickle.load(handle)
+            images, offsets, classes = self._load_partition_(partition)
 
         with open(os.path.join(self.root, 'compacted_datasets', 'mini_imagenet_label_encoder.pickle'),
                   'rb') as handle:
             label_encoder = pickle.load(handle)
 
-        # Resize images and normalize
-        for class_ in data:
-            for i in range(len(data[class_])):
-                image2resize = pil_image.fromarray(np.uint8(data[class_][i]))
-                image_resized = image2resize.resize((size[1], size[0]))
-                image_resized = np.array(image_resized, dtype='float32')
-
-                # Normalize
-                image_resized = np.transpose(image_resized, (2, 0, 1))
-                image_resized[0, :, :] -= 120.45  # R
-                image_resized[1, :, :] -= 115.74  # G
-                image_resized[2, :, :] -= 104.65  # B
-                image_resized /= 127.5
-
-                data[class_][i] = image_resized
-
-        logger.info("Num classes " + str(len(data)))
-        num_images = 0
-        for class_ in data:
-            num_images += len(data[class_])
-        logger.info("Num images " + str(num_images))
-        return data, label_encoder
+        if tuple(size) != images.shape[1:3]:
+            logger.warn("Resizing images to {}, the dataset will be kept in memory".format(size))
+            images = np.stack([np.array(pil_image.fromarray(img).resize((size[1], size[0])))
+                               for img in images])
+
+        logger.info("Num classes " + str(len(classes)))
+        logger.info("Num images " + str(len(images)))
+        return images, offsets, classes, label_encoder
+
+
+def _load_image_(path):
+    img = pil_image.open(path)
+    img = img.convert('RGB')
+    img = img.resize((IMAGE_SIZE[1], IMAGE_SIZE[0]), pil_image.ANTIALIAS)
+    return np.array(img, dtype=np.uint8)
+
+
+def normalize(images):
+    """
+    uint8 [n, H, W, 3] RGB images -> normalized float32 [n, 3, H, W].
+    """
+    images = np.transpose(images, (0, 3, 1, 2)).astype('float32')
+    images -= MEAN_RGB
+    images /= 127.5
+    return images
@@ -140,7 +140,4 @@ class Omniglot(data.Dataset):
         return data_rot
 
     def rotate_image(self, image, times):
-        rotated_image = np.zeros(image.shape)
-        for channel in range(image.shape[0]):
-            rotated_image[:, :] = np.rot90(image[:, :], k=times)
-        return rotated_image
\ No newline at end of file
+        return np.rot90(image, k=times)
\ No newline at end of file
@@ -61,6 +61,8 @@ parser.add_argument('--dataset', type=str, default='mini_imagenet', metavar='N',
                     help='omniglot')
 parser.add_argument('--dec_lr', type=int, default=15000, metavar='N',
                     help='Decreasing the learning rate every x iterations')
+parser.add_argument('--edge_chunk', type=int, default=0, metavar='N',
+                    help='Compute test-time GNN edges in chunks of N rows to bound memory (0: no chunking)')
 args = parser.parse_args()
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -20,14 +20,10 @@ def gmul(input):
     W, x = input
     # x is a tensor of size (bs, N, num_features). [40, 26, 181]
     # W is a tensor of size (bs, N, N, J), [40, 26, 26, 2]
-    x_size = x.size()
-    W_size = W.size()
-    N = W_size[-2]
-    W = W.split(1, 3)
-    W = torch.cat(W, 1).squeeze(3) # W is now a tensor of size (bs, J*N, N)   x is a tensor of size (bs, N, num_features)
-    output = torch.bmm(W, x) # output has size (bs, J*N, num_features)
-    output = output.split(N, 1) #spli into  a list with length=J, size: [bs, N, num_features]
-    output = torch.cat(output, 2) # output has size (bs, N, J*num_features)
+    bs, N, J = W.size(0), W.size(1), W.size(3)
+    # one batched matmul over all J operators instead of split/cat along J
+    output = torch.matmul(W.permute(0, 3, 1, 2), x.unsqueeze(1)) # output has size (bs, J, N, num_features)
+    output = output.transpose(1, 2).contiguous().view(bs, N, J * x.size(2)) # output has size (bs, N, J*num_features)
     return output
 
 
@@ -61,8 +57,9 @@ class Gconv(nn.Module):
 
 
 class Wcompute(nn.Module):
-    def __init__(self, input_features, nf, operator='J2', activation='softmax', ratio=[2,2,1,1], num_operators=1, drop=False):
+    def __init__(self, input_features, nf, operator='J2', activation='softmax', ratio=[2,2,1,1], num_operators=1, drop=False, chunk_size=None):
         super(Wcompute, self).__init__()
+        self.chunk_size = chunk_size
         logger.info("Wcompute activation type: {}".format(activation))
         self.num_features = nf
         self.operator = operator
@@ -80,34 +77,38 @@ class Wcompute(nn.Module):
         self.conv2d_last = nn.Conv2d(nf, num_operators, 1, stride=1)
         self.activation = activation
 
-    def forward(self, x, W_id):
-        #x : [40, 26, 133]
-        #W_id:[40, 26, 26, 1]
-        W1 = x.unsqueeze(2)
-        W2 = torch.transpose(W1, 1, 2) #size: bs x N x N x num_features
-        W_new = torch.abs(W1 - W2) #size: bs x N x N x num_features
-        W_new = torch.transpose(W_new, 1, 3) #size: bs x num_features x N x N
-
-        W_new = self.conv2d_1(W_new)
-        W_new = self.bn_1(W_new)
-        W_new = F.leaky_relu(W_new)
-        if self.drop:
-            W_new = self.dropout(W_new)
+    def _pointwise_(self, W, conv, bn=None):
+        # 1x1 conv (+ BN) applied on the channels-last edge tensor, no transposes
+        W_size = list(W.size())
+        W = F.linear(W.view(-1, W_size[-1]), conv.weight.view(conv.weight.size(0), -1), conv.bias)
+        if bn is not None:
+            W = F.batch_norm(W, bn.running_mean, bn.running_var, bn.weight, bn.bias,
+                             bn.training, bn.momentum, bn.eps)
+        return W.view(*(W_size[:-1] + [-1]))
 
-        W_new = self.conv2d_2(W_new)
-        W_new = self.bn_2(W_new)
-        W_new = F.leaky_relu(W_new)
+    def edge_logits(self, x_i, x_j):
+        W_new = torch.abs(x_i.unsqueeze(2) - x_j.unsqueeze(1)) #size: bs x n_i x N x num_features
 
-        W_new = self.conv2d_3(W_new)
-        W_new = self.bn_3(W_new)
-        W_new = F.leaky_relu(W_new)
+        W_new = F.leaky_relu(self._pointwise_(W_new, self.conv2d_1, self.bn_1))
+        if self.drop:
+            W_new = self.dropout(W_new)
+        W_new = F.leaky_relu(self._pointwise_(W_new, self.conv2d_2, self.bn_2))
+        W_new = F.leaky_relu(self._pointwise_(W_new, self.conv2d_3, self.bn_3))
+        W_new = F.leaky_relu(self._pointwise_(W_new, self.conv2d_4, self.bn_4))
 
-        W_new = self.conv2d_4(W_new)
-        W_new = self.bn_4(W_new)
-        W_new = F.leaky_relu(W_new)
+        return self._pointwise_(W_new, self.conv2d_last) #size: bs x n_i x N x num_operators
 
-        W_new = self.conv2d_last(W_new)
-        W_new = torch.transpose(W_new, 1, 3) #size: bs x N x N x 1
+    def forward(self, x, W_id):
+        #x : [40, 26, 133]
+        #W_id:[40, 26, 26, 1]
+        # whole modules are saved with torch.save, older ones have no chunk_size
+        if self.training or not getattr(self, 'chunk_size', None):
+            W_new = self.edge_logits(x, x)
+        else:
+            # BN uses running statistics at test time, so rows of the edge matrix
+            # can be computed independently and only bs x chunk x N x F is alive at once.
+            W_new = torch.cat([self.edge_logits(x[:, i:i + self.chunk_size], x)
+                               for i in range(0, x.size(1), self.chunk_size)], 1)
 
         if self.activation == 'softmax':
             W_new = W_new - W_id.expand_as(W_new) * 1e8
@@ -143,6 +144,8 @@ class GNN_nl_omniglot(nn.Module):
     def __init__(self, args, input_features, nf, J):
         super(GNN_nl_omniglot, self).__init__()
         self.args = args
+        # rows per chunk of the test-time edge computation, 0: no chunking
+        self.edge_chunk = getattr(args, 'edge_chunk', 0)
         self.input_features = input_features
         self.nf = nf
         self.J = J
@@ -151,14 +154,14 @@ class GNN_nl_omniglot(nn.Module):
         for i in range(self.num_layers):
             module_w = Wcompute(self.input_features + int(nf / 2) * i,
                                 self.input_features + int(nf / 2) * i,
-                                operator='J2', activation='softmax', ratio=[2, 1.5, 1, 1], drop=False)
+                                operator='J2', activation='softmax', ratio=[2, 1.5, 1, 1], drop=False, chunk_size=self.edge_chunk)
             module_l = Gconv(self.input_features + int(nf / 2) * i, int(nf / 2), 2)
             self.add_module('layer_w{}'.format(i), module_w)
             self.add_module('layer_l{}'.format(i), module_l)
 
         self.w_comp_last = Wcompute(self.input_features + int(self.nf / 2) * self.num_layers,
                                     self.input_features + int(self.nf / 2) * (self.num_layers - 1),
-                                    operator='J2', activation='softmax', ratio=[2, 1.5, 1, 1], drop=True)
+                                    operator='J2', activation='softmax', ratio=[2, 1.5, 1, 1], drop=True, chunk_size=self.edge_chunk)
         self.layer_last = Gconv(self.input_features + int(self.nf / 2) * self.num_layers, args.train_N_way, 2, bn_bool=True)
 
     def forward(self, x):
@@ -182,6 +185,8 @@ class GNN_nl(nn.Module):
     def __init__(self, args, input_features, nf, J):
         super(GNN_nl, self).__init__()
         self.args = args
+        # rows per chunk of the test-time edge computation, 0: no chunking
+        self.edge_chunk = getattr(args, 'edge_chunk', 0)
         self.input_features = input_features
         self.nf = nf
         self.J = J
@@ -193,15 +198,15 @@ class GNN_nl(nn.Module):
 
         for i in range(self.num_layers):
             if i == 0:
-                module_w = Wcompute(self.input_features, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1])
+                module_w = Wcompute(self.input_features, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1], chunk_size=self.edge_chunk)
                 module_l = Gconv(self.input_features, int(nf / 2), 2)
             else:
-                module_w = Wcompute(self.input_features + int(nf / 2) * i, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1])
+                module_w = Wcompute(self.input_features + int(nf / 2) * i, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1], chunk_size=self.edge_chunk)
                 module_l = Gconv(self.input_features + int(nf / 2) * i, int(nf / 2), 2)
             self.add_module('layer_w{}'.format(i), module_w)
             self.add_module('layer_l{}'.format(i), module_l)
 
-        self.w_comp_last = Wcompute(self.input_features + int(self.nf / 2) * self.num_layers, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1])
+        self.w_comp_last = Wcompute(self.input_features + int(self.nf / 2) * self.num_layers, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1], chunk_size=self.edge_chunk)
         self.layer_last = Gconv(self.input_features + int(self.nf / 2) * self.num_layers, args.train_N_way, 2, bn_bool=False)
 
     def forward(self, x):#[40, 26, 133]
@@ -224,6 +229,8 @@ class GNN_active(nn.Module):
     def __init__(self, args, input_features, nf, J):
         super(GNN_active, self).__init__()
         self.args = args
+        # rows per chunk of the test-time edge computation, 0: no chunking
+        self.edge_chunk = getattr(args, 'edge_chunk', 0)
         self.input_features = input_features
         self.nf = nf
         self.J = J
@@ -231,10 +238,10 @@ class GNN_active(nn.Module):
         self.num_layers = 2
         for i in range(self.num_layers // 2):
             if i == 0:
-                module_w = Wcompute(self.input_features, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1])
+                module_w = Wcompute(self.input_features, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1], chunk_size=self.edge_chunk)
                 module_l = Gconv(self.input_features, int(nf / 2), 2)
             else:
-                module_w = Wcompute(self.input_features + int(nf / 2) * i, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1])
+                module_w = Wcompute(self.input_features + int(nf / 2) * i, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1], chunk_size=self.edge_chunk)
                 module_l = Gconv(self.input_features + int(nf / 2) * i, int(nf / 2), 2)
 
             self.add_module('layer_w{}'.format(i), module_w)
@@ -246,15 +253,15 @@ class GNN_active(nn.Module):
 
         for i in range(int(self.num_layers/2), self.num_layers):
             if i == 0:
-                module_w = Wcompute(self.input_features, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1])
+                module_w = Wcompute(self.input_features, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1], chunk_size=self.edge_chunk)
                 module_l = Gconv(self.input_features, int(nf / 2), 2)
             else:
-                module_w = Wcompute(self.input_features + int(nf / 2) * i, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1])
+                module_w = Wcompute(self.input_features + int(nf / 2) * i, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1], chunk_size=self.edge_chunk)
                 module_l = Gconv(self.input_features + int(nf / 2) * i, int(nf / 2), 2)
             self.add_module('layer_w{}'.format(i), module_w)
             self.add_module('layer_l{}'.format(i), module_l)
 
-        self.w_comp_last = Wcompute(self.input_features + int(self.nf / 2) * self.num_layers, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1])
+        self.w_comp_last = Wcompute(self.input_features + int(self.nf / 2) * self.num_layers, nf, operator='J2', activation='softmax', ratio=[2, 2, 1, 1], chunk_size=self.edge_chunk)
         self.layer_last = Gconv(self.input_features + int(self.nf / 2) * self.num_layers, args.train_N_way, 2, bn_bool=False)
 
     def active(self, x, oracles_yi, hidden_labels):
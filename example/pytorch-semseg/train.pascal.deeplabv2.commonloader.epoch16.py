@@ -20,6 +20,7 @@ from ptsemseg.loss import *
 from ptsemseg.augmentations import *
 from tqdm import tqdm
 from pytorchgo.utils import logger
+from pytorchgo.utils.checkpoint import CheckpointManager
 from pytorchgo.utils.pytorch_utils import optimizer_summary
 from pytorchgo.utils.learning_rate import adjust_learning_rate
 
@@ -128,20 +129,20 @@ def train(args):
         optimizer = torch.optim.SGD(model.optimizer_params(args.l_rate), lr=args.l_rate, momentum=0.99, weight_decay=5e-4)
 
     optimizer_summary(optimizer)
-    if args.resume is not None:                                         
+    # checkpoint.pth after every epoch, best_model.pth for the best mIoU, written in the background
+    checkpoints = CheckpointManager(logger.get_logger_dir(), filename="checkpoint.pth", best_filename="best_model.pth")
+    checkpoint_objects = {'model_state': model, 'optimizer_state': optimizer}
+    start_epoch = 0
+    best_iou = 0
+    if args.resume is not None:
         if os.path.isfile(args.resume):
-            logger.info("Loading model and optimizer from checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
-            model.load_state_dict(checkpoint['model_state'])
-            optimizer.load_state_dict(checkpoint['optimizer_state'])
-            logger.info("Loaded checkpoint '{}' (epoch {})"
-                  .format(args.resume, checkpoint['epoch']))
+            state = checkpoints.restore(checkpoint_objects, path=args.resume)
+            start_epoch, best_iou = state['epoch'], state['mIoU']
         else:
             logger.info("No checkpoint found at '{}'".format(args.resume))
 
-    best_iou = 0
     logger.info('start!!')
-    for epoch in tqdm(range(args.n_epoch),total=args.n_epoch):
+    for epoch in tqdm(range(start_epoch, args.n_epoch), initial=start_epoch, total=args.n_epoch):
         model.train()
         for i, (images, labels) in tqdm(enumerate(trainloader),total=len(trainloader), desc="training epoch {}/{}".format(epoch, args.n_epoch)):
             if i > 10 and is_debug==1: break
@@ -172,13 +173,9 @@ def train(args):
 
 
         cur_miou = get_validation_miou(model)
-        if cur_miou >= best_iou:
-            best_iou = cur_miou
-            state = {'epoch': epoch+1,
-                     'mIoU': best_iou,
-                     'model_state': model.state_dict(),
-                     'optimizer_state' : optimizer.state_dict(),}
-            torch.save(state, os.path.join(logger.get_logger_dir(), "best_model.pth"))
+        best_iou = max(best_iou, cur_miou)
+        checkpoints.save(checkpoint_objects, step=epoch+1, metric=cur_miou, epoch=epoch+1, mIoU=best_iou)
+    checkpoints.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Hyperparams')
@@ -16,6 +16,7 @@ from ptsemseg.loader import get_loader, get_data_path
 from ptsemseg.metrics import runningScore
 from ptsemseg.loss import *
 from ptsemseg.augmentations import *
+from pytorchgo.utils.checkpoint import CheckpointManager
 
 def train(args):
 
@@ -65,19 +66,21 @@ def train(args):
     else:
         loss_fn = cross_entropy2d
 
+    # saved after every epoch in the background, the best model is kept apart
+    checkpoints = CheckpointManager('.', filename="{}_{}_checkpoint.pkl".format(args.arch, args.dataset),
+                                    best_filename="{}_{}_best_model.pkl".format(args.arch, args.dataset))
+    checkpoint_objects = {'model_state': model, 'optimizer_state': optimizer}
+    start_epoch = 0
+    best_iou = -100.0 
     if args.resume is not None:                                         
         if os.path.isfile(args.resume):
-            print("Loading model and optimizer from checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
-            model.load_state_dict(checkpoint['model_state'])
-            optimizer.load_state_dict(checkpoint['optimizer_state'])
-            print("Loaded checkpoint '{}' (epoch {})"                    
-                  .format(args.resume, checkpoint['epoch']))
+            state = checkpoints.restore(checkpoint_objects, path=args.resume)
+            start_epoch = state['epoch']
+            best_iou = state.get('best_iou', best_iou)
         else:
             print("No checkpoint found at '{}'".format(args.resume)) 
 
-    best_iou = -100.0 
-    for epoch in range(args.n_epoch):
+    for epoch in range(start_epoch, args.n_epoch):
         model.train()
         for i, (images, labels) in enumerate(trainloader):
             images = Variable(images.cuda())
@@ -116,12 +119,10 @@ def train(args):
             print(k, v)
         running_metrics.reset()
 
-        if score['Mean IoU : \t'] >= best_iou:
-            best_iou = score['Mean IoU : \t']
-            state = {'epoch': epoch+1,
-                     'model_state': model.state_dict(),
-                     'optimizer_state' : optimizer.state_dict(),}
-            torch.save(state, "{}_{}_best_model.pkl".format(args.arch, args.dataset))
+        best_iou = max(best_iou, score['Mean IoU : \t'])
+        checkpoints.save(checkpoint_objects, step=epoch+1, metric=score['Mean IoU : \t'],
+                         epoch=epoch+1, best_iou=best_iou)
+    checkpoints.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Hyperparams')
@@ -4,17 +4,17 @@ from layers.modules import MultiBoxLoss
 from ssd import build_ssd
 import os
 import sys
-import time
 import torch
 from torch.autograd import Variable
 import torch.nn as nn
 import torch.optim as optim
 import torch.backends.cudnn as cudnn
 import torch.nn.init as init
-import torch.utils.data as data
 import numpy as np
 import argparse
 from pytorchgo.utils import logger
+from pytorchgo.utils.checkpoint import CheckpointManager
+from pytorchgo.dataloader import infinite_loader
 from tqdm import tqdm
 
 def str2bool(v):
@@ -36,6 +36,8 @@ parser.add_argument('--resume', default=None, type=str,
                     help='Checkpoint state_dict file to resume training from')
 parser.add_argument('--start_iter', default=0, type=int,
                     help='Resume training at this iter')
+parser.add_argument('--resume_training', action='store_true',
+                    help='Continue from the last checkpoint in the log directory: weights, optimizer, iteration and data order')
 parser.add_argument('--num_workers', default=4, type=int,
                     help='Number of workers used in dataloading')
 parser.add_argument('--cuda', default=True, type=str2bool,
@@ -52,6 +54,8 @@ parser.add_argument('--visdom', default=False, type=str2bool,
                     help='Use visdom for loss visualization')
 parser.add_argument('--gpu', default=0, type=int,
                     help='gpu')
+parser.add_argument('--profile_sync', default=False, type=str2bool,
+                    help='Synchronize CUDA in the step profiler, for exact per-phase times')
 args = parser.parse_args()
 
 os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
@@ -98,7 +102,9 @@ def train():
         #net = torch.nn.DataParallel(ssd_net), if only one gpu, just comment it!!
         cudnn.benchmark = True
 
-    if args.resume:
+    if args.resume_training:
+        pass  # restored with the optimizer below
+    elif args.resume:
         logger.info('Resuming training, loading {}...'.format(args.resume))
         ssd_net.load_weights(args.resume)
     else:
@@ -109,7 +115,7 @@ def train():
     if args.cuda:
         net = net.cuda()
 
-    if not args.resume:
+    if not args.resume and not args.resume_training:
         logger.info('Initializing weights...')
         # initialize newly added layers' weights with xavier method
         ssd_net.extras.apply(weights_init)
@@ -134,6 +140,7 @@ def train():
     logger.info(args)
 
     step_index = 0
+    start_iter = args.start_iter
 
     if args.visdom:
         vis_title = 'SSD.PyTorch on ' + dataset.name
@@ -141,15 +148,24 @@ def train():
         iter_plot = create_vis_plot('Iteration', 'Loss', vis_title, vis_legend)
         epoch_plot = create_vis_plot('Epoch', 'Loss', vis_title, vis_legend)
 
-    data_loader = data.DataLoader(dataset, args.batch_size,
+    # endless: no restart at the end of the dataset, and the position can be checkpointed
+    data_loader = infinite_loader(dataset, args.batch_size,
                                   num_workers=args.num_workers,
-                                  shuffle=True, collate_fn=detection_collate,
+                                  collate_fn=detection_collate,
                                   pin_memory=True)
 
+    # periodic snapshots are written in the background
+    checkpoints = CheckpointManager(logger.get_logger_dir())
+    checkpoint_objects = {'model': ssd_net, 'optimizer': optimizer, 'sampler': data_loader.sampler}
+    if args.resume_training:
+        state = checkpoints.restore(checkpoint_objects)
+        start_iter, step_index = state['iteration'] + 1, state['step_index']
+    data_loader.sampler.skip(start_iter * args.batch_size)
 
     # create batch iterator
     batch_iterator = iter(data_loader)
-    for iteration in tqdm(range(args.start_iter, cfg['max_iter'])):
+    profiler = logger.StepProfiler('train', log_interval=100, sync=args.cuda and args.profile_sync)
+    for iteration in tqdm(range(start_iter, cfg['max_iter'])):
         if args.visdom and iteration != 0 and (iteration % epoch_size == 0):
             update_vis_plot(epoch, loc_loss, conf_loss, epoch_plot, None,
                             'append', epoch_size)
@@ -163,36 +179,34 @@ def train():
             adjust_learning_rate(optimizer, args.gamma, step_index)
 
         # load train data
-        #images, targets = next(batch_iterator)
-        #https://github.com/amdegroot/ssd.pytorch/issues/140
-        try:
-            images, targets = next(batch_iterator)
-        except StopIteration:
-            batch_iterator = iter(data_loader)
+        with profiler.scope('data'):
             images, targets = next(batch_iterator)
 
-        if args.cuda:
-            images = Variable(images.cuda())
-            targets = [Variable(ann.cuda(), volatile=True) for ann in targets]
-        else:
-            images = Variable(images)
-            targets = [Variable(ann, volatile=True) for ann in targets]
-        # forward
-        t0 = time.time()
-        out = net(images)
+        with profiler.scope('h2d'):
+            if args.cuda:
+                images = Variable(images.cuda())
+                targets = [Variable(ann.cuda(), volatile=True) for ann in targets]
+            else:
+                images = Variable(images)
+                targets = [Variable(ann, volatile=True) for ann in targets]
+        with profiler.scope('forward'):
+            out = net(images)
+        with profiler.scope('loss'):
+            loss_l, loss_c = criterion(out, targets)
+            loss = loss_l + loss_c
         # backprop
-        optimizer.zero_grad()
-        loss_l, loss_c = criterion(out, targets)
-        loss = loss_l + loss_c
-        loss.backward()
-        optimizer.step()
-        t1 = time.time()
-        loc_loss += loss_l.data[0]
-        conf_loss += loss_c.data[0]
-
-        if iteration % 10 == 0:
-            logger.info('timer: {} sec.'.format(t1 - t0))
-            logger.info('iter {}/{} || Loss: {} ||'.format(repr(iteration), cfg['max_iter'], loss.data[0]))
+        with profiler.scope('backward'):
+            optimizer.zero_grad()
+            loss.backward()
+        with profiler.scope('optimizer'):
+            optimizer.step()
+        with profiler.scope('logging'):
+            loc_loss += loss_l.data[0]
+            conf_loss += loss_c.data[0]
+
+            if iteration % 10 == 0:
+                logger.info('iter {}/{} || Loss: {} ||'.format(repr(iteration), cfg['max_iter'], loss.data[0]))
+        profiler.step(loc_loss=loss_l.data[0], conf_loss=loss_c.data[0])
 
         if args.visdom:
             update_vis_plot(iteration, loss_l.data[0], loss_c.data[0],
@@ -200,9 +214,11 @@ def train():
 
         if iteration != 0 and iteration % 5000 == 0:
             logger.info('Saving state, iter: {}'.format(iteration))
-            torch.save(ssd_net.state_dict(), os.path.join(logger.get_logger_dir(),'ssd300_{}_{}.pth'.format(args.dataset, repr(iteration))))
-    torch.save(ssd_net.state_dict(),
-               os.path.join(logger.get_logger_dir(), args.dataset + '.pth'))
+            checkpoints.write(ssd_net.state_dict(), 'ssd300_{}_{}.pth'.format(args.dataset, repr(iteration)))
+            checkpoints.save(checkpoint_objects, step=iteration, iteration=iteration, step_index=step_index)
+    profiler.close()
+    checkpoints.write(ssd_net.state_dict(), args.dataset + '.pth')
+    checkpoints.close()
 
 
 def adjust_learning_rate(optimizer, gamma, step):
@@ -258,5 +274,5 @@ def update_vis_plot(iteration, loc, conf, window1, window2, update_type,
 
 
 if __name__ == '__main__':
-    logger.auto_set_dir()
+    logger.auto_set_dir(action='k' if args.resume_training else None)
     train()
@@ -1 +1,5 @@
-# Author: Tao Hu <taohu620@gmail.com>
\ No newline at end of file
+# Author: Tao Hu <taohu620@gmail.com>
+
+from .tensor_transforms import resize_images
+from .tensor_transforms import resize_labels
+from .tensor_transforms import DiscriminatorInput
@@ -0,0 +1,110 @@
+# Author: Tao Hu <taohu620@gmail.com>
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+__all__ = ['resize_images', 'resize_labels', 'DiscriminatorInput']
+
+
+def _nearest_index(in_size, out_size, like):
+    # same sampling grid as PIL NEAREST: floor((i + 0.5) * in / out)
+    index = ((np.arange(out_size) + 0.5) * in_size / float(out_size)).astype(np.int64)
+    index = torch.from_numpy(np.minimum(index, in_size - 1))
+    if like.is_cuda:
+        index = index.cuda(like.get_device())
+    return index
+
+
+def _unwrap(x):
+    return x.data if isinstance(x, Variable) else x
+
+
+def resize_images(images, size, mode='area'):
+    """
+    Batched resize of N x C x H x W images, on the device of the input.
+
+    Args:
+        images: float tensor or Variable.
+        size: (w, h), PIL order.
+        mode(str): 'area' (average pooling, anti-aliased, for downsampling),
+            'bilinear' or 'nearest'.
+
+    Returns:
+        same type as ``images``.
+    """
+    w, h = size
+    if tuple(images.size()[2:]) == (h, w):
+        return images
+    if mode == 'nearest':
+        data = _unwrap(images)
+        rows = _nearest_index(data.size(2), h, data)
+        cols = _nearest_index(data.size(3), w, data)
+        if isinstance(images, Variable):
+            rows, cols = Variable(rows), Variable(cols)
+        return images.index_select(2, rows).index_select(3, cols)
+
+    is_tensor = not isinstance(images, Variable)
+    x = Variable(images, volatile=True) if is_tensor else images
+    if mode == 'area':
+        x = F.adaptive_avg_pool2d(x, (h, w))
+    elif mode == 'bilinear':
+        x = F.upsample(x, size=(h, w), mode='bilinear')
+    else:
+        raise ValueError("Unknown resize mode: {}".format(mode))
+    return x.data if is_tensor else x
+
+
+def resize_labels(labels, size):
+    """
+    Nearest-neighbour resize of N x H x W (or H x W) label maps of any integer type,
+    done by indexing so no float round-trip is involved.
+
+    Args:
+        labels: tensor or Variable.
+        size: (w, h), PIL order.
+    """
+    labels = _unwrap(labels)
+    w, h = size
+    rows = _nearest_index(labels.size(-2), h, labels)
+    cols = _nearest_index(labels.size(-1), w, labels)
+    return labels.index_select(labels.dim() - 2, rows).index_select(labels.dim() - 1, cols)
+
+
+class DiscriminatorInput(nn.Module):
+    """
+    Turn a batch of mean-subtracted images into discriminator inputs in [0, 1]:
+    add the mean back, resize and scale, without leaving the device.
+    The channel order of the input is kept.
+
+    Examples:
+
+    .. code-block:: python
+
+        to_d = DiscriminatorInput(size=(512, 256), mean=dataset.mean_bgr)
+        d_input = to_d(source_data)
+    """
+
+    def __init__(self, size=None, mean=None, mode='area', scale=1 / 255.0):
+        super(DiscriminatorInput, self).__init__()
+        self.size = size
+        self.mode = mode
+        self.scale = scale
+        if mean is None:
+            self.mean = None
+        else:
+            self.register_buffer('mean', torch.from_numpy(np.asarray(mean, dtype=np.float32)).view(1, -1, 1, 1))
+
+    def forward(self, images):
+        data = _unwrap(images).float()
+        if data.dim() == 3:
+            data = data.unsqueeze(0)
+        if self.mean is not None:
+            if data.is_cuda and not self.mean.is_cuda:
+                self.mean = self.mean.cuda(data.get_device())
+            data = (data + self.mean).clamp_(0, 255)
+        if self.size is not None:
+            data = resize_images(data, self.size, mode=self.mode)
+        data = data * self.scale
+        return Variable(data) if isinstance(images, Variable) else data
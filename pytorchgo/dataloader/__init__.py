@@ -1 +1,17 @@
-# Author: Tao Hu <taohu620@gmail.com>
\ No newline at end of file
+# Author: Tao Hu <taohu620@gmail.com>
+
+from .label_mapping import CITYSCAPES_ID_TO_TRAINID
+from .label_mapping import compile_label_lut
+from .label_mapping import LabelMapper
+from .label_mapping import get_label_mapper
+from .label_mapping import convert_label_dir
+
+from .prefetch import PrefetchIterator
+from .prefetch import InfiniteSampler
+from .prefetch import infinite_loader
+from .prefetch import to_cuda
+
+from .packed import pack_segmentation_dataset
+from .packed import PackedSegDataset
+
+from .image_pool import ImagePool
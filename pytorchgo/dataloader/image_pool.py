@@ -0,0 +1,95 @@
+# Author: Tao Hu <taohu620@gmail.com>
+
+import os
+import random
+import multiprocessing
+import numpy as np
+import torch
+
+__all__ = ['ImagePool']
+
+
+class ImagePool(object):
+    """
+    In-memory pool of images indexed by class folder, for few-shot episodes. Every image of
+    ``folders`` is decoded once, in parallel, into a single uint8 [N,H,W,C] tensor in shared
+    memory, so data loader workers can read it without a copy. Tasks are built by index
+    gathering instead of a DataLoader per episode.
+
+    Examples:
+
+    .. code-block:: python
+
+        def load_image(path):   # module level, it runs in worker processes
+            return np.array(Image.open(path).convert('RGB'), dtype=np.uint8)
+
+        pool = ImagePool(metatrain_folders, load_image, mean=0.92206, std=0.08426)
+        samples, sample_labels, batches, batch_labels = pool.sample_task(5, 1, 15)
+    """
+
+    def __init__(self, folders, load_fn, mean=0., std=1., num_workers=None):
+        """
+        Args:
+            folders(list): one folder of images per class.
+            load_fn: function path -> uint8 np.ndarray [H,W] or [H,W,C], the same size for
+                all the images. It must be picklable.
+            mean, std: of the ``Normalize`` applied after ``ToTensor`` (images in [0, 1]),
+                a number or one value per channel.
+            num_workers(int): decoding processes, all the cpus by default.
+        """
+        self.folders = folders
+        paths = []
+        self.offsets = [0]
+        for c in folders:
+            paths += [os.path.join(c, x) for x in sorted(os.listdir(c))]
+            self.offsets.append(len(paths))
+        self.offsets = np.array(self.offsets)
+
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            images = pool.map(load_fn, paths, chunksize=256)
+        finally:
+            pool.close()
+            pool.join()
+        images = np.stack(images)
+        if images.ndim == 3:
+            images = images[..., np.newaxis]
+        self.images = torch.from_numpy(images).share_memory_()
+        self.mean = torch.FloatTensor(np.broadcast_to(mean, images.shape[-1:]).copy()).view(1, -1, 1, 1)
+        self.std = torch.FloatTensor(np.broadcast_to(std, images.shape[-1:]).copy()).view(1, -1, 1, 1)
+
+    def sample_task(self, num_classes, train_num, test_num, shuffle=True, rotation=0):
+        """
+        Returns:
+            the same tensors as the sample (shuffle=False) and batch data loaders of a task:
+            samples [num_classes*train_num,C,H,W] grouped by class, batches
+            [num_classes*test_num,C,H,W] shuffled if ``shuffle``, and their labels.
+            ``rotation`` is in degrees, see :meth:`gather`.
+        """
+        classes = random.sample(range(len(self.folders)), num_classes)
+        index = np.stack([self.offsets[c] + np.random.permutation(self.offsets[c + 1] - self.offsets[c])[:train_num + test_num]
+                          for c in classes])
+        labels = np.repeat(np.arange(num_classes), train_num + test_num).reshape(num_classes, -1)
+
+        train_index, train_labels = index[:, :train_num].ravel(), labels[:, :train_num].ravel()
+        test_index, test_labels = index[:, train_num:].ravel(), labels[:, train_num:].ravel()
+        if shuffle:
+            perm = np.random.permutation(len(test_index))
+            test_index, test_labels = test_index[perm], test_labels[perm]
+
+        return (self.gather(train_index, rotation), torch.from_numpy(train_labels),
+                self.gather(test_index, rotation), torch.from_numpy(test_labels))
+
+    def gather(self, index, rotation=0):
+        """
+        Returns:
+            FloatTensor [len(index),C,H,W] of the images at ``index``, as ``ToTensor`` and
+            ``Normalize(mean, std)`` would give. A multiple of 90 ``rotation`` turns square
+            images counter-clockwise, like a PIL rotate.
+        """
+        images = self.images.index_select(0, torch.from_numpy(index))
+        if rotation % 360:
+            assert rotation % 90 == 0, rotation
+            images = torch.from_numpy(np.ascontiguousarray(np.rot90(images.numpy(), rotation // 90, axes=(1, 2))))
+        images = images.permute(0, 3, 1, 2).contiguous().float().div_(255)
+        return images.sub_(self.mean).div_(self.std)
@@ -0,0 +1,150 @@
+# Author: Tao Hu <taohu620@gmail.com>
+import os
+import multiprocessing
+import numpy as np
+import torch
+from PIL import Image
+
+from ..utils import logger
+from ..utils.fs import mkdir_p
+
+__all__ = ['CITYSCAPES_ID_TO_TRAINID', 'compile_label_lut', 'LabelMapper', 'get_label_mapper', 'convert_label_dir']
+
+# Cityscapes labelIds -> trainIds, also used for GTA5 labels.
+CITYSCAPES_ID_TO_TRAINID = {7: 0, 8: 1, 11: 2, 12: 3, 13: 4, 17: 5,
+                            19: 6, 20: 7, 21: 8, 22: 9, 23: 10, 24: 11, 25: 12,
+                            26: 13, 27: 14, 28: 15, 31: 16, 32: 17, 33: 18}
+
+
+def compile_label_lut(mapping, ignore_label=255, keep_unmapped=False, num_ids=256, dtype=np.uint8):
+    """
+    Compile an id -> trainId mapping into a lookup table.
+
+    Args:
+        mapping: dict, or a list/array of (id, trainId) pairs.
+        ignore_label(int): value of ids absent from ``mapping``.
+        keep_unmapped(bool): map absent ids to themselves instead of ``ignore_label``.
+        num_ids(int): number of entries of the table. Ids out of ``[0, num_ids)`` (e.g. the
+            ``[-1, 255]`` pair of the Cityscapes info files) can not occur in a label map
+            indexing the table and are skipped.
+        dtype: dtype of the table, i.e. of the remapped labels.
+
+    Returns:
+        np.ndarray: table of ``num_ids`` entries, ``lut[label]`` remaps a whole label map.
+    """
+    if isinstance(mapping, dict):
+        mapping = list(mapping.items())
+    if keep_unmapped:
+        lut = np.arange(num_ids)
+    else:
+        lut = np.full(num_ids, ignore_label, dtype=np.int64)
+    for k, v in mapping:
+        if 0 <= k < num_ids:
+            lut[int(k)] = v
+    if dtype == np.uint8:
+        assert lut.min() >= 0 and lut.max() <= 255, "trainIds must fit in uint8"
+    return lut.astype(dtype)
+
+
+class LabelMapper(object):
+    """
+    Remap label ids with a single table lookup instead of one masked write per id.
+
+    Works on PIL images and numpy arrays (returns an array of ``dtype``, label values out
+    of the table are left unchanged), and on torch tensors of any device (returns a tensor
+    of the same type as the input, values must be in the table).
+
+    Examples:
+
+    .. code-block:: python
+
+        mapper = LabelMapper(CITYSCAPES_ID_TO_TRAINID)
+        label = mapper(Image.open(label_path))          # in the loader
+        label = mapper(label_batch.cuda())             # or on-device
+    """
+
+    def __init__(self, mapping, ignore_label=255, keep_unmapped=False, dtype=np.uint8):
+        self.lut = compile_label_lut(mapping, ignore_label=ignore_label, keep_unmapped=keep_unmapped, dtype=dtype)
+        self._lut_tensors = {}
+
+    def _lut_like(self, label):
+        key = (type(label), label.get_device() if label.is_cuda else -1)
+        if key not in self._lut_tensors:
+            lut = torch.from_numpy(self.lut.astype(np.int64)).type(type(label))
+            if label.is_cuda:
+                lut = lut.cuda(label.get_device())
+            self._lut_tensors[key] = lut
+        return self._lut_tensors[key]
+
+    def __call__(self, label):
+        if torch.is_tensor(label):
+            index = label.contiguous().view(-1).long()
+            return self._lut_like(label).index_select(0, index).view_as(label)
+        label = np.asarray(label)
+        if label.dtype == np.uint8 and len(self.lut) >= 256:
+            return np.take(self.lut, label)
+        inside = (label >= 0) & (label < len(self.lut))
+        mapped = np.take(self.lut, np.where(inside, label, 0))
+        if inside.all():
+            return mapped
+        return np.where(inside, mapped, label)
+
+
+_label_mappers = {}
+
+
+def get_label_mapper(mapping, ignore_label=255, keep_unmapped=True, dtype=np.int64):
+    """
+    Returns:
+        LabelMapper: of ``mapping``, built on the first call and shared by the later ones
+        with the same arguments, for code that gets the mapping with every label.
+    """
+    key = (np.asarray(mapping, dtype=np.int64).tobytes(), ignore_label, keep_unmapped, np.dtype(dtype).str)
+    if key not in _label_mappers:
+        _label_mappers[key] = LabelMapper(mapping, ignore_label=ignore_label, keep_unmapped=keep_unmapped, dtype=dtype)
+    return _label_mappers[key]
+
+
+def _convert_label(args):
+    lut, src_path, dst_path = args
+    if os.path.isfile(dst_path):
+        return
+    label = np.asarray(Image.open(src_path))
+    Image.fromarray(np.take(lut, label)).save(dst_path)
+
+
+def convert_label_dir(src_dir, dst_dir, mapping, ignore_label=255, keep_unmapped=False,
+                      ext='.png', num_workers=None):
+    """
+    Remap every label image of ``src_dir`` once, in parallel, and save the results
+    with the same relative paths under ``dst_dir``. Loaders can then read trainIds
+    directly. Existing outputs are skipped, so an interrupted conversion can be resumed.
+
+    Args:
+        src_dir(str), dst_dir(str):
+        mapping: see :func:`compile_label_lut`.
+        ext(str): only files with this extension are converted.
+        num_workers(int): number of processes, defaults to the number of CPUs.
+
+    Returns:
+        int: number of label files found.
+    """
+    lut = compile_label_lut(mapping, ignore_label=ignore_label, keep_unmapped=keep_unmapped)
+    jobs = []
+    for root, _, files in os.walk(src_dir):
+        for f in files:
+            if not f.endswith(ext):
+                continue
+            src_path = os.path.join(root, f)
+            dst_path = os.path.join(dst_dir, os.path.relpath(src_path, src_dir))
+            mkdir_p(os.path.dirname(dst_path))
+            jobs.append((lut, src_path, dst_path))
+
+    logger.info("Converting {} label files from {} to {}".format(len(jobs), src_dir, dst_dir))
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        pool.map(_convert_label, jobs, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+    return len(jobs)
@@ -0,0 +1,169 @@
+# Author: Tao Hu <taohu620@gmail.com>
+
+import os
+import json
+import argparse
+import multiprocessing
+import numpy as np
+from PIL import Image
+from torch.utils import data
+
+from ..utils import logger
+from .label_mapping import LabelMapper, CITYSCAPES_ID_TO_TRAINID
+
+__all__ = ['pack_segmentation_dataset', 'PackedSegDataset']
+
+INDEX_FILE = 'index.json'
+
+
+def _load_pair(args):
+    image_path, label_path, size, label_mapper = args
+    image = np.asarray(Image.open(image_path).convert('RGB').resize(size, Image.BICUBIC), dtype=np.uint8)
+    label = Image.open(label_path).resize(size, Image.NEAREST)
+    label = label_mapper(label) if label_mapper is not None else np.asarray(label, dtype=np.uint8)
+    return image, label
+
+
+def pack_segmentation_dataset(samples, out_dir, size, label_mapper=None, shard_size=1000, num_workers=None):
+    """
+    Resize a segmentation dataset once to the training resolution and store it as sharded
+    uint8 ``.npy`` files, read back with :class:`PackedSegDataset` without any decoding.
+
+    Args:
+        samples: list of (name, image_path, label_path).
+        out_dir(str): output directory, gets ``index.json`` plus ``images_XXXX.npy``
+            (N x H x W x 3 RGB) and ``labels_XXXX.npy`` (N x H x W) shards.
+        size: (w, h), images are resized with BICUBIC and labels with NEAREST, like the loaders do.
+        label_mapper: optional :class:`LabelMapper` applied to the labels, e.g. to train ids.
+        shard_size(int): images per shard.
+        num_workers(int): decoding processes, defaults to the number of cpus.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    if os.path.isfile(os.path.join(out_dir, INDEX_FILE)):
+        os.remove(os.path.join(out_dir, INDEX_FILE))
+    w, h = size
+    pool = multiprocessing.Pool(num_workers)
+    shards = []
+    try:
+        for start in range(0, len(samples), shard_size):
+            chunk = samples[start:start + shard_size]
+            shard = {'images': 'images_{:04d}.npy'.format(len(shards)),
+                     'labels': 'labels_{:04d}.npy'.format(len(shards)),
+                     'count': len(chunk)}
+            images = np.lib.format.open_memmap(os.path.join(out_dir, shard['images']), mode='w+',
+                                               dtype=np.uint8, shape=(len(chunk), h, w, 3))
+            labels = np.lib.format.open_memmap(os.path.join(out_dir, shard['labels']), mode='w+',
+                                               dtype=np.uint8, shape=(len(chunk), h, w))
+            jobs = [(image_path, label_path, size, label_mapper) for _, image_path, label_path in chunk]
+            for i, (image, label) in enumerate(pool.imap(_load_pair, jobs, chunksize=8)):
+                images[i] = image
+                labels[i] = label
+            images.flush()
+            labels.flush()
+            del images, labels
+            shards.append(shard)
+            logger.info("packed {}/{} images into {}".format(start + len(chunk), len(samples), out_dir))
+    finally:
+        pool.close()
+        pool.join()
+
+    # the index is written last, an interrupted build has no index and is not loadable
+    with open(os.path.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump({'size': [w, h], 'shards': shards, 'names': [name for name, _, _ in samples]}, f)
+
+
+class PackedSegDataset(data.Dataset):
+    """
+    Random access over a directory written by :func:`pack_segmentation_dataset`.
+    Shards are memory-mapped lazily in each DataLoader worker, so fetching a sample is a
+    page-cache read with no decode or resize.
+
+    Returns the same (image, label, size, name) tuples as the AdaptSegNet datasets:
+    with ``mean`` the image is a float32 BGR CHW array minus the mean, without it the
+    image stays uint8 RGB CHW for normalization on the GPU. Labels are uint8.
+    """
+
+    def __init__(self, root, mean=None, max_iters=None, size=None):
+        """
+        Args:
+            root(str): packed dataset directory.
+            mean: BGR mean subtracted from the images, or None to return uint8 images.
+            max_iters(int): repeat the samples to at least this many, like the AdaptSegNet datasets.
+            size: optional (w, h) the dataset must have been packed at.
+        """
+        self.root = root
+        self.mean = None if mean is None else np.asarray(mean, dtype=np.float32)
+        with open(os.path.join(root, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.size = tuple(index['size'])
+        if size is not None and tuple(size) != self.size:
+            raise ValueError("{} was packed at {}, not {}".format(root, self.size, tuple(size)))
+        self.shards = index['shards']
+        self.names = index['names']
+        self.offsets = np.cumsum([0] + [shard['count'] for shard in self.shards])
+        self.ids = np.arange(len(self.names))
+        if max_iters is not None:
+            self.ids = np.tile(self.ids, int(np.ceil(float(max_iters) / len(self.ids))))
+        self._maps = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _shard(self, k):
+        if self._pid != os.getpid():  # don't share file handles with forked workers
+            self._maps = {}
+            self._pid = os.getpid()
+        if k not in self._maps:
+            shard = self.shards[k]
+            self._maps[k] = (np.load(os.path.join(self.root, shard['images']), mmap_mode='r'),
+                             np.load(os.path.join(self.root, shard['labels']), mmap_mode='r'))
+        return self._maps[k]
+
+    def __getitem__(self, index):
+        i = int(self.ids[index])
+        k = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        images, labels = self._shard(k)
+        image = images[i - self.offsets[k]]
+        label = np.array(labels[i - self.offsets[k]])
+        size = np.array(image.shape)
+        if self.mean is None:
+            image = np.ascontiguousarray(image.transpose((2, 0, 1)))
+        else:
+            image = image[:, :, ::-1].astype(np.float32)  # change to BGR
+            image -= self.mean
+            image = image.transpose((2, 0, 1)).copy()
+        return image, label, size, self.names[i]
+
+
+def _read_list(path):
+    return [line.strip() for line in open(path) if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a segmentation dataset for PackedSegDataset.")
+    parser.add_argument("--image_root", type=str, required=True)
+    parser.add_argument("--image_list", type=str, required=True)
+    parser.add_argument("--label_root", type=str, default=None, help="defaults to --image_root")
+    parser.add_argument("--label_list", type=str, default=None, help="defaults to --image_list")
+    parser.add_argument("--size", type=str, required=True, help="w,h of the training images, e.g. 1280,720")
+    parser.add_argument("--id_to_trainid", action="store_true", help="map Cityscapes ids to train ids")
+    parser.add_argument("--shard_size", type=int, default=1000)
+    parser.add_argument("--num_workers", type=int, default=None)
+    parser.add_argument("--out", type=str, required=True)
+    args = parser.parse_args()
+
+    images = _read_list(args.image_list)
+    labels = _read_list(args.label_list) if args.label_list else images
+    assert len(images) == len(labels), "{} images but {} labels".format(len(images), len(labels))
+    label_root = args.label_root or args.image_root
+    samples = [(image, os.path.join(args.image_root, image), os.path.join(label_root, label))
+               for image, label in zip(images, labels)]
+    label_mapper = LabelMapper(CITYSCAPES_ID_TO_TRAINID) if args.id_to_trainid else None
+    pack_segmentation_dataset(samples, args.out, tuple(map(int, args.size.split(','))), label_mapper=label_mapper,
+                              shard_size=args.shard_size, num_workers=args.num_workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# Author: Tao Hu <taohu620@gmail.com>
+import sys
+import time
+import threading
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data.sampler import Sampler
+import six
+from six.moves import queue
+
+__all__ = ['PrefetchIterator', 'InfiniteSampler', 'infinite_loader', 'to_cuda']
+
+
+class InfiniteSampler(Sampler):
+    """
+    Endless sampler, one new permutation of the dataset per pass. A DataLoader over it
+    never ends, so its worker processes are started once instead of at every epoch.
+    ``epoch`` counts the completed passes.
+
+    The order only depends on the generator state the sampler starts from, which
+    :meth:`state_dict` / :meth:`load_state_dict` save and restore. The sampler does not
+    know how many samples were consumed (workers read ahead), so after restoring, the
+    caller resumes on the sample it stopped at with :meth:`skip`, without loading the
+    samples before it.
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=None):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        # numpy, not torch: some scripts set a cuda default tensor type
+        self.rng = np.random.RandomState(seed)
+        self.epoch = 0
+        self.offset = 0
+        self._initial_state = self.rng.get_state()
+
+    def state_dict(self):
+        return {'rng_state': self._initial_state}
+
+    def load_state_dict(self, state_dict):
+        self._initial_state = state_dict['rng_state']
+        self.rng.set_state(self._initial_state)
+        self.epoch = 0
+        self.offset = 0
+
+    def skip(self, num_samples):
+        """The next iteration starts ``num_samples`` after the beginning."""
+        self.offset = num_samples
+
+    def __iter__(self):
+        n = len(self.data_source)
+        self.rng.set_state(self._initial_state)
+        self.epoch = 0
+        skip = self.offset
+        while skip >= n:  # whole passes only advance the generator
+            if self.shuffle:
+                self.rng.permutation(n)
+            self.epoch += 1
+            skip -= n
+        while True:
+            indices = self.rng.permutation(n) if self.shuffle else np.arange(n)
+            for i in indices[skip:]:
+                yield int(i)
+            skip = 0
+            self.epoch += 1
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+def infinite_loader(dataset, batch_size=1, shuffle=True, seed=None, **kwargs):
+    """
+    Returns:
+        a DataLoader over ``InfiniteSampler(dataset)``, ``kwargs`` go to the DataLoader.
+        ``len()`` is still the number of batches of one pass.
+    """
+    return DataLoader(dataset, batch_size=batch_size, sampler=InfiniteSampler(dataset, shuffle, seed), **kwargs)
+
+
+def _cuda_async(tensor):
+    try:
+        return tensor.cuda(non_blocking=True)
+    except TypeError:  # torch < 0.4
+        return tensor.cuda(**{'async': True})
+
+
+def to_cuda(obj):
+    """Move the tensors of a (nested) batch to the GPU, asynchronously if they are pinned."""
+    if torch.is_tensor(obj):
+        return _cuda_async(obj)
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(to_cuda(o) for o in obj)
+    if isinstance(obj, dict):
+        return {k: to_cuda(v) for k, v in obj.items()}
+    return obj
+
+
+def _cuda_tensors(obj):
+    if torch.is_tensor(obj):
+        if obj.is_cuda:
+            yield obj
+    elif isinstance(obj, (tuple, list)):
+        for o in obj:
+            for t in _cuda_tensors(o):
+                yield t
+    elif isinstance(obj, dict):
+        for o in obj.values():
+            for t in _cuda_tensors(o):
+                yield t
+
+
+class PrefetchIterator(object):
+    """
+    Endless iterator over several loaders at once, e.g. a source and a target domain
+    loader, yielding one tuple ``(batch_0, batch_1, ...)`` per step. A loader that runs out
+    is restarted on its own, so loaders of different lengths can be paired; use
+    :func:`infinite_loader` to avoid restarting the DataLoader workers at all.
+    The next steps are prepared by a background thread, including ``transform``
+    (typically moving the batches to the GPU), while the current one is consumed.
+
+    With ``cuda_stream``, ``transform`` runs on a side CUDA stream so that the host to
+    device copies overlap with the compute of the current step.
+
+    Examples:
+
+    .. code-block:: python
+
+        it = PrefetchIterator([infinite_loader(source, 1, pin_memory=True, num_workers=4),
+                               infinite_loader(target, 1, pin_memory=True, num_workers=4)],
+                              transform=to_cuda, cuda_stream=True)
+        (source_data, source_labels), (target_data, _) = next(it)
+        logger.info(it.stats())
+    """
+
+    def __init__(self, loaders, transform=None, num_prefetch=2, cuda_stream=False):
+        """
+        Args:
+            loaders: list of iterables, re-iterated when exhausted.
+            transform: optional function applied to each step tuple in the background thread.
+            num_prefetch(int): number of steps prepared ahead.
+            cuda_stream(bool): run ``transform`` on a side CUDA stream, ignored without a GPU.
+        """
+        self.loaders = list(loaders)
+        self.transform = transform
+        self.num_prefetch = num_prefetch
+        self.epochs = [0] * len(self.loaders)
+        self._stream = None
+        if cuda_stream and torch.cuda.is_available():
+            self._device = torch.cuda.current_device()
+            self._stream = torch.cuda.Stream()
+        self._reset_stats()
+        self._error = None
+        self._queue = queue.Queue(maxsize=num_prefetch)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _next_batch(self, iterators, i):
+        try:
+            return next(iterators[i])
+        except StopIteration:
+            self.epochs[i] += 1
+            iterators[i] = iter(self.loaders[i])
+            return next(iterators[i])
+
+    def _prepare(self, step):
+        if self._stream is None:
+            return self.transform(step), None
+        with torch.cuda.device(self._device):
+            with torch.cuda.stream(self._stream):
+                step = self.transform(step)
+                event = torch.cuda.Event()
+                event.record()
+        return step, event
+
+    def _put(self, item):
+        # gives up once closed, the consumer may never take it
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        try:
+            iterators = [iter(l) for l in self.loaders]
+            while not self._stop.is_set():
+                step = tuple(self._next_batch(iterators, i) for i in range(len(iterators)))
+                event = None
+                if self.transform is not None:
+                    step, event = self._prepare(step)
+                self._put((step, event))
+        except Exception:
+            # kept for every later call, the thread is gone
+            self._error = sys.exc_info()
+            self._put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._error is not None and self._queue.empty():
+            six.reraise(*self._error)
+        depth = self._queue.qsize()
+        start = time.time()
+        item = self._queue.get()
+        self._wait_time += time.time() - start
+        self._depth_sum += depth
+        self._starved += depth == 0
+        self._steps += 1
+        if item is None:
+            six.reraise(*self._error)
+        step, event = item
+        if event is not None:
+            current = torch.cuda.current_stream()
+            current.wait_event(event)
+            # the batches were allocated on the side stream but are freed after use on this one
+            for t in _cuda_tensors(step):
+                t.record_stream(current)
+        return step
+
+    next = __next__
+
+    def _reset_stats(self):
+        self._steps = 0
+        self._starved = 0
+        self._depth_sum = 0
+        self._wait_time = 0.0
+
+    def stats(self, reset=True):
+        """
+        Returns:
+            dict: over the steps since the last reset, ``queue_depth`` the mean number of
+            ready steps when one was requested (out of ``num_prefetch``), ``starved`` the
+            fraction of steps that found the queue empty and ``wait_ms`` the mean time
+            spent waiting for data per step. A starved loader shows as a depth near 0.
+        """
+        steps = max(self._steps, 1)
+        result = {'steps': self._steps,
+                  'queue_depth': float(self._depth_sum) / steps,
+                  'starved': float(self._starved) / steps,
+                  'wait_ms': self._wait_time * 1000. / steps}
+        if reset:
+            self._reset_stats()
+        return result
+
+    def close(self):
+        """Stop the background thread and wait for it, after the batch it is loading."""
+        self._stop.set()
+        # unblock the producer if it waits on a full queue
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._thread.join()
@@ -5,6 +5,7 @@ import torch
 import numpy as np
 import fcn, os
 from pytorchgo.utils import logger
+from pytorchgo.utils.weight_store import load_weights
 affine_par = True
 
 
@@ -187,13 +188,14 @@ class ResNet(nn.Module):
 class MS_Deeplab(nn.Module):
     pretrained_model = \
         os.path.expanduser('~/data/models/pytorch/MS_DeepLab_resnet_pretrained_COCO_init.pth')
+    pretrained_md5 = 'a5720af006c01fd69b3325da36e1c9ed'
 
     @classmethod
     def download(cls):
         return fcn.data.cached_download(
             url='https://dongzhuoyao.oss-cn-qingdao.aliyuncs.com/MS_DeepLab_resnet_pretrained_COCO_init.pth',
             path=cls.pretrained_model,
-            md5='a5720af006c01fd69b3325da36e1c9ed',
+            md5=cls.pretrained_md5,
         )
 
 
@@ -272,9 +274,8 @@ def Res_Deeplab(NoLabels=21, pretrained = False, output_all = False):
     model = MS_Deeplab(Bottleneck,NoLabels, output_all)
     if pretrained:
         logger.info("initializing pretrained deeplabv2 model....")
-        model_file = MS_Deeplab.download()
-        state_dict = torch.load(model_file)
-        model.load_state_dict(state_dict)
+        # memory-mapped copy of the checkpoint, converted once per machine
+        load_weights(model, MS_Deeplab.download(), md5=MS_Deeplab.pretrained_md5)
 
     return model
 
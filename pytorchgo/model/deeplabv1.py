@@ -5,6 +5,7 @@ import torch.utils.model_zoo as model_zoo
 import math
 from pytorchgo.utils import logger
 from pytorchgo.utils.pytorch_utils import model_summary
+from pytorchgo.utils.weight_store import cached_url
 
 __all__ = [
     'VGG', 'vgg11', 'vgg11_bn', 'vgg13', 'vgg13_bn', 'vgg16', 'vgg16_bn',
@@ -266,21 +267,9 @@ def VGG16_LargeFoV(class_num, image_size, pretrained=False,  **kwargs):
     model = FCN(vgg_input, **kwargs)
 
     if pretrained:
-        saved_state_dict = model_zoo.load_url(model_urls['vgg16'])
-        logger.info("dictionary weight: {}".format(saved_state_dict.keys()))
-        new_params = model.state_dict().copy()
-        for weight_key in saved_state_dict:
-            # classifier.0.bias
-            i_parts = weight_key.split('.')
-            if i_parts[0] == 'classifier':
-                continue
-            elif i_parts[0] == 'features':
-                new_params[weight_key] = saved_state_dict[weight_key]
-                logger.info("loading weight from pretrained dictionary: {}".format(weight_key))
-            else:
-                raise
-            # print i_parts
-        model.load_state_dict(new_params)
+        # the vgg16 features only, copied from the memory-mapped checkpoint, the classifier is not read
+        loaded = cached_url(model_urls['vgg16']).load_into(model, prefixes=['features.'], strict=False)
+        logger.info("loaded weights from the pretrained vgg16: {}".format(loaded))
 
     logger.info("deeplabv1 model structure: {}".format(model))
     model_summary(model)
@@ -0,0 +1,3 @@
+# Author: Tao Hu <taohu620@gmail.com>
+
+from .adversarial import AdversarialSegTrainer
@@ -0,0 +1,153 @@
+# Author: Tao Hu <taohu620@gmail.com>
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+from ..dataloader.prefetch import PrefetchIterator, to_cuda
+from ..utils.logger import StepProfiler
+
+__all__ = ['AdversarialSegTrainer']
+
+
+class AdversarialSegTrainer(object):
+    """
+    One iteration of output-space adversarial training for segmentation:
+    the segmentation network runs once on a (source, target) batch pair. The
+    discriminator is updated on detached outputs, then the segmentation network
+    is updated through the same graph with the refreshed discriminator.
+
+    Subclasses add task losses by overriding :meth:`generator_losses`.
+
+    Examples:
+
+    .. code-block:: python
+
+        trainer = AdversarialSegTrainer(model, netD, optim, optimD, train_loader, target_loader,
+                                        seg_loss=lambda score, label: CrossEntropyLoss2d_Seg(score, label, class_num=16))
+        for _ in range(iterations):
+            losses = trainer.step()
+    """
+
+    def __init__(self, model, netD, optimizer, optimizerD, source_loader, target_loader,
+                 seg_loss, adv_loss=None, dis_weight=1.0, source_label=1, target_label=0,
+                 d_steps=1, d_clamp=None, cuda=True, prepare_batch=None, profiler=None):
+        """
+        Args:
+            seg_loss: function (source_score, source_labels) -> loss.
+            adv_loss: criterion of the discriminator, defaults to MSE (least squares GAN).
+            dis_weight(float): weight of the discriminator losses, for both D and G.
+            d_steps(int): discriminator updates per iteration, all on the same detached outputs.
+            d_clamp(float): clamp discriminator weights to [-d_clamp, d_clamp] after each update.
+            prepare_batch: function (source_batch, target_batch) -> (source_data, source_labels,
+                target_data, extra) run in the prefetch thread, on a side CUDA stream with ``cuda``,
+                defaults to moving the first two fields to the GPU.
+            profiler(StepProfiler): times the data / forward / discriminator / generator_loss /
+                backward / optimizer phases, one :meth:`StepProfiler.step` per iteration.
+        """
+        self.model = model
+        self.netD = netD
+        self.optim = optimizer
+        self.optimD = optimizerD
+        self.seg_loss = seg_loss
+        self.adv_loss = adv_loss if adv_loss is not None else nn.MSELoss()
+        self.dis_weight = dis_weight
+        self.source_label = source_label
+        self.target_label = target_label
+        self.d_steps = d_steps
+        self.d_clamp = d_clamp
+        self.cuda = cuda
+        self.prepare_batch = prepare_batch if prepare_batch is not None else self._default_prepare_batch
+        self.profiler = profiler if profiler is not None else StepProfiler(enabled=False)
+        self._labels = {}
+        self.data_iter = PrefetchIterator([source_loader, target_loader],
+                                          transform=lambda step: self.prepare_batch(*step), cuda_stream=cuda)
+
+    def _default_prepare_batch(self, source_batch, target_batch):
+        source_data, source_labels = source_batch[0], source_batch[1]
+        target_data = target_batch[0]
+        if self.cuda:
+            source_data, source_labels, target_data = to_cuda((source_data, source_labels, target_data))
+        return source_data, source_labels, target_data, target_batch[1:]
+
+    def domain_label(self, like, value):
+        """Constant discriminator target with the shape of ``like``, cached per shape and value."""
+        key = (tuple(like.size()), value, like.is_cuda)
+        if key not in self._labels:
+            label = torch.FloatTensor(*key[0]).fill_(value)
+            if like.is_cuda:
+                label = label.cuda()
+            self._labels[key] = Variable(label)
+        return self._labels[key]
+
+    def _set_requires_grad(self, seg, dis):
+        for param in self.model.parameters():
+            param.requires_grad = seg
+        for param in self.netD.parameters():
+            param.requires_grad = dis
+
+    def discriminator_losses(self, source_score, target_score, fool):
+        src_result = self.netD(F.softmax(source_score))
+        target_result = self.netD(F.softmax(target_score))
+        target_label = self.source_label if fool else self.target_label
+        src_dis_loss = self.adv_loss(src_result, self.domain_label(src_result, self.source_label)) * self.dis_weight
+        target_dis_loss = self.adv_loss(target_result, self.domain_label(target_result, target_label)) * self.dis_weight
+        return src_dis_loss, target_dis_loss
+
+    def generator_losses(self, source_data, source_labels, target_data, extra, source_score, target_score):
+        """
+        Returns:
+            dict of weighted losses, summed with the adversarial ones for the G update.
+        """
+        return {'seg_loss': self.seg_loss(source_score, source_labels)}
+
+    def step(self):
+        """
+        Run one iteration.
+
+        Returns:
+            dict: name -> Variable of every loss term.
+        """
+        profiler = self.profiler
+        with profiler.scope('data'):
+            source_data, source_labels, target_data, extra = next(self.data_iter)
+        source_data, source_labels = Variable(source_data), Variable(source_labels)
+        target_data = Variable(target_data)
+
+        with profiler.scope('forward'):
+            self._set_requires_grad(seg=True, dis=False)
+            source_score = self.model(source_data)
+            target_score = self.model(target_data)
+
+        # D, on detached outputs
+        with profiler.scope('discriminator'):
+            self._set_requires_grad(seg=True, dis=True)
+            source_score_d, target_score_d = source_score.detach(), target_score.detach()
+            for _ in range(self.d_steps):
+                self.optimD.zero_grad()
+                d_src_loss, d_target_loss = self.discriminator_losses(source_score_d, target_score_d, fool=False)
+                (d_src_loss + d_target_loss).backward()
+                self.optimD.step()
+                if self.d_clamp is not None:
+                    for p in self.netD.parameters():
+                        p.data.clamp_(-self.d_clamp, self.d_clamp)
+
+        # G, through the same forward
+        with profiler.scope('generator_loss'):
+            self._set_requires_grad(seg=True, dis=False)
+            self.optim.zero_grad()
+            losses = self.generator_losses(source_data, source_labels, target_data, extra, source_score, target_score)
+            src_dis_loss, target_dis_loss = self.discriminator_losses(source_score, target_score, fool=True)
+            total_loss = sum(losses.values()) + src_dis_loss + target_dis_loss
+        with profiler.scope('backward'):
+            total_loss.backward()
+        with profiler.scope('optimizer'):
+            self.optim.step()
+        profiler.step()
+
+        losses.update({'d_src_loss': d_src_loss, 'd_target_loss': d_target_loss,
+                       'src_dis_loss': src_dis_loss, 'target_dis_loss': target_dis_loss})
+        return losses
+
+    def close(self):
+        self.data_iter.close()
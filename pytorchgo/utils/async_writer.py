@@ -0,0 +1,152 @@
+# Author: Tao Hu <taohu620@gmail.com>
+
+import time
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
+
+from . import logger
+
+__all__ = ['BoundedPool', 'AsyncWriter']
+
+
+def _timed_call(slot, func, args):
+    start = time.time()
+    try:
+        func(*args)
+    except Exception as e:
+        return slot, time.time() - start, e
+    return slot, time.time() - start, None
+
+
+class BoundedPool(object):
+    """
+    A pool of threads or processes with at most ``max_pending`` jobs in flight. Every job
+    holds one of the slots ``0 .. max_pending - 1`` from :meth:`acquire` until it is done,
+    which bounds the memory held by queued jobs, and lets the caller hand data over
+    through per-slot buffers. The first job error is raised by the next :meth:`acquire`
+    or by :meth:`close`.
+    """
+
+    def __init__(self, num_workers, max_pending, use_processes=False, initializer=None, initargs=()):
+        """
+        Args:
+            num_workers(int): size of the pool.
+            max_pending(int): number of slots.
+            use_processes(bool): use a process pool, for jobs that hold the GIL.
+                The job functions and their arguments must then be picklable.
+            initializer, initargs: run in every worker when it starts.
+        """
+        self.num_workers = num_workers
+        pool_cls = multiprocessing.Pool if use_processes else ThreadPool
+        self._pool = pool_cls(num_workers, initializer, initargs)
+        self._free = queue.Queue()
+        for slot in range(max_pending):
+            self._free.put(slot)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._error = None
+        self.num_jobs = 0
+        self.job_time = 0.0
+        self.blocked_time = 0.0
+
+    def _set_error(self, error):
+        if error is not None and self._error is None:
+            self._error = error
+
+    def _done(self, result):
+        slot, duration, error = result
+        with self._lock:
+            self.job_time += duration
+            self._set_error(error)
+            self._pending.pop(slot, None)
+        self._free.put(slot)
+
+    def _reclaim(self):
+        # a job that couldn't be run at all (e.g. its arguments don't pickle) never calls
+        # back, on python 2 nothing else would tell: give its slot back from here
+        with self._lock:
+            for slot, result in list(self._pending.items()):
+                if result.ready() and not result.successful():
+                    try:
+                        result.get(0)
+                    except Exception as e:
+                        self._set_error(e)
+                    del self._pending[slot]
+                    self._free.put(slot)
+
+    def acquire(self):
+        """Returns: int, a free slot, blocking while all of them are in use."""
+        start = time.time()
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                slot = self._free.get(timeout=0.1)
+                break
+            except queue.Empty:
+                self._reclaim()
+        self.blocked_time += time.time() - start
+        return slot
+
+    def submit(self, slot, func, *args):
+        """Run ``func(*args)`` in the pool, ``slot`` is free again once it is done."""
+        with self._lock:
+            # under the lock: the job may be done before apply_async returns
+            self._pending[slot] = self._pool.apply_async(_timed_call, (slot, func, args), callback=self._done)
+        self.num_jobs += 1
+
+    def close(self):
+        """Wait for the pending jobs and raise the first job error, if any."""
+        self._pool.close()
+        self._pool.join()
+        self._reclaim()
+        if self._error is not None:
+            raise self._error
+
+
+class AsyncWriter(BoundedPool):
+    """
+    Run output jobs (colorizing, PNG encoding, saving...) on a pool of threads or processes,
+    so that the inference loop doesn't wait on disk I/O. At most ``max_pending`` jobs are in
+    flight: :meth:`put` blocks beyond that, which bounds the memory held by queued outputs.
+
+    Examples:
+
+    .. code-block:: python
+
+        writer = AsyncWriter(num_workers=4)
+        for image, name in loader:
+            pred = model(image).data.max(1)[1].cpu().numpy()
+            writer.put(save_prediction, pred, name)
+        writer.close()   # waits for the pending jobs and logs images/sec
+    """
+
+    def __init__(self, num_workers=4, max_pending=32, use_processes=False):
+        """
+        Args:
+            num_workers(int): size of the pool.
+            max_pending(int): maximum number of submitted but unfinished jobs.
+            use_processes(bool): use a process pool, for jobs that hold the GIL.
+                The job functions and their arguments must then be picklable.
+        """
+        super(AsyncWriter, self).__init__(num_workers, max_pending, use_processes)
+        self._start = time.time()
+
+    def put(self, func, *args):
+        """Submit ``func(*args)``, blocking while ``max_pending`` jobs are in flight."""
+        self.submit(self.acquire(), func, *args)
+
+    def close(self):
+        """Wait for the pending jobs, log the throughput and raise the first job error, if any."""
+        submit_time = time.time() - self._start
+        super(AsyncWriter, self).close()
+        total_time = time.time() - self._start
+        if self.num_jobs:
+            compute_time = max(submit_time - self.blocked_time, 1e-6)
+            logger.info("{} outputs: compute {:.2f} images/sec, writing {:.2f} images/sec with {} workers, "
+                        "blocked on the writer for {:.1f}s, {:.1f}s in total".format(
+                            self.num_jobs, self.num_jobs / compute_time,
+                            self.num_jobs * self.num_workers / max(self.job_time, 1e-6), self.num_workers,
+                            self.blocked_time, total_time))
@@ -0,0 +1,274 @@
+# Author: Tao Hu <taohu620@gmail.com>
+
+import io
+import os
+import json
+import random
+import threading
+import sys
+import numpy as np
+import torch
+from six.moves import queue
+
+from . import logger
+from .fs import mkdir_p
+
+__all__ = ['CheckpointManager', 'snapshot_state', 'get_rng_state', 'set_rng_state']
+
+
+def snapshot_state(obj):
+    """
+    Returns:
+        a copy of a (nested) state dict whose tensors live in host memory, unaffected by
+        the training steps that follow.
+    """
+    if torch.is_tensor(obj):
+        cpu = obj.cpu()
+        return cpu.clone() if cpu is obj else cpu
+    if isinstance(obj, dict):
+        copy = obj.__class__()
+        for k, v in obj.items():
+            copy[k] = snapshot_state(v)
+        if hasattr(obj, '_metadata'):  # module state dicts carry their version there
+            copy._metadata = obj._metadata
+        return copy
+    if isinstance(obj, list):
+        return [snapshot_state(v) for v in obj]
+    if isinstance(obj, tuple):
+        return tuple(snapshot_state(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    """The state of the python, numpy, torch and cuda generators."""
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        get_all = getattr(torch.cuda, 'get_rng_state_all', None)
+        state['cuda'] = get_all() if get_all is not None else [torch.cuda.get_rng_state()]
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        set_all = getattr(torch.cuda, 'set_rng_state_all', None)
+        if set_all is not None and len(state['cuda']) == torch.cuda.device_count():
+            set_all(state['cuda'])
+        else:
+            torch.cuda.set_rng_state(state['cuda'][0])
+
+
+def _optimizer_state_to_params(optimizer):
+    # the state was snapshot to host memory, put it back next to the parameters
+    # (torch >= 0.4 already does so, step counters are left where they are)
+    for p, state in optimizer.state.items():
+        for k, v in state.items():
+            if torch.is_tensor(v) and v.dim() > 0 and v.is_cuda != p.is_cuda:
+                state[k] = v.cuda(p.get_device()) if p.is_cuda else v.cpu()
+
+
+def _atomic_write(path, data):
+    tmp_path = path + '.{}.tmp'.format(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+class CheckpointManager(object):
+    """
+    Checkpoints written in the background: :meth:`save` copies the state dicts to host
+    memory on the calling thread, and a writer thread serializes them and writes the files
+    (temporary file + rename, so a crash never leaves a truncated checkpoint). Training
+    only waits when a save is requested while two are still pending.
+
+    A checkpoint holds the state dicts of the given objects (models, optimizers, LR
+    schedulers, :class:`InfiniteSampler` ...) under the given names, the extra values passed
+    to :meth:`save` and the RNG states. The latest one is always ``filename``; when a
+    ``metric`` is given, the ``keep_best`` best ones are kept as well, the very best as
+    ``best_filename``. :meth:`restore` puts everything back in one call.
+
+    Examples:
+
+    .. code-block:: python
+
+        checkpoints = CheckpointManager(logger.get_logger_dir(), keep_best=3)
+        objects = {'model_state_dict': model, 'optim_state_dict': optimizer}
+        if args.resume:
+            start_epoch = checkpoints.restore(objects)['epoch'] + 1
+        for epoch in range(start_epoch, max_epoch):
+            ...
+            checkpoints.save(objects, step=epoch, metric=mean_iu, epoch=epoch)
+        checkpoints.close()
+    """
+
+    def __init__(self, directory, filename='checkpoint.pth.tar', best_filename='model_best.pth.tar',
+                 keep_best=1, mode='max', async_write=True):
+        """
+        Args:
+            directory(str): where the checkpoints go.
+            filename(str): the latest checkpoint.
+            best_filename(str): the best checkpoint so far. With ``keep_best > 1``, the other
+                best ones are kept next to it with the step in their name.
+            keep_best(int): number of best checkpoints kept.
+            mode(str): 'max' or 'min', whether a larger metric is better.
+            async_write(bool): write in a background thread.
+        """
+        assert mode in ('max', 'min'), mode
+        self.directory = directory
+        self.filename = filename
+        self.best_filename = best_filename
+        self.keep_best = keep_best
+        self.mode = mode
+        mkdir_p(directory)
+
+        # [metric, step, file] of the kept best checkpoints, best first. A new run starts
+        # empty and overwrites the files of an earlier one, restore() picks the list up
+        self._index_path = os.path.join(directory, os.path.splitext(filename)[0] + '.best.json')
+        self.best = []
+
+        self._error = None
+        self._queue = None
+        if async_write:
+            self._queue = queue.Queue(maxsize=1)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _best_name(self, step):
+        root, ext = os.path.splitext(self.best_filename)
+        if ext in ('.tar', '.gz'):
+            root, ext2 = os.path.splitext(root)
+            ext = ext2 + ext
+        return '{}-{}{}'.format(root, step, ext)
+
+    def _is_better(self, a, b):
+        return a > b if self.mode == 'max' else a < b
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._write(*job)
+            except Exception:
+                if self._error is None:
+                    self._error = sys.exc_info()[1]
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state, filenames, removed, best):
+        buf = io.BytesIO()
+        torch.save(state, buf)
+        data = buf.getvalue()
+        for filename in filenames:
+            _atomic_write(self._path(filename), data)
+        for filename in removed:
+            if os.path.isfile(self._path(filename)):
+                os.remove(self._path(filename))
+        if best is not None:
+            _atomic_write(self._index_path, json.dumps({'best': best}).encode('utf-8'))
+
+    def _submit(self, job):
+        if self._error is not None:
+            raise self._error
+        if self._queue is None:
+            self._write(*job)
+        else:
+            self._queue.put(job)
+
+    def _update_best(self, step, metric):
+        """Returns the files to write and to remove for a checkpoint of ``metric``."""
+        if metric is None or self.keep_best < 1:
+            return [], [], None
+        if len(self.best) >= self.keep_best and not self._is_better(metric, self.best[-1][0]):
+            return [], [], None
+        name = self._best_name(step) if self.keep_best > 1 else self.best_filename
+        was_best = self.best[0][2] if self.best else None
+        self.best.append([float(metric), step, name])
+        self.best.sort(key=lambda b: b[0], reverse=self.mode == 'max')
+        removed = [b[2] for b in self.best[self.keep_best:]]
+        self.best = self.best[:self.keep_best]
+        filenames = [name]
+        if self.keep_best > 1 and self.best[0][2] == name:
+            filenames.append(self.best_filename)
+        if was_best == name:  # same step saved twice
+            removed = []
+        return filenames, [r for r in removed if r != self.best_filename], [list(b) for b in self.best]
+
+    def save(self, objects, step, metric=None, **extra):
+        """
+        Args:
+            objects(dict): name -> object with a ``state_dict()``, or a state dict.
+            step(int): iteration or epoch of the checkpoint, names the best-k files.
+            metric(float): validation metric, to keep the best checkpoints.
+            extra: other picklable values to store (epoch, best metric so far ...).
+        """
+        state = {}
+        for name, obj in objects.items():
+            state[name] = snapshot_state(obj.state_dict() if hasattr(obj, 'state_dict') else obj)
+        state.update(snapshot_state(extra))
+        state['step'] = step
+        state['metric'] = metric
+        state['rng_state'] = get_rng_state()
+        best_files, removed, best = self._update_best(step, metric)
+        self._submit((state, [self.filename] + best_files, removed, best))
+
+    def write(self, state, filename):
+        """Write any (state dict like) object to ``filename`` in the directory, the same way."""
+        self._submit((snapshot_state(state), [filename], [], None))
+
+    def latest(self):
+        """The path of the latest checkpoint, or None."""
+        path = self._path(self.filename)
+        return path if os.path.isfile(path) else None
+
+    def restore(self, objects, path=None, restore_rng=True):
+        """
+        Load a checkpoint into ``objects`` (same names as in :meth:`save`) and restore the RNGs.
+        The best checkpoints kept in the directory so far are tracked again.
+
+        Args:
+            objects(dict): name -> object with a ``load_state_dict()``.
+            path(str): the checkpoint, by default the latest one.
+
+        Returns:
+            dict: everything else the checkpoint holds (step, metric and the extra values).
+        """
+        path = path or self.latest()
+        if path is None:
+            raise IOError("No checkpoint to restore in {}".format(self.directory))
+        state = torch.load(path, map_location=lambda storage, loc: storage)
+        if os.path.isfile(self._index_path):
+            with open(self._index_path) as f:
+                self.best = json.load(f)['best']
+        for name, obj in objects.items():
+            obj.load_state_dict(state.pop(name))
+            if isinstance(obj, torch.optim.Optimizer):
+                _optimizer_state_to_params(obj)
+        rng_state = state.pop('rng_state', None)
+        if restore_rng and rng_state is not None:
+            set_rng_state(rng_state)
+        logger.info("Restored {} from {} (step {})".format(', '.join(sorted(objects)), path, state.get('step')))
+        return state
+
+    def wait(self):
+        """Block until the pending checkpoints are written, raise the first write error."""
+        if self._queue is not None:
+            self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        self.wait()
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
@@ -0,0 +1,89 @@
+# Author: Tao Hu <taohu620@gmail.com>
+
+import os
+import subprocess
+import threading
+
+__all__ = ['PeakGPUMemory']
+
+
+def _query(args):
+    try:
+        out = subprocess.check_output(['nvidia-smi'] + args + ['--format=csv,noheader,nounits'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return [line.split(', ') for line in out.decode('utf-8').strip().splitlines() if line.strip()]
+
+
+def _visible_gpu():
+    gpu = os.environ.get('CUDA_VISIBLE_DEVICES', '0').split(',')[0].strip()
+    return gpu if gpu else '0'
+
+
+class PeakGPUMemory(object):
+    """
+    Peak GPU memory of this process as nvidia-smi reports it, sampled in a background
+    thread. It works with any torch version (``torch.cuda.max_memory_allocated`` only
+    exists from 0.4, and can only be reset from 1.0 on). The memory held by the
+    process includes the CUDA context and the blocks kept by the caching allocator,
+    which are never given back: measure each configuration in a fresh process.
+
+    If nvidia-smi does not list the process (e.g. in a container with its own pid
+    namespace), the memory in use on the first visible GPU is measured instead.
+
+    Examples:
+
+    .. code-block:: python
+
+        with PeakGPUMemory() as memory:
+            for _ in range(10):
+                train_step.step(data_iter)
+        logger.info("peak {}".format(memory))
+    """
+
+    def __init__(self, interval=0.05):
+        """
+        Args:
+            interval(float): seconds between two samples.
+        """
+        self.interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        """Returns: the memory used now in MB, or None without nvidia-smi."""
+        apps = _query(['--query-compute-apps=pid,used_memory'])
+        if apps is None:
+            return None
+        used = [float(mb) for pid, mb in apps if pid == str(os.getpid())]
+        if used:
+            return sum(used)
+        gpus = _query(['--query-gpu=memory.used', '-i', _visible_gpu()])
+        return float(gpus[0][0]) if gpus else None
+
+    def _update(self):
+        used = self.sample()
+        if used is not None:
+            self.peak_mb = used if self.peak_mb is None else max(self.peak_mb, used)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._update()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._update()
+        return False
+
+    def __str__(self):
+        return 'n/a' if self.peak_mb is None else '{:.0f}MB'.format(self.peak_mb)
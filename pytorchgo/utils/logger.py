@@ -6,12 +6,16 @@ import logging
 import os
 import shutil
 import os.path
+import csv
+import json
+import time
+import six
 from termcolor import colored
 from datetime import datetime
 from six.moves import input
 import sys
 
-__all__ = ['set_logger_dir', 'auto_set_dir', 'get_logger_dir']
+__all__ = ['set_logger_dir', 'auto_set_dir', 'get_logger_dir', 'StepProfiler']
 
 
 class _MyFormatter(logging.Formatter):
@@ -146,3 +150,234 @@ def get_logger_dir():
         The directory is used for general logging, tensorboard events, checkpoints, etc.
     """
     return LOG_DIR
+
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+class _Scope(object):
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        p = self.profiler
+        if p.sync:
+            p._synchronize()
+        p._depth += 1
+        self.start = _timer()
+        return self
+
+    def __exit__(self, *exc):
+        p = self.profiler
+        if p.sync:
+            p._synchronize()
+        dt = _timer() - self.start
+        p._depth -= 1
+        p._times[self.name] = p._times.get(self.name, 0.) + dt
+        if p._depth == 0:
+            p._scoped += dt
+        return False
+
+
+class _NullScope(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SCOPE = _NullScope()
+
+
+def _csv_header(path):
+    with (open(path, 'rb') if six.PY2 else open(path, newline='')) as f:
+        return next(csv.reader(f), None)
+
+
+class StepProfiler(object):
+    """
+    Where the time of each training iteration goes: the loop wraps its phases in named
+    scopes and calls :meth:`step` once per iteration. Every ``log_interval`` iterations a
+    summary line is logged (iterations/sec, ms/iter of each scope and of the time outside
+    any scope) and appended as one row to ``<name>_profile.csv`` (or ``.jsonl``) in the
+    logger directory. A warning is logged when the ``data_scope`` takes more than
+    ``starvation`` of the iteration time, i.e. the data loader cannot keep up.
+
+    A scope costs two timer reads and a dict update. CUDA calls return before the GPU is
+    done, so without ``sync`` the GPU time is charged to whichever scope waits for it next
+    (typically a ``.data[0]`` or the next data copy). ``sync`` synchronizes at each scope
+    boundary to get the actual time of every phase, at some cost in throughput.
+
+    Scopes may be nested, the time outside any scope is reported as ``other``. A scope
+    must not be nested in itself.
+
+    Examples:
+
+    .. code-block:: python
+
+        profiler = logger.StepProfiler('train', log_interval=100)
+        for iteration in range(max_iter):
+            with profiler.scope('data'):
+                images, labels = next(batch_iterator)
+            with profiler.scope('h2d'):
+                images, labels = Variable(images.cuda()), Variable(labels.cuda())
+            with profiler.scope('forward'):
+                outputs = model(images)
+            with profiler.scope('loss'):
+                loss = criterion(outputs, labels)
+            with profiler.scope('backward'):
+                optimizer.zero_grad()
+                loss.backward()
+            with profiler.scope('optimizer'):
+                optimizer.step()
+            profiler.step()
+        profiler.close()
+    """
+
+    def __init__(self, name='train', log_interval=100, export='csv', sync=False,
+                 data_scope='data', starvation=0.2, enabled=True):
+        """
+        Args:
+            name(str): shown in the summary lines, and the export file name.
+            log_interval(int): iterations per summary, 0 to only summarize on :meth:`flush`.
+            export(str): 'csv', 'jsonl' or None. Needs a logger directory.
+            sync(bool): synchronize CUDA at each scope boundary.
+            data_scope(str): the scope waiting for the data loader.
+            starvation(float): fraction of the iteration time spent in ``data_scope``
+                above which a warning is logged.
+            enabled(bool): when False, scopes and steps do nothing.
+        """
+        assert export in ('csv', 'jsonl', None), export
+        self.name = name
+        self.log_interval = log_interval
+        self.export = export
+        self.sync = sync
+        self.data_scope = data_scope
+        self.starvation = starvation
+        self.enabled = enabled
+        self.iteration = 0
+        self._scopes = {}
+        self._file = None
+        self._writer = None
+        self._depth = 0
+        self._synchronize = None
+        if sync:
+            import torch
+            self._synchronize = torch.cuda.synchronize if torch.cuda.is_available() else (lambda: None)
+        self.reset()
+        self._start = None  # the first window starts with the first scope or step
+
+    def reset(self):
+        """Start a new summary window now, e.g. after a validation pass."""
+        self._times = {}
+        self._values = {}
+        self._scoped = 0.
+        self._steps = 0
+        self._start = _timer()
+
+    def scope(self, name):
+        """
+        Returns:
+            a context manager adding the time spent in it to ``name``.
+        """
+        if not self.enabled:
+            return _NULL_SCOPE
+        if self._start is None:
+            self._start = _timer()
+        scope = self._scopes.get(name)
+        if scope is None:
+            scope = self._scopes[name] = _Scope(self, name)
+        return scope
+
+    def step(self, **values):
+        """
+        End an iteration. ``values`` (python numbers, e.g. the loss) are averaged over the
+        summary window and reported with the timings.
+        """
+        if not self.enabled:
+            return
+        if self._start is None:
+            self._start = _timer()
+        self.iteration += 1
+        self._steps += 1
+        for k, v in values.items():
+            self._values[k] = self._values.get(k, 0.) + v
+        if self.log_interval and self._steps >= self.log_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Log and export the summary of the iterations since the last one.
+
+        Returns:
+            dict: iteration, it_per_sec, step_ms, ``<scope>_ms`` for each scope, other_ms
+            and the averaged values. None if no iteration ended since the last summary.
+        """
+        if not self._steps:
+            return None
+        n = self._steps
+        wall = _timer() - self._start
+        summary = {'iteration': self.iteration, 'it_per_sec': n / wall, 'step_ms': wall / n * 1000.}
+        parts = []
+        for scope in sorted(self._times, key=lambda k: -self._times[k]):
+            ms = self._times[scope] / n * 1000.
+            summary[scope + '_ms'] = ms
+            parts.append('{} {:.1f}ms {:.0%}'.format(scope, ms, self._times[scope] / wall))
+        other = max(wall - self._scoped, 0.)
+        summary['other_ms'] = other / n * 1000.
+        parts.append('other {:.1f}ms {:.0%}'.format(summary['other_ms'], other / wall))
+        for k in sorted(self._values):
+            summary[k] = float(self._values[k]) / n
+            parts.append('{} {:.4g}'.format(k, summary[k]))
+
+        _logger.info("{} iter {}: {:.2f} it/s, {:.1f}ms/iter | {}".format(
+            self.name, self.iteration, summary['it_per_sec'], summary['step_ms'], ' | '.join(parts)))
+        data_time = self._times.get(self.data_scope, 0.)
+        if data_time > self.starvation * wall:
+            _logger.warn("{}: {:.0%} of the iteration time waiting for data, the data loader is the bottleneck "
+                         "(more workers, or prefetching, may help)".format(self.name, data_time / wall))
+        self._export(summary)
+        self.reset()
+        return summary
+
+    def _export(self, summary):
+        if self.export is None or LOG_DIR is None:
+            return
+        if self._file is None:
+            path = os.path.join(LOG_DIR, '{}_profile.{}'.format(self.name, self.export))
+            new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+            if self.export == 'jsonl':
+                self._file = open(path, 'a')
+            else:
+                # the columns are fixed by the first summary, scopes seen later are only logged
+                head = ['iteration', 'it_per_sec', 'step_ms', 'other_ms']
+                fields = head + sorted(k for k in summary if k not in head)
+                root, index = path, 0
+                while not new_file and _csv_header(path) != fields:
+                    # resumed with other scopes: a new file, rather than rows under the wrong columns
+                    index += 1
+                    path = '{}.{}.csv'.format(os.path.splitext(root)[0], index)
+                    new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+                if index:
+                    _logger.warn("{} has other columns, profile written to {}".format(root, path))
+                self._file = open(path, 'ab') if six.PY2 else open(path, 'a', newline='')
+                self._writer = csv.DictWriter(self._file, fieldnames=fields, extrasaction='ignore')
+                if new_file:
+                    self._writer.writeheader()
+        if self._writer is not None:
+            self._writer.writerow(summary)
+        else:
+            self._file.write(json.dumps(summary, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def close(self):
+        """Summarize the last iterations and close the export file."""
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
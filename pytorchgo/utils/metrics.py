@@ -0,0 +1,148 @@
+# Author: Tao Hu <taohu620@gmail.com>
+
+import numpy as np
+
+__all__ = ['ConfusionMatrix', 'RunningConfusionMatrix']
+
+
+class ConfusionMatrix(object):
+    """
+    Segmentation confusion matrix accumulated on the device of the predictions.
+    Only the ``num_classes x num_classes`` matrix is copied back, when a metric is read.
+
+    Examples:
+
+    .. code-block:: python
+
+        cm = ConfusionMatrix(19)
+        for image, label in loader:
+            cm.update(model(image).max(1)[1], label.cuda())
+        logger.info("mIoU: {}".format(cm.miou()))
+    """
+
+    def __init__(self, num_classes, ignore_label=255):
+        self.num_classes = num_classes
+        self.ignore_label = ignore_label
+        self.hist = None
+
+    def reset(self):
+        self.hist = None
+
+    def update(self, pred, label):
+        """
+        Args:
+            pred: integer tensor of predicted classes.
+            label: tensor of ground truth classes of the same number of elements, on the same device.
+                Pixels equal to ``ignore_label`` or outside ``[0, num_classes)`` are skipped.
+        """
+        n = self.num_classes
+        pred = pred.contiguous().view(-1).long()
+        label = label.contiguous().view(-1).long()
+        if self.hist is None:
+            # one extra bin collects the skipped pixels
+            self.hist = label.new(n * n + 1).zero_()
+        valid = ((label >= 0) & (label < n) & (label != self.ignore_label)).long()
+        # no masked_select: its output size would need a device to host sync
+        index = (label.clamp(0, n - 1) * n + pred) * valid + (1 - valid) * (n * n)
+        if index.numel() > 0:
+            self.hist.index_add_(0, index, index.new(index.numel()).fill_(1))
+
+    def value(self):
+        """
+        Returns:
+            np.ndarray: num_classes x num_classes counts, rows are ground truth, columns predictions.
+        """
+        if self.hist is None:
+            return np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+        return self.hist[:-1].cpu().numpy().reshape(self.num_classes, self.num_classes)
+
+    def iou(self):
+        """Per-class IoU, 0 for classes that appear neither in the labels nor in the predictions."""
+        hist = self.value().astype(np.float64)
+        union = hist.sum(1) + hist.sum(0) - np.diag(hist)
+        return np.diag(hist) / np.maximum(union, 1)
+
+    def miou(self):
+        """Mean IoU over the classes that appear in the labels or the predictions."""
+        hist = self.value()
+        present = (hist.sum(1) + hist.sum(0)) > 0
+        return self.iou()[present].mean() if present.any() else 0.0
+
+    def pixel_accuracy(self):
+        hist = self.value()
+        return np.diag(hist).sum() / float(max(hist.sum(), 1))
+
+    def mean_accuracy(self):
+        """Per-class pixel accuracy, averaged over the classes that appear in the labels."""
+        hist = self.value()
+        present = hist.sum(1) > 0
+        return (np.diag(hist)[present] / hist.sum(1)[present].astype(np.float64)).mean() if present.any() else 0.0
+
+    def frequency_weighted_iou(self):
+        hist = self.value().astype(np.float64)
+        freq = hist.sum(1) / max(hist.sum(), 1)
+        return (freq * self.iou()).sum()
+
+
+class RunningConfusionMatrix(ConfusionMatrix):
+    """
+    Cheap training-time metrics: :meth:`update` is called at every iteration, but only
+    every ``interval``-th call is accumulated, from every ``stride``-th row and column of
+    the label maps. Everything stays on the device until :meth:`scores` is called, which
+    is the only point that waits for the GPU.
+
+    Examples:
+
+    .. code-block:: python
+
+        metrics = RunningConfusionMatrix(19, interval=10, stride=4)
+        for it, (image, label) in enumerate(loader):
+            ...
+            metrics.update(score.data.max(1)[1], label)
+            if it % 100 == 0:
+                acc, acc_cls, mean_iu, fwavacc = metrics.scores()
+    """
+
+    def __init__(self, num_classes, ignore_label=255, interval=10, stride=4):
+        """
+        Args:
+            interval(int): accumulate one call out of ``interval``.
+            stride(int): spatial subsampling of the accumulated maps.
+        """
+        super(RunningConfusionMatrix, self).__init__(num_classes, ignore_label)
+        self.interval = interval
+        self.stride = stride
+        self.num_calls = 0
+
+    def update(self, pred, label):
+        """
+        Args:
+            pred, label: N x H x W tensors (or H x W), see :meth:`ConfusionMatrix.update`.
+
+        Returns:
+            bool: whether this call was accumulated.
+        """
+        self.num_calls += 1
+        if (self.num_calls - 1) % self.interval:
+            return False
+        if self.stride > 1:
+            s = self.stride
+            pred = pred[:, ::s, ::s] if pred.dim() == 3 else pred[::s, ::s]
+            label = label[:, ::s, ::s] if label.dim() == 3 else label[::s, ::s]
+        super(RunningConfusionMatrix, self).update(pred, label)
+        return True
+
+    def scores(self, reset=True):
+        """
+        Returns:
+            tuple: pixel accuracy, mean class accuracy, mean IoU and frequency weighted IoU,
+            over the calls accumulated since the last reset.
+        """
+        result = (self.pixel_accuracy(), self.mean_accuracy(), self.miou(), self.frequency_weighted_iou())
+        if reset:
+            self.reset()
+        return result
+
+    def reset(self):
+        super(RunningConfusionMatrix, self).reset()
+        self.num_calls = 0
@@ -0,0 +1,255 @@
+# Author: Tao Hu <taohu620@gmail.com>
+
+import os
+import json
+import struct
+import zlib
+import numpy as np
+
+from . import logger
+from .fs import mkdir_p
+
+__all__ = ['ProbStore']
+
+_MAGIC = b'PRB1'
+_EXT = '.prob'
+
+
+class ProbStore(object):
+    """
+    Per-image C x H x W class probability maps on disk, in place of float32 ``.npy`` dumps.
+
+    Each map is stored as float16, or quantized to uint8 (step 1/255), optionally
+    keeping only the ``topk`` classes of every pixel along with their uint8 class ids.
+    The rows are split into chunks of ``chunk_rows`` that are zlib-compressed
+    independently, so a reader only decompresses the rows it asks for; the file is
+    read memory-mapped.
+
+    A file is ``PRB1``, the uint32 length of a json header (shape, encoding and the
+    offset / size of each chunk), the header, then the chunks. A chunk holds the values
+    of its rows, followed by their class ids with ``topk``.
+
+    With ``verify``, :meth:`save` decodes every map it writes and :meth:`summary`
+    reports the maximum / mean absolute probability error and how often the argmax changed.
+    """
+
+    def __init__(self, root, dtype='float16', topk=None, compress=True, chunk_rows=64, level=1, verify=False):
+        """
+        Args:
+            root (str): directory of the store, one ``<name>.prob`` file per map.
+            dtype (str): 'float16' or 'uint8', for writing.
+            topk (int): keep the k most probable classes per pixel. The rest of the
+                probability mass is spread evenly over the other classes when reading.
+            compress (bool): zlib-compress the chunks.
+            chunk_rows (int): rows per chunk.
+            level (int): zlib level.
+            verify (bool): measure the encoding error of the maps written.
+        """
+        assert dtype in ('float16', 'uint8'), dtype
+        assert topk is None or 0 < topk < 256, topk
+        self.root = root
+        self.dtype = dtype
+        self.topk = topk
+        self.compress = compress
+        self.chunk_rows = chunk_rows
+        self.level = level
+        self.verify = verify
+        mkdir_p(root)
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.num_saved = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.max_error = 0.0
+        self.error_sum = 0.0
+        self.num_values = 0
+        self.argmax_changed = 0
+        self.num_pixels = 0
+
+    def path(self, name):
+        return os.path.join(self.root, name + _EXT)
+
+    def names(self):
+        return sorted(f[:-len(_EXT)] for f in os.listdir(self.root) if f.endswith(_EXT))
+
+    def __contains__(self, name):
+        return os.path.isfile(self.path(name))
+
+    def _encode(self, probs):
+        if self.topk is not None and self.topk < probs.shape[0]:
+            ids = np.argpartition(-probs, self.topk - 1, axis=0)[:self.topk]
+            _, h, w = probs.shape
+            values = probs[ids, np.arange(h)[:, None], np.arange(w)]
+            ids = ids.astype(np.uint8)
+        else:
+            values, ids = probs, None
+        if self.dtype == 'uint8':
+            values = np.round(np.clip(values, 0, 1) * 255).astype(np.uint8)
+        else:
+            values = values.astype(np.float16)
+        return values, ids
+
+    def save(self, name, probs):
+        """
+        Args:
+            name (str): file name, without extension.
+            probs: C x H x W float probabilities (not scores).
+        """
+        probs = np.asarray(probs, dtype=np.float32)
+        n_class, h, w = probs.shape
+        values, ids = self._encode(probs)
+        chunks = []
+        for r in range(0, h, self.chunk_rows):
+            data = np.ascontiguousarray(values[:, r:r + self.chunk_rows]).tobytes()
+            if ids is not None:
+                data += np.ascontiguousarray(ids[:, r:r + self.chunk_rows]).tobytes()
+            chunks.append(zlib.compress(data, self.level) if self.compress else data)
+
+        offsets, offset = [], 0
+        for c in chunks:
+            offsets.append([offset, len(c)])
+            offset += len(c)
+        header = json.dumps({'shape': [n_class, h, w], 'dtype': self.dtype,
+                             'k': None if ids is None else len(ids), 'compress': self.compress,
+                             'chunk_rows': self.chunk_rows, 'chunks': offsets}).encode('utf-8')
+
+        # write then rename, a reader never sees a partial file
+        path = self.path(name)
+        tmp_path = path + '.{}.tmp'.format(os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(_MAGIC + struct.pack('<I', len(header)) + header)
+            for c in chunks:
+                f.write(c)
+        os.rename(tmp_path, path)
+
+        self.num_saved += 1
+        self.raw_bytes += probs.size * 4
+        self.stored_bytes += 8 + len(header) + offset
+        if self.verify:
+            decoded = self.load(name)
+            error = np.abs(decoded - probs)
+            self.max_error = max(self.max_error, float(error.max()))
+            self.error_sum += float(error.sum())
+            self.num_values += error.size
+            self.argmax_changed += int((decoded.argmax(0) != probs.argmax(0)).sum())
+            self.num_pixels += h * w
+
+    @staticmethod
+    def _read_header(buf):
+        if bytes(buf[:4]) != _MAGIC:
+            raise ValueError("Not a probability store file")
+        size = struct.unpack('<I', bytes(buf[4:8]))[0]
+        return json.loads(bytes(buf[8:8 + size]).decode('utf-8')), 8 + size
+
+    def load(self, name, rows=None):
+        """
+        Args:
+            name (str): file name, without extension.
+            rows: optional ``slice`` of rows to read, only their chunks are decompressed.
+
+        Returns:
+            np.ndarray: C x H x W float32 probabilities (C x len(rows) x W).
+        """
+        buf = np.memmap(self.path(name), dtype=np.uint8, mode='r')
+        header, start = self._read_header(buf)
+        n_class, h, w = header['shape']
+        chunk_rows = header['chunk_rows']
+        k = header['k']
+        dtype = np.dtype(header['dtype'])
+        r0, r1, _ = (rows or slice(None)).indices(h)
+        r1 = max(r0, r1)
+
+        depth = k or n_class
+        values = np.empty((depth, r1 - r0, w), dtype=dtype)
+        ids = np.empty((depth, r1 - r0, w), dtype=np.uint8) if k else None
+        for i in range(r0 // chunk_rows, (r1 + chunk_rows - 1) // chunk_rows):
+            offset, size = header['chunks'][i]
+            data = buf[start + offset:start + offset + size]
+            data = zlib.decompress(data.tobytes()) if header['compress'] else data
+            c0 = i * chunk_rows
+            n = min(chunk_rows, h - c0)
+            value_bytes = depth * n * w * dtype.itemsize
+            chunk_values = np.frombuffer(data[:value_bytes], dtype=dtype).reshape(depth, n, w)
+            lo, hi = max(r0, c0), min(r1, c0 + n)
+            values[:, lo - r0:hi - r0] = chunk_values[:, lo - c0:hi - c0]
+            if k:
+                chunk_ids = np.frombuffer(data[value_bytes:], dtype=np.uint8).reshape(depth, n, w)
+                ids[:, lo - r0:hi - r0] = chunk_ids[:, lo - c0:hi - c0]
+        del buf
+
+        values = values.astype(np.float32)
+        if dtype == np.uint8:
+            values /= 255.
+        if not k:
+            return values
+        rest = np.maximum(1. - values.sum(0), 0) / max(n_class - k, 1)
+        probs = np.empty((n_class, r1 - r0, w), dtype=np.float32)
+        probs[:] = rest
+        probs[ids, np.arange(r1 - r0)[:, None], np.arange(w)] = values
+        return probs
+
+    def summary(self, reset=True):
+        """
+        Returns:
+            dict: the maps saved, the float32 / stored size ratio, and with ``verify`` the
+            maximum and mean absolute probability error and the fraction of pixels whose
+            argmax changed. Also logged.
+        """
+        result = {'saved': self.num_saved,
+                  'ratio': float(self.raw_bytes) / max(self.stored_bytes, 1)}
+        msg = "Probability store {}: {} maps, {:.1f}MB instead of {:.1f}MB as float32 ({:.1f}x)".format(
+            self.root, self.num_saved, self.stored_bytes / 2. ** 20, self.raw_bytes / 2. ** 20, result['ratio'])
+        if self.verify and self.num_values:
+            result.update({'max_error': self.max_error,
+                           'mean_error': self.error_sum / self.num_values,
+                           'argmax_changed': float(self.argmax_changed) / self.num_pixels})
+            msg += ", max abs error {:.4f}, mean abs error {:.5f}, argmax changed on {:.4%} of the pixels".format(
+                result['max_error'], result['mean_error'], result['argmax_changed'])
+        logger.info(msg)
+        if reset:
+            self._reset_stats()
+        return result
+
+
+def _softmax(scores):
+    e = np.exp(scores - scores.max(axis=0, keepdims=True))
+    return e / e.sum(axis=0)
+
+
+def main():
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(
+        description='Convert a directory of C x H x W .npy maps into a probability store, '
+                    'or time reading one back')
+    parser.add_argument('indir', help='directory of .npy files, or of a store with --read')
+    parser.add_argument('outdir', nargs='?', default=None)
+    parser.add_argument('--scores', action='store_true', help='the npys hold scores, apply a softmax')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'uint8'])
+    parser.add_argument('--topk', type=int, default=None)
+    parser.add_argument('--no_compress', action='store_true')
+    parser.add_argument('--verify', action='store_true', help='report the encoding error')
+    parser.add_argument('--read', action='store_true', help='time reading the store at indir')
+    args = parser.parse_args()
+
+    if args.read:
+        store = ProbStore(args.indir)
+        start = time.time()
+        names = store.names()
+        for name in names:
+            store.load(name)
+        logger.info("Read {} maps in {:.2f}s".format(len(names), time.time() - start))
+        return
+
+    store = ProbStore(args.outdir, dtype=args.dtype, topk=args.topk, compress=not args.no_compress,
+                      verify=args.verify)
+    for f in sorted(os.listdir(args.indir)):
+        if f.endswith('.npy'):
+            probs = np.load(os.path.join(args.indir, f)).astype(np.float32)
+            store.save(f[:-len('.npy')], _softmax(probs) if args.scores else probs)
+    store.summary()
+
+
+if __name__ == '__main__':
+    main()
@@ -25,12 +25,9 @@ def model_summary(model_list):
 
 
     for model in model_list:
-        state_dict = model.state_dict().copy()
-        params = filter(lambda p: p.requires_grad, model.parameters())
-
         data = []
         param_num = 0
-        for key,value in state_dict.items():
+        for key,value in model.state_dict().items():
             data.append([key,list(value.size())])
             param_num += reduce(mul, list(value.size()), 1)
         table = tabulate(data, headers=['name', 'shape'])
@@ -0,0 +1,139 @@
+# Author: Tao Hu <taohu620@gmail.com>
+
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.autograd import Variable
+from numpy.lib.format import open_memmap
+
+from . import logger
+from .fs import mkdir_p
+
+__all__ = ['TeacherCache']
+
+
+class TeacherCache(object):
+    """
+    Memoize the outputs of a frozen teacher network (e.g. the source-only ``model_fix``
+    used as distillation target) on disk, so that it only runs once per input.
+
+    Entries are keyed by a fixed grid of integer keys of shape ``key_shape``, typically
+    (image index, crop row, crop column), and stored average-pooled by ``downsample`` in
+    float16, in one preallocated ``.npy`` file that is memory-mapped, next to a small
+    ``.index.npy`` of the filled entries. The file is sparse, it only takes disk space as
+    it fills up. :meth:`__call__` always returns the stored (reduced) version upsampled to
+    the input size, so a sample gets the same target whether it hit the cache or not.
+
+    Inputs without a key in the grid (a negative or out of range component, e.g. a crop
+    that is not grid-aligned) or that went through random augmentation (``augmented``)
+    can't be cached: the teacher runs on them without touching the store.
+    """
+
+    def __init__(self, teacher, path, key_shape, entry_shape, downsample=8, dtype=np.float16, clear=False):
+        """
+        Args:
+            teacher (nn.Module): frozen network, N x C x H x W -> N x K x H x W.
+            path (str): the store, one per (teacher, dataset) pair.
+            key_shape (tuple): number of values of each key component.
+            entry_shape (tuple): K x h x w, the shape of a reduced teacher output
+                (h and w are the input size divided by ``downsample``, rounded up).
+            downsample (int): spatial reduction of the stored outputs.
+            dtype: storage dtype.
+            clear (bool): drop the existing entries, e.g. after changing the teacher.
+        """
+        self.teacher = teacher
+        self.path = path
+        self.key_shape = tuple(int(k) for k in key_shape)
+        self.downsample = downsample
+        self.hits = 0
+        self.misses = 0
+        shape = (int(np.prod(self.key_shape)),) + tuple(int(s) for s in entry_shape)
+        index_path = os.path.splitext(path)[0] + '.index.npy'
+        mkdir_p(os.path.dirname(os.path.abspath(path)))
+
+        if os.path.isfile(path) and os.path.isfile(index_path):
+            self._store = open_memmap(path, mode='r+')
+            self._filled = open_memmap(index_path, mode='r+')
+            if self._store.shape != shape or self._store.dtype != np.dtype(dtype):
+                if not clear:
+                    raise ValueError("{} holds {} {} entries, expected {} {}, clear it to start over".format(
+                        path, self._store.shape, self._store.dtype, shape, np.dtype(dtype)))
+                del self._store, self._filled
+                os.remove(path)
+                os.remove(index_path)
+            elif clear:
+                self.clear()
+        if not hasattr(self, '_store'):
+            self._filled = open_memmap(index_path, mode='w+', dtype=np.uint8, shape=shape[:1])
+            self._store = open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        logger.info("Teacher cache at {}: {} of {} entries filled".format(
+            path, int(np.count_nonzero(self._filled)), shape[0]))
+
+    def _reduce(self, score):
+        if self.downsample > 1:
+            score = F.avg_pool2d(score, self.downsample, ceil_mode=True)
+        return score
+
+    def _entries(self, keys):
+        """Index of each key in the store, -1 for the keys outside the grid."""
+        keys = keys.cpu().numpy() if torch.is_tensor(keys) else np.asarray(keys)
+        keys = keys.reshape(len(keys), -1)
+        inside = ((keys >= 0) & (keys < np.array(self.key_shape))).all(1)
+        entries = np.full(len(keys), -1, dtype=np.int64)
+        if inside.any():
+            entries[inside] = np.ravel_multi_index(keys[inside].T, self.key_shape)
+        return entries
+
+    def clear(self):
+        self._filled[:] = 0
+
+    def __call__(self, images, keys, augmented=None):
+        """
+        Args:
+            images: Variable, N x C x H x W, the teacher input.
+            keys: N keys, rows of ints (e.g. an N x len(key_shape) LongTensor).
+            augmented: optional N booleans, entries to compute fresh and not store.
+
+        Returns:
+            Variable: N x K x H x W teacher output, without graph.
+        """
+        n, _, h, w = images.size()
+        entries = self._entries(keys)
+        if augmented is not None:
+            entries[np.asarray(augmented, dtype=bool)] = -1
+        outputs = [None] * n
+        todo = []
+        for i, e in enumerate(entries):
+            if e >= 0 and self._filled[e]:
+                outputs[i] = torch.from_numpy(self._store[e].astype(np.float32))
+            else:
+                todo.append(i)
+        self.hits += n - len(todo)
+        self.misses += len(todo)
+
+        if todo:
+            index = torch.LongTensor(todo)
+            if images.is_cuda:
+                index = index.cuda()
+            inputs = Variable(images.data.index_select(0, index), volatile=True)
+            reduced = self._reduce(self.teacher(inputs)).data.float().cpu().numpy().astype(self._store.dtype)
+            for j, i in enumerate(todo):
+                outputs[i] = torch.from_numpy(reduced[j].astype(np.float32))
+                e = entries[i]
+                if e >= 0:
+                    # the data first: a crash in between leaves the entry unfilled
+                    self._store[e] = reduced[j]
+                    self._filled[e] = 1
+
+        reduced = torch.stack(outputs)
+        if images.is_cuda:
+            reduced = reduced.cuda(images.get_device())
+        score = Variable(reduced, volatile=True)
+        if self.downsample > 1:
+            score = F.upsample(score, size=(h, w), mode='bilinear')
+        return Variable(score.data)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0.0
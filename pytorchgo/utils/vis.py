@@ -1,18 +1,92 @@
 # Author: Tao Hu <taohu620@gmail.com>
+import torch
 import torchvision
 import numpy as np
+from PIL import Image
+
+__all__ = ['CITYSCAPES_PALETTE', 'label_colormap', 'full_palette', 'colorize', 'palette_image', 'vis_seg']
+
+# the 19 Cityscapes train ids, everything else (ignore label included) maps to black
+CITYSCAPES_PALETTE = np.array([[128, 64, 128], [244, 35, 232], [70, 70, 70], [102, 102, 156], [190, 153, 153],
+                               [153, 153, 153], [250, 170, 30], [220, 220, 0], [107, 142, 35], [152, 251, 152],
+                               [70, 130, 180], [220, 20, 60], [255, 0, 0], [0, 0, 142], [0, 0, 70],
+                               [0, 60, 100], [0, 80, 100], [0, 0, 230], [119, 11, 32]], dtype=np.uint8)
+
+
+def label_colormap(n=256):
+    """
+    The PASCAL VOC colormap: the bits of the label id are spread over the high bits of r, g and b.
+
+    Returns:
+        np.ndarray: n x 3 uint8.
+    """
+    ids = np.arange(n)
+    cmap = np.zeros((n, 3), dtype=np.uint8)
+    for j in range(8):
+        for c in range(3):
+            cmap[:, c] |= (((ids >> (3 * j + c)) & 1) << (7 - j)).astype(np.uint8)
+    return cmap
+
+
+def full_palette(palette):
+    """
+    Returns:
+        np.ndarray: 256 x 3 uint8, ``palette`` (k x 3 or flat) padded with black.
+    """
+    palette = np.asarray(palette, dtype=np.uint8).reshape(-1, 3)[:256]
+    full = np.zeros((256, 3), dtype=np.uint8)
+    full[:len(palette)] = palette
+    return full
+
+
+def colorize(labels, palette):
+    """
+    Colorize label maps with one palette lookup, whatever the number of classes.
+
+    Args:
+        labels: integer label maps with values in [0, 255], of any shape (..., H, W):
+            an np.ndarray, or a tensor on any device.
+        palette: k x 3 colors, ids >= k are black. Either array-like, or a 256 x 3
+            ByteTensor (e.g. ``torch.from_numpy(full_palette(p))``) to avoid rebuilding it per call.
+
+    Returns:
+        uint8 colors, (..., H, W, 3) for an np.ndarray and (..., 3, H, W) on the device of
+        ``labels`` for a tensor.
+    """
+    if isinstance(labels, np.ndarray):
+        if torch.is_tensor(palette):
+            palette = palette.cpu().numpy()
+        return full_palette(palette)[labels]
+
+    cmap = palette if torch.is_tensor(palette) else torch.from_numpy(full_palette(palette))
+    if labels.is_cuda and not cmap.is_cuda:
+        cmap = cmap.cuda(labels.get_device())
+    size = labels.size()
+    colors = cmap.index_select(0, labels.contiguous().view(-1).long()).view(*(tuple(size) + (3,)))
+    dims = len(size)
+    return colors.permute(*(tuple(range(dims - 2)) + (dims, dims - 2, dims - 1))).contiguous()
+
+
+def palette_image(label, palette):
+    """
+    Returns:
+        PIL.Image: the H x W label map as a 'P' mode image with ``palette``. Saved as PNG
+        it stays one byte per pixel, the colors are only applied by the viewer.
+    """
+    image = Image.fromarray(np.asarray(label, dtype=np.uint8))
+    image.putpalette(full_palette(palette).reshape(-1).tolist())
+    return image
+
 
 def vis_seg(imgs, labels, waitkey = 10000):
     import cv2
-    from tensorpack.utils.segmentation.segmentation import predict_slider, visualize_label, predict_scaler
     img = torchvision.utils.make_grid(imgs).numpy()
     img = np.transpose(img, (1, 2, 0))
     img = img[:, :, ::-1] + 128
 
-    label = torchvision.utils.make_grid(labels.unsqueeze(1)).numpy()
-    label = np.transpose(label, (1, 2, 0))
+    label = torchvision.utils.make_grid(labels.unsqueeze(1)).numpy()[0]
     # plt.imshow(img)
     # plt.show()
     cv2.imshow("source image", img.astype(np.uint8))
-    cv2.imshow("source label", visualize_label(label[:, :, 0]))
-    cv2.waitKey(waitkey)
\ No newline at end of file
+    cv2.imshow("source label", np.ascontiguousarray(colorize(label, label_colormap())[:, :, ::-1]))
+    cv2.waitKey(waitkey)
@@ -0,0 +1,255 @@
+# Author: Tao Hu <taohu620@gmail.com>
+
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+import torch
+
+from . import logger
+from .fs import mkdir_p
+
+__all__ = ['WeightStore', 'convert', 'cached_weights', 'cached_url', 'load_weights']
+
+_MAGIC = b'PGW1'
+_ALIGN = 64
+
+
+def _default_cache_dir():
+    return os.path.expanduser(os.getenv('PYTORCHGO_WEIGHT_CACHE', '~/.pytorchgo/weights'))
+
+
+def _md5(path, chunk_size=2 ** 22):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _state_dict(checkpoint, key=None):
+    if key is not None:
+        checkpoint = checkpoint[key]
+    elif 'state_dict' in checkpoint and not torch.is_tensor(checkpoint['state_dict']):
+        checkpoint = checkpoint['state_dict']
+    return checkpoint
+
+
+def convert(src, dst, key=None, source_md5=None):
+    """
+    Convert a ``torch.save``-d state dict to the weight store format: ``PGW1``, the uint32
+    length of a json header (dtype, shape and offset of every tensor), the header, then
+    the raw tensors, each 64-byte aligned.
+
+    Args:
+        src(str): the checkpoint.
+        dst(str): the converted file.
+        key(str): entry of the checkpoint holding the state dict, by default the checkpoint
+            itself or its 'state_dict'.
+    """
+    state_dict = _state_dict(torch.load(src, map_location=lambda storage, loc: storage), key)
+    names, arrays, tensors, offset = [], [], {}, 0
+    for name, value in state_dict.items():
+        if not torch.is_tensor(value):
+            continue
+        array = value.cpu().contiguous().numpy()
+        tensors[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        names.append(name)
+        arrays.append(array)
+        offset += -(-array.nbytes // _ALIGN) * _ALIGN
+    header = json.dumps({'tensors': tensors, 'order': names, 'source_md5': source_md5}).encode('utf-8')
+    start = -(-(8 + len(header)) // _ALIGN) * _ALIGN
+
+    # write then rename, concurrent workers converting the same file do not clash
+    tmp_path = dst + '.{}.tmp'.format(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_MAGIC + struct.pack('<I', len(header)) + header)
+        for name, array in zip(names, arrays):
+            f.seek(start + tensors[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(start + offset)
+    os.rename(tmp_path, dst)
+    return dst
+
+
+class WeightStore(object):
+    """
+    A converted state dict, memory-mapped: opening it only reads the header, and a tensor
+    is read from disk when it is copied. Workers loading the same file share its pages
+    through the page cache.
+
+    Examples:
+
+    .. code-block:: python
+
+        store = cached_weights(MS_Deeplab.download(), md5=MS_Deeplab.pretrained_md5)
+        store.load_into(model, prefixes=['Scale.conv1', 'Scale.layer'])
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # copy-on-write: the pages stay shared as long as nobody writes to them
+        self._buf = np.memmap(path, dtype=np.uint8, mode='c')
+        if bytes(self._buf[:4]) != _MAGIC:
+            raise ValueError("{} is not a weight store file".format(path))
+        size = struct.unpack('<I', bytes(self._buf[4:8]))[0]
+        header = json.loads(bytes(self._buf[8:8 + size]).decode('utf-8'))
+        self._start = -(-(8 + size) // _ALIGN) * _ALIGN
+        self._tensors = header['tensors']
+        self._order = header['order']
+        self.source_md5 = header['source_md5']
+
+    def keys(self):
+        return list(self._order)
+
+    def __contains__(self, name):
+        return name in self._tensors
+
+    def __len__(self):
+        return len(self._order)
+
+    def shape(self, name):
+        return tuple(self._tensors[name]['shape'])
+
+    def array(self, name):
+        """The tensor as an np.ndarray view of the mapped file."""
+        info = self._tensors[name]
+        dtype = np.dtype(info['dtype'])
+        count = int(np.prod(info['shape'])) if info['shape'] else 1
+        start = self._start + info['offset']
+        return self._buf[start:start + count * dtype.itemsize].view(dtype).reshape(info['shape'])
+
+    def __getitem__(self, name):
+        """The tensor, sharing the memory of the mapped file."""
+        return torch.from_numpy(self.array(name))
+
+    def load_into(self, model, prefixes=None, rename=None, strict=True):
+        """
+        Copy weights straight from the mapped file into the parameters and buffers of
+        ``model``, without building a state dict.
+
+        Args:
+            model: nn.Module, on any device.
+            prefixes: only load the model entries whose name starts with one of these.
+            rename: function model entry name -> name in the store, or None to skip the entry.
+            strict(bool): raise if a selected entry is missing from the store or has another
+                shape, or, when the whole model is loaded (no ``prefixes`` nor ``rename``),
+                if the store holds tensors the model has no entry for, like
+                ``load_state_dict``. Otherwise these are reported with a warning.
+
+        Returns:
+            list: the names of the model entries loaded.
+        """
+        loaded, missing = [], []
+        own_state = model.state_dict()
+        for name, own in own_state.items():
+            if prefixes is not None and not name.startswith(tuple(prefixes)):
+                continue
+            key = rename(name) if rename is not None else name
+            if key is None:
+                continue
+            if key not in self._tensors:
+                missing.append(name)
+                continue
+            if tuple(own.size()) != self.shape(key):
+                msg = "{}: shape {} in the model, {} in {}".format(name, tuple(own.size()), self.shape(key), self.path)
+                if strict:
+                    raise ValueError(msg)
+                logger.warn("Not loaded, " + msg)
+                continue
+            own.copy_(self[key])
+            loaded.append(name)
+        if missing:
+            msg = "Missing in {}: {}".format(self.path, ', '.join(missing))
+            if strict:
+                raise KeyError(msg)
+            logger.warn(msg)
+        if prefixes is None and rename is None:
+            unused = [key for key in self._order if key not in own_state]
+            if unused:
+                msg = "Not in the model, from {}: {}".format(self.path, ', '.join(unused))
+                if strict:
+                    raise KeyError(msg)
+                logger.warn(msg)
+        logger.info("Loaded {} tensors from {}".format(len(loaded), self.path))
+        return loaded
+
+
+def cached_weights(path, md5=None, cache_dir=None, key=None):
+    """
+    Returns:
+        WeightStore: of the checkpoint at ``path``, converted once and cached as
+        ``<cache_dir>/<md5>.pgw``. Without ``md5`` (e.g. the one checked by the download),
+        the md5 of the file is computed the first time and remembered for its size and
+        modification time.
+    """
+    cache_dir = cache_dir or _default_cache_dir()
+    mkdir_p(cache_dir)
+    if md5 is None:
+        stat = os.stat(path)
+        memo = os.path.join(cache_dir, hashlib.md5('{}:{}:{}'.format(
+            os.path.abspath(path), stat.st_size, int(stat.st_mtime)).encode('utf-8')).hexdigest() + '.md5')
+        if os.path.isfile(memo):
+            with open(memo) as f:
+                md5 = f.read().strip()
+        else:
+            md5 = _md5(path)
+            with open(memo + '.{}.tmp'.format(os.getpid()), 'w') as f:
+                f.write(md5)
+            os.rename(memo + '.{}.tmp'.format(os.getpid()), memo)
+    name = md5 if key is None else '{}-{}'.format(md5, key)
+    cached = os.path.join(cache_dir, name + '.pgw')
+    if not os.path.isfile(cached):
+        logger.info("Converting {} to {}".format(path, cached))
+        convert(path, cached, key=key, source_md5=md5)
+    return WeightStore(cached)
+
+
+def cached_url(url, md5=None, cache_dir=None):
+    """
+    Like ``model_zoo.load_url``, without loading the checkpoint: download it to the model
+    zoo directory if needed and return its :class:`WeightStore`.
+    """
+    from torch.utils import model_zoo
+    model_dir = os.path.expanduser(os.getenv('TORCH_MODEL_ZOO', os.path.join('~', '.torch', 'models')))
+    mkdir_p(model_dir)
+    path = os.path.join(model_dir, os.path.basename(url))
+    if not os.path.isfile(path):
+        logger.info("Downloading {} to {}".format(url, path))
+        download = getattr(model_zoo, 'download_url_to_file', None) or model_zoo._download_url_to_file
+        download(url, path, None)
+    return cached_weights(path, md5=md5, cache_dir=cache_dir)
+
+
+def load_weights(model, path, prefixes=None, rename=None, strict=True, md5=None, key=None):
+    """
+    :func:`cached_weights` then :meth:`WeightStore.load_into`.
+
+    Returns:
+        list: the names of the model entries loaded.
+    """
+    return cached_weights(path, md5=md5, key=key).load_into(model, prefixes=prefixes, rename=rename, strict=strict)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert a checkpoint to a weight store file, or list one')
+    parser.add_argument('src', help='checkpoint, or a .pgw file with --list')
+    parser.add_argument('dst', nargs='?', default=None, help='by default, into the cache directory')
+    parser.add_argument('--key', default=None, help='entry of the checkpoint holding the state dict')
+    parser.add_argument('--list', action='store_true')
+    args = parser.parse_args()
+
+    if args.list:
+        store = WeightStore(args.src)
+        for name in store.keys():
+            print(name, store.shape(name))
+    elif args.dst:
+        convert(args.src, args.dst, key=args.key)
+    else:
+        logger.info("Cached as {}".format(cached_weights(args.src, key=args.key).path))
+
+
+if __name__ == '__main__':
+    main()